@@ -59,3 +59,5 @@ completed_by VARCHAR(50) REFERENCES "users",
 completed_task INT REFERENCES tasks,
 PRIMARY KEY(completed_by,completed_task)
 );
+
+CREATE INDEX posts_feed_order ON posts (created_at DESC, post_id DESC);
@@ -0,0 +1,12 @@
+"""
+    :module_name: gunicorn.conf
+    :module_summary: gunicorn settings for serving the slice of life backend
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+def post_worker_init(worker): # pylint: disable=unused-argument
+    """
+        Every worker keeps its own caches, so each listens for the changes the others make
+    """
+    from sliceoflife_webservice.api import BaseSliceOfLifeApiResponse # pylint: disable=import-outside-toplevel
+    BaseSliceOfLifeApiResponse.start_invalidation_bus()
@@ -11,18 +11,34 @@ from secrets import compare_digest
 from datetime import timedelta
 
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import Flask, Request, request
 from flask_cors import cross_origin
 
+from .toolkit import ImageUploadFile
+from .api import BaseSliceOfLifeApiResponse
 from .api.get import SliceOfLifeApiGetResponse
 from .api.post import SliceOfLifeApiPostResponse
+from .api.put import SliceOfLifeApiPutResponse
 from .api.options import SliceOfLifeApiOptionsResponse
 
 LOGGER = logging.getLogger('gunicorn.error')
 
 load_dotenv()
 
+class SliceOfLifeRequest(Request):
+    """
+        Requests to the slice of life API. Every file the API accepts is an image, so
+        uploaded files are checked as their first bytes arrive, while the body is parsed
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return ImageUploadFile()
+
 app = Flask(__name__)
+app.request_class = SliceOfLifeRequest
+# requests without a declared length are cut off once they read past the limit
+app.config['MAX_CONTENT_LENGTH'] = BaseSliceOfLifeApiResponse.max_upload_bytes
 
 LOGGER.info("Created an API application instance")
 
@@ -36,6 +52,15 @@ def greeting():
     LOGGER.info("Responding to GET /api/v1/greeting")
     return SliceOfLifeApiGetResponse().hello()
 
+LOGGER.info("Added the route: GET /api/v1/stats")
+@app.route('/api/v1/stats', methods=['GET'])
+def service_stats():
+    """
+        GET operational statistics for the worker serving the request
+    """
+    LOGGER.info("Responding to GET /api/v1/stats")
+    return SliceOfLifeApiGetResponse().get_service_stats()
+
 LOGGER.info("Added the route: GET /api/v1/slices/latest")
 @app.route('/api/v1/slices/latest', methods=['GET'])
 @cross_origin(allow_headers=['x-auth-token'], max_age=timedelta(seconds=60))
@@ -126,3 +151,42 @@ def new_post():
     """
     LOGGER.info("Responding to POST /api/v1/slices/new")
     return SliceOfLifeApiPostResponse().create_new_post()
+
+LOGGER.info("Added the route: POST /api/v1/slices/upload")
+@app.route('/api/v1/slices/upload', methods=['POST'])
+@cross_origin(allow_headers=['x-auth-token'], max_age=timedelta(seconds=60))
+def new_post_upload():
+    """
+        Get a link to upload a new post's image to, if the user is authenticated
+    """
+    LOGGER.info("Responding to POST /api/v1/slices/upload")
+    return SliceOfLifeApiPostResponse().start_post_upload()
+
+LOGGER.info("Added the route: POST /api/v1/slices/upload/finish")
+@app.route('/api/v1/slices/upload/finish', methods=['POST'])
+@cross_origin(allow_headers=['x-auth-token'], max_age=timedelta(seconds=60))
+def finish_post_upload():
+    """
+        Create a new post from an uploaded image, if the user is authenticated
+    """
+    LOGGER.info("Responding to POST /api/v1/slices/upload/finish")
+    return SliceOfLifeApiPostResponse().finish_post_upload()
+
+LOGGER.info("Added the route: GET /api/v1/files/<:key>")
+@app.route('/api/v1/files/<path:key>', methods=['GET'])
+def stored_file(key: str):
+    """
+        GET a file kept in local storage through a signed link
+    """
+    LOGGER.info("Responding to GET /api/v1/files/<key>")
+    return SliceOfLifeApiGetResponse().get_stored_file(key)
+
+LOGGER.info("Added the route: PUT /api/v1/files/<:key>")
+@app.route('/api/v1/files/<path:key>', methods=['PUT'])
+@cross_origin(max_age=timedelta(seconds=60))
+def upload_stored_file(key: str):
+    """
+        PUT a file into local storage through a signed link
+    """
+    LOGGER.info("Responding to PUT /api/v1/files/<key>")
+    return SliceOfLifeApiPutResponse().put_stored_file(key)
@@ -7,19 +7,53 @@
 import logging
 import os
 import datetime
+import hashlib
+import time
+from dataclasses import replace
 
 import jwt
 from dotenv import load_dotenv
-from flask import jsonify, make_response, request
+from flask import Response, g, jsonify, make_response, request
 
-from ..dbtools import Instance
-from ..toolkit import SpaceIndex
+from ..dbtools import Instance, PoolLimits, Replication, InvalidationBus, invalidation_message
+from ..dbtools.queries import notify_invalidation
+from ..toolkit import SpaceIndex, ImagePipeline, TaskCatalog, SingleFlight, region_cache
 from ..exceptions import SliceOfLifeAPIException, ContentNotFoundError, \
-                         AuthorizationError, ServiceNotReachable
+                         AuthorizationError, ServiceNotReachable, \
+                         UploadTooLargeError, UnsupportedMediaError
 
 LOGGER = logging.getLogger("gunicorn.error")
 
+# the most connections each worker opens to the primary. The read pool takes
+# DBREADCONNECTIONS of them (half, if unset) and the write pool the rest. The invalidation
+# bus holds one more, so a worker's total on the primary is DBCONNECTIONS + 1. Each
+# replica gets a read pool of DBREADCONNECTIONS of its own
 DBCONNECTIONS = 10
+DBMINCONNECTIONS = 0
+DBACQUIRETIMEOUT = 2.5
+DBIDLETIMEOUT = 300
+DBMAXCONNAGE = 1800
+DBCHECKAFTER = 30
+DBSTATEMENTCACHE = 64
+DBROUTING = 'round_robin'
+DBSTICKYWINDOW = 5.0
+DBSTICKYWRITERS = 4096
+MAXUPLOADBYTES = 10 * 1024 * 1024
+IMAGEWORKERS = 2
+PROFILECACHE = 4096
+PROFILECACHETTL = 300
+TASKCACHE = 1024
+TASKCACHETTL = 600
+TASKCATALOGTTL = 600
+RESPONSECACHE = 1024
+RESPONSECACHEBYTES = 32 * 1024 * 1024
+# a post takes about a kilobyte of JSON, so a slot holds a page of MAXPAGESIZE posts
+RESPONSECACHESLOT = 128 * 1024
+POSTIMAGECACHE = 4096
+MAXPAGESIZE = 100
+LATESTCACHETTL = 10
+SLICECACHETTL = 30
+INVALIDATIONCHANNEL = 'sliceoflife_invalidations'
 
 load_dotenv()
 
@@ -31,8 +65,31 @@ class BaseSliceOfLifeApiResponse():
 
     _instance = None
     _space = None
+    _images = None
+    _bus = None
     _auth_secret_key = os.getenv('APP_AUTH_KEY', 'testing_key_DONOTUSE')
     _jwt_algoritm="HS256"
+    max_upload_bytes = int(os.getenv('MAXUPLOADBYTES', str(MAXUPLOADBYTES)))
+    invalidation_channel = os.getenv('INVALIDATIONCHANNEL', INVALIDATIONCHANNEL)
+    # public profiles and tasks rarely change, so every request in the worker shares them.
+    # with SHAREDCACHEDIR set, so does every worker on the machine
+    _profiles = region_cache('profiles', int(os.getenv('PROFILECACHE', str(PROFILECACHE))),
+                             ttl=float(os.getenv('PROFILECACHETTL', str(PROFILECACHETTL))),
+                             slot_size=1024)
+    _tasks = region_cache('tasks', int(os.getenv('TASKCACHE', str(TASKCACHE))),
+                          ttl=float(os.getenv('TASKCACHETTL', str(TASKCACHETTL))),
+                          slot_size=1024)
+    _catalog = TaskCatalog(ttl=float(os.getenv('TASKCATALOGTTL', str(TASKCATALOGTTL))))
+    _responses = region_cache('responses', int(os.getenv('RESPONSECACHE', str(RESPONSECACHE))),
+                              slot_size=int(os.getenv('RESPONSECACHESLOT',
+                                                      str(RESPONSECACHESLOT))),
+                              max_bytes=int(os.getenv('RESPONSECACHEBYTES',
+                                                      str(RESPONSECACHEBYTES))))
+    # posts are never edited, so the image each one shows is kept until it is pushed out
+    _post_images = region_cache('post_images',
+                                int(os.getenv('POSTIMAGECACHE', str(POSTIMAGECACHE))),
+                                slot_size=256)
+    _flights = SingleFlight()
 
     def __init__(self):
         self._conn = None
@@ -76,6 +133,104 @@ class BaseSliceOfLifeApiResponse():
             LOGGER.error("Claim immature or expired %s", str(exc))
             return False
 
+    def authenticated_handle(self) -> str:
+        """
+            Returns the handle the request is authenticated as, if it carries a valid token
+            :returns: the handle claimed by the request's auth token
+            :rtype: str or NoneType
+        """
+        token = request.headers.get('x-auth-token')
+        if not token:
+            return None
+        try:
+            return jwt.decode(token,
+                              self._auth_secret_key,
+                              algorithms=self._jwt_algoritm,
+                              ).get('handle')
+        except jwt.exceptions.InvalidTokenError:
+            return None
+
+    def recent_writer(self) -> str:
+        """
+            Returns the handle the request is authenticated as, if that handle wrote recently
+            enough that its reads are kept on the primary
+            :returns: the handle of a recent writer
+            :rtype: str or NoneType
+        """
+        handle = self.authenticated_handle()
+        return handle if self.instance.wrote_recently(handle) else None
+
+    def forget_user(self, handle: str) -> None:
+        """
+            Drop any cached copy of a user's public profile. Call after writing to the user
+            :arg handle: the handle of the user that changed
+            :returns: nothing
+            :rtype: NoneType
+        """
+        self._forget_profiles(handle)
+
+    def forget_responses(self, route: str) -> None:
+        """
+            Drop every cached response of a route. Call after writing something it shows
+            :arg route: the name the route's responses are cached under
+            :returns: nothing
+            :rtype: NoneType
+        """
+        self._forget_responses(route)
+
+    def announce_change(self, region: str, key=None) -> None:
+        """
+            Tell every worker that something they may have cached has changed. The message is
+            sent with the current transaction, so it is only delivered once it commits
+            :arg region: the cache region that changed, one of profiles, tasks or responses
+            :arg key: the handle, task id or route that changed, or None for the whole region
+                      (defaults to None)
+            :returns: nothing
+            :rtype: NoneType
+        """
+        Instance.query_no_fetch(
+            self._conn,
+            notify_invalidation(self.invalidation_channel, invalidation_message(region, key))
+        )
+
+    @classmethod
+    def start_invalidation_bus(cls) -> InvalidationBus:
+        """
+            Start listening for changes announced by other workers, and drop what they make
+            stale from this worker's caches. Call once in each worker after it starts
+            :returns: the running invalidation bus
+            :rtype: InvalidationBus
+        """
+        if not cls._bus:
+            cls._bus = InvalidationBus(cls._shared_instance().listen, cls.invalidation_channel)
+            cls._bus.subscribe('profiles', cls._forget_profiles)
+            cls._bus.subscribe('tasks', cls._forget_tasks)
+            cls._bus.subscribe('responses', cls._forget_responses)
+        cls._bus.start()
+        return cls._bus
+
+    @classmethod
+    def _forget_profiles(cls, handle: str) -> None:
+        if handle is None:
+            cls._profiles.clear()
+        else:
+            cls._profiles.invalidate(handle)
+
+    @classmethod
+    def _forget_tasks(cls, task_id: int) -> None:
+        if task_id is None:
+            cls._tasks.clear()
+        else:
+            cls._tasks.invalidate(task_id)
+        cls._catalog.invalidate()
+
+    @classmethod
+    def _forget_responses(cls, route: str) -> None:
+        if route is None:
+            cls._responses.clear()
+        else:
+            cls._responses.invalidate_matching(lambda key: key[0] == route)
+
     @property
     def instance(self):
         """
@@ -94,11 +249,45 @@ class BaseSliceOfLifeApiResponse():
         """
         return self._shared_space_index()
 
+    @property
+    def images(self):
+        """
+            returns a reference to the api's shared image pipeline, creates it if it does not exist
+            :returns: shared image pipeline
+            :rtype: ImagePipeline
+        """
+        return self._shared_image_pipeline()
+
     @classmethod
     def _shared_instance(cls):
         if not cls._instance:
+            writes, reads = cls._split_connections(
+                int(os.getenv('DBCONNECTIONS', str(DBCONNECTIONS))),
+                os.getenv('DBREADCONNECTIONS')
+            )
+            limits = PoolLimits(
+                max_size=writes,
+                min_size=min(int(os.getenv('DBMINCONNECTIONS', str(DBMINCONNECTIONS))), writes),
+                acquire_timeout=float(os.getenv('DBACQUIRETIMEOUT', str(DBACQUIRETIMEOUT))),
+                idle_timeout=float(os.getenv('DBIDLETIMEOUT', str(DBIDLETIMEOUT))),
+                max_age=float(os.getenv('DBMAXCONNAGE', str(DBMAXCONNAGE))),
+                check_after=float(os.getenv('DBCHECKAFTER', str(DBCHECKAFTER)))
+            )
             cls. _instance = Instance(
-                DBCONNECTIONS,
+                limits,
+                read_pool_limits=replace(limits, max_size=reads,
+                                         min_size=min(limits.min_size, reads)),
+                statement_cache_size=int(os.getenv('DBSTATEMENTCACHE', str(DBSTATEMENTCACHE))),
+                replication=Replication(
+                    replicas=cls._replica_settings(os.getenv('DBREPLICAS', '')),
+                    policy=os.getenv('DBROUTING', DBROUTING),
+                    sticky_window=float(os.getenv('DBSTICKYWINDOW', str(DBSTICKYWINDOW))),
+                    # with SHAREDCACHEDIR set, a write is seen by every worker on the machine
+                    recent_writes=region_cache(
+                        'writes', int(os.getenv('DBSTICKYWRITERS', str(DBSTICKYWRITERS))),
+                        slot_size=256
+                    )
+                ),
                 **{
                     'dbname': os.getenv('DBNAME'),
                     'user': os.getenv('DBUSER'),
@@ -109,6 +298,23 @@ class BaseSliceOfLifeApiResponse():
             )
         return cls._instance
 
+    @staticmethod
+    def _split_connections(budget: int, reads: str = None) -> tuple:
+        # reads take half the budget unless told otherwise, and both pools keep at least one
+        reads = budget // 2 if not reads else int(reads)
+        if not 0 < reads < budget:
+            raise ValueError(f"Cannot give {reads} of {budget} connections to reads")
+        return budget - reads, reads
+
+    @staticmethod
+    def _replica_settings(replicas: str) -> list:
+        # replicas are listed as host:port pairs separated by commas
+        settings = []
+        for replica in filter(None, (r.strip() for r in replicas.split(','))):
+            host, _, port = replica.partition(':')
+            settings.append({'host': host, 'port': port} if port else {'host': host})
+        return settings
+
     @classmethod
     def _shared_space_index(cls):
         if not cls._space:
@@ -117,6 +323,110 @@ class BaseSliceOfLifeApiResponse():
                 cls._space.create_session()
         return cls._space
 
+    @classmethod
+    def _shared_image_pipeline(cls):
+        if not cls._images:
+            cls._images = ImagePipeline(
+                cls._shared_space_index(),
+                workers=int(os.getenv('IMAGEWORKERS', str(IMAGEWORKERS)))
+            )
+        return cls._images
+
+    @staticmethod
+    def cached_response(route: str, ttl: float, query: str) -> callable:
+        """
+            A decorator that reuses the JSON body of an API callback's response for `ttl`
+            seconds. Responses are cached by route, path arguments and the query arguments
+            returned by the `query` method, which parses and bounds the arguments the route
+            reads, so other arguments cannot fill the cache. Only use it on routes whose
+            responses are the same for every viewer. A viewer who just wrote gets responses
+            cached for them alone, so they see their write. Responses are also kept apart
+            by share link epoch, so none outlives the epoch it was built in. Errors are never
+            cached, so apply it beneath safe_api_callback
+            :arg route: the name to cache the route's responses under
+            :arg ttl: seconds a response may be reused for
+            :arg query: name of the method that returns the route's normalized query arguments
+            :returns: a decorator for the API callback
+            :rtype: callable
+        """
+        def decorator(method: callable) -> callable:
+            def wrapper(ref, *args):
+                key = (route, args, getattr(ref, query)(), g.get('content_version'),
+                       BaseSliceOfLifeApiResponse._share_epoch(), ref.recent_writer())
+                body = BaseSliceOfLifeApiResponse._responses.get(key)
+                if body is None:
+                    body = jsonify(method(ref, *args)).get_data()
+                    BaseSliceOfLifeApiResponse._responses.put(key, body, ttl)
+                return Response(body, 200, mimetype='application/json')
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def coalesced_response(route: str) -> callable:
+        """
+            A decorator that lets concurrent calls to an API callback with the same route,
+            path arguments and query arguments share a single run and its result, instead
+            of each borrowing a connection and making the same queries. Only use it on
+            routes whose responses are the same for every viewer. A viewer who just wrote
+            only shares runs with their own requests, since other viewers' runs may read
+            from a replica that lacks the write. Apply it beneath cached_response, so each
+            request still builds its own response
+            :arg route: the name of the route
+            :returns: a decorator for the API callback
+            :rtype: callable
+        """
+        def decorator(method: callable) -> callable:
+            def wrapper(ref, *args):
+                key = (route, args, tuple(sorted(request.args.items(multi=True))),
+                       ref.recent_writer())
+                return BaseSliceOfLifeApiResponse._flights.do(key, lambda: method(ref, *args))
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def conditional_response(route: str, version: str) -> callable:
+        """
+            A decorator that gives an API callback's response a strong ETag, and answers
+            requests that already hold it with 304 Not Modified before the callback runs.
+            The tag is built from the route, its arguments and a version token returned by
+            the `version` method, which must be cheap and change whenever the response would.
+            Responses carry share links, so the tag also changes with the share link epoch.
+            A response is only served, from cached_response or with a 304, in the epoch it
+            was built in, so its links are still valid for half of `SPACES_SHARE_MARGIN`.
+            Apply it beneath safe_api_callback and above cached_response
+            :arg route: the name of the route
+            :arg version: name of the method called with the callback's arguments to get
+                          the version token
+            :returns: a decorator for the API callback
+            :rtype: callable
+        """
+        def decorator(method: callable) -> callable:
+            def wrapper(ref, *args):
+                g.content_version = getattr(ref, version)(*args)
+                etag = BaseSliceOfLifeApiResponse._entity_tag(route, args, g.content_version)
+                if request.if_none_match.contains_weak(etag):
+                    response = make_response("", 304)
+                else:
+                    response = method(ref, *args)
+                    if not isinstance(response, Response):
+                        response = make_response(jsonify(response), 200)
+                response.set_etag(etag)
+                return response
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _entity_tag(route: str, args: tuple, version) -> str:
+        tagged = (route, args, sorted(request.args.items(multi=True)), version,
+                  BaseSliceOfLifeApiResponse._share_epoch())
+        return hashlib.sha256(repr(tagged).encode()).hexdigest()[:32]
+
+    @staticmethod
+    def _share_epoch() -> int:
+        # share links are reused until SPACES_SHARE_MARGIN seconds are left, and an epoch
+        # is half that, so links in a response built this epoch outlive it by half a margin
+        return int(time.time() // (SpaceIndex.SPACES_SHARE_MARGIN / 2))
+
     @staticmethod
     def safe_api_callback(method: callable) -> callable:
         """
@@ -128,26 +438,36 @@ class BaseSliceOfLifeApiResponse():
         def wrapper(ref, *args):
             try:
                 LOGGER.info("Request from %s", str(request.headers.get('Origin')))
-                response = make_response(jsonify(method(ref, *args)), 200)
-                return response
+                response = method(ref, *args)
+                if not isinstance(response, Response):
+                    response = make_response(jsonify(response), 200)
             except ContentNotFoundError as exc:
                 LOGGER.error("Requested content does not exist")
                 LOGGER.error("Error occurred during execution: %s", str(exc))
-                return make_response("Not found", 404)
+                response = make_response("Not found", 404)
             except AuthorizationError as exc:
                 LOGGER.error("Insufficient permissions")
                 LOGGER.error("Error occurred during execution: %s", str(exc))
-                return make_response("Not authorized", 401)
+                response = make_response("Not authorized", 401)
+            except UploadTooLargeError as exc:
+                LOGGER.error("The request was too large")
+                LOGGER.error("Error occurred during execution: %s", str(exc))
+                response = make_response("Payload too large", 413)
+            except UnsupportedMediaError as exc:
+                LOGGER.error("The request carried an unsupported file")
+                LOGGER.error("Error occurred during execution: %s", str(exc))
+                response = make_response("Unsupported media type", 415)
             except ServiceNotReachable as exc:
                 LOGGER.error("The requested resource timed out")
                 LOGGER.error("Error occurred during execution: %s", str(exc))
-                return make_response("Bad gateway", 504)
+                response = make_response("Bad gateway", 504)
             except (KeyError, IndexError) as exc:
                 LOGGER.error("The request could not be understood")
                 LOGGER.error("Error occurred during execution: %s", str(exc))
-                return make_response("Bad request", 400)
+                response = make_response("Bad request", 400)
             except SliceOfLifeAPIException as exc:
                 LOGGER.error("Error occurred during execution: %s", str(exc))
-                return make_response("Internal server error", 500)
+                response = make_response("Internal server error", 500)
+            return response
 
         return wrapper
@@ -4,21 +4,28 @@
     :module_author: Nathan Mendoza (nathancm@uci.edu)
 """
 
+import base64
 import logging
 import os
+import secrets
+from dataclasses import fields, replace
+from datetime import datetime
 
-from flask import request
+from flask import request, send_file
 from dotenv import load_dotenv
 
-from . import BaseSliceOfLifeApiResponse
+from . import BaseSliceOfLifeApiResponse, LATESTCACHETTL, SLICECACHETTL, MAXPAGESIZE
 
 from ..dbtools import Instance
-from ..dbtools.queries import paginated_posts, specific_user, \
+from ..dbtools.queries import paginated_posts, keyset_posts, latest_post_version, \
+                              specific_user, \
                               specific_task, specific_post, \
-                              top_level_comments, comments_responding_to, \
-                              reactions_by_group, reaction_counts, reactors_by_emoji, \
-                              available_tasks, completed_tasks
-from ..dbtools.schema import interpret_as, Post, User, Task, Comment, Reaction
+                              users_by_handles, tasks_by_ids, \
+                              comment_forest, \
+                              reaction_summary, \
+                              all_tasks, completed_task_ids
+from ..dbtools.schema import interpret_as, Post, User, Task, Comment
+from ..toolkit import closest_width
 
 from ..exceptions import ContentNotFoundError, AuthorizationError
 
@@ -31,6 +38,12 @@ class SliceOfLifeApiGetResponse(BaseSliceOfLifeApiResponse):
         A subclass of SliceOfLifeApiResponse for specifically responding to GET request
     """
     base_url = os.getenv('BASE_URL', 'http://127.0.0.1:8000')
+    stats_key = os.getenv('STATS_KEY')
+
+    def __init__(self):
+        super().__init__()
+        # records and links already looked up by this request, so each is fetched once
+        self._identities = {}
 
     @BaseSliceOfLifeApiResponse.safe_api_callback
     def hello(self) -> dict:
@@ -45,48 +58,85 @@ class SliceOfLifeApiGetResponse(BaseSliceOfLifeApiResponse):
         return response
 
     @BaseSliceOfLifeApiResponse.safe_api_callback
+    def get_service_stats(self) -> dict:
+        """
+            A GET route that reports operational statistics for this worker. The statistics
+            describe the service's internals, so they are only served when STATS_KEY is set,
+            to requests that carry it in the x-stats-key header
+            :returns: statistics for the connection pools and the share link cache
+            :rtype: dict
+            :throws: ContentNotFoundError if statistics are not enabled
+            :throws: AuthorizationError if the request does not carry the stats key
+        """
+        if not self.stats_key:
+            raise ContentNotFoundError("Service statistics are not enabled")
+        if not secrets.compare_digest(request.headers.get('x-stats-key', ''), self.stats_key):
+            raise AuthorizationError("Missing or incorrect stats key in request headers")
+        return {
+            'database': self.instance.stats(),
+            'database_read_only': self.instance.stats(read_only=True),
+            'database_replicas': self.instance.replica_stats(),
+            'share_links': self.spaces.share_link_stats(),
+            'profiles': self._profiles.stats(),
+            'tasks': self._tasks.stats(),
+            'task_catalog': self._catalog.stats(),
+            'responses': self._responses.stats(),
+            'coalesced': self._flights.stats()
+        }
+
+    @BaseSliceOfLifeApiResponse.safe_api_callback
+    @BaseSliceOfLifeApiResponse.conditional_response('latest', '_feed_version')
+    @BaseSliceOfLifeApiResponse.cached_response(
+        'latest', float(os.getenv('LATESTCACHETTL', str(LATESTCACHETTL))), '_feed_arguments'
+    )
     def get_latest_posts(self) -> dict:
         """
             A GET route that returns the most recently posted slices of life. Pages results
+            by offset, or by an opaque cursor if the `cursor` query argument is given
+            (an empty cursor starts from the first page). Pages hold at most MAXPAGESIZE
+            posts. A `size` query argument asks for images scaled to about that many pixels wide
             :returns: a JSON object of posts and their associated information
             :rtype: dict
         """
-        limit = int(request.args.get('limit', 20))
-        offset = int(request.args.get('offset', 0))
-        with self.instance.start_transaction() as self._conn:
+        limit, offset, cursor, _ = self._feed_arguments()
+        if cursor is not None:
+            return self._get_latest_posts_after(limit, cursor)
+        with self._read_transaction() as self._conn:
             results = Instance.query(self._conn, paginated_posts(limit, offset))
-            results = [interpret_as(Post, r) for r in results]
-            for res in results:
-                if not isinstance(res.posted_by, User):
-                    res.posted_by = self._get_basic_post_author_info(res.posted_by)
-                if not isinstance(res.completes, Task):
-                    res.completes = self._get_task_info(res.completes)
-                res.image = self.spaces.get_share_link(res.image)
+            results = self._hydrate_posts([interpret_as(Post, r) for r in results])
             return {
                 "page": results,
                 "next":
                 f"{self.base_url}/api/v1/slices/latest?limit={limit}&offset={offset + len(results)}"
+                + self._size_query()
             }
 
     @BaseSliceOfLifeApiResponse.safe_api_callback
+    @BaseSliceOfLifeApiResponse.conditional_response('slice', '_slice_version')
+    @BaseSliceOfLifeApiResponse.cached_response(
+        'slice', float(os.getenv('SLICECACHETTL', str(SLICECACHETTL))), '_slice_arguments'
+    )
+    @BaseSliceOfLifeApiResponse.coalesced_response('slice')
     def get_slice_by_id(self, slice_id: int) -> Post:
         """
-            A GET method that returns the slice corresponding to the given ID, if it exists
+            A GET method that returns the slice corresponding to the given ID, if it exists.
+            A `size` query argument asks for an image scaled to about that many pixels wide
             :arg slice_id: The ID post to retrieve
             :returns: the corresponding post, it it exists
             :rtype: Post
             :throws SliceOfLifeAPIException: when result size is not expected (1 excactly)
         """
-        with self.instance.start_transaction() as self._conn:
+        with self._read_transaction() as self._conn:
             pinfo = self._get_post_information(slice_id)
             if not isinstance(pinfo.posted_by, User):
                 pinfo.posted_by = self._get_basic_post_author_info(pinfo.posted_by)
             if not isinstance(pinfo.completes, Task):
                 pinfo.completes = self._get_task_info(pinfo.completes)
-            pinfo.image = self.spaces.get_share_link(pinfo.image)
+            pinfo.image = self._share_post_image(pinfo.image)
             return pinfo
 
     @BaseSliceOfLifeApiResponse.safe_api_callback
+    @BaseSliceOfLifeApiResponse.coalesced_response('comments')
     def get_comments_for_slice(self, slice_id: int) -> dict:
         """
             A Get method that return the comments associated with a given post id, if it exists
@@ -95,28 +145,38 @@ class SliceOfLifeApiGetResponse(BaseSliceOfLifeApiResponse):
             :rtype: dict
             :throws: SliceOfLifeAPIException: the post ID invalid
         """
-        with self.instance.start_transaction() as self._conn:
+        with self._read_transaction() as self._conn:
             pinfo = self._get_post_information(slice_id)
 
             return self._build_comment_tree_for_slice(pinfo.post_id)
 
     @BaseSliceOfLifeApiResponse.safe_api_callback
+    @BaseSliceOfLifeApiResponse.coalesced_response('reactions')
     def get_reactions_for_slice(self, slice_id: int) -> list:
         """
             A get method that returns the information on the reactions for a given post
             :arg slice_id: the slice id to get reactions for
-            :returns: a list of each reaction and the number of times it occurs
+            :returns: a list of each reaction, the number of times it occurs and who used it
             :rtype list:
             :throws SliceOfLifeAPIException: if the slice does not exist
         """
-        with self.instance.start_transaction() as self._conn:
+        reactor_limit = request.args.get('max_reactors')
+        try:
+            reactor_limit = int(reactor_limit) if reactor_limit is not None else None
+        except ValueError as exc:
+            raise KeyError(f"Malformed reactor limit {reactor_limit}") from exc
+        with self._read_transaction() as self._conn:
             self._get_post_information(slice_id) # test for existing slice id
             return [
                 {
-                    "reaction": r.emoji_code,
-                    "count": self._reaction_occurences(r.emoji_code, slice_id),
-                    "reactors": self._reactors_for_slice(r.emoji_code, slice_id)
-                } for r in self._reactions_for_slice(slice_id)
+                    "reaction": emoji_code,
+                    "count": count,
+                    "total_reactors": total_reactors,
+                    "reactors": list(reactors)
+                } for emoji_code, count, total_reactors, reactors in Instance.query(
+                    self._conn,
+                    reaction_summary(slice_id, reactor_limit)
+                )
             ]
 
     @BaseSliceOfLifeApiResponse.safe_api_callback
@@ -127,7 +187,7 @@ class SliceOfLifeApiGetResponse(BaseSliceOfLifeApiResponse):
             :returns: basic user information
             :rtype: User
         """
-        with self.instance.start_transaction() as self._conn:
+        with self._read_transaction() as self._conn:
             if self.verify_auth_token(handle):
                 return self._get_basic_post_author_info(handle)
             raise AuthorizationError("Log in to view profile")
@@ -140,14 +200,97 @@ class SliceOfLifeApiGetResponse(BaseSliceOfLifeApiResponse):
             :returns: task information
             :rtype: dict
         """
-        with self.instance.start_transaction() as self._conn:
+        with self._read_transaction() as self._conn:
             if self.verify_auth_token(handle):
+                completed, available = self._catalog.partition(
+                    self._load_task_catalog,
+                    self._get_users_completed_task_ids(handle)
+                )
                 return {
-                    "completed": self._get_users_completed_tasks(handle),
-                    "available": self._get_users_available_tasks(handle)
+                    "completed": [replace(t) for t in completed],
+                    "available": [replace(t) for t in available]
                 }
             raise AuthorizationError("Log in to view task list")
 
+    @BaseSliceOfLifeApiResponse.safe_api_callback
+    def get_stored_file(self, key: str):
+        """
+            A GET method that serves a file kept in local storage, given a signed link to it.
+            Range requests and conditional requests are answered from the file's size and
+            modification time, and the body is sent straight from disk
+            :arg key: the file to serve
+            :returns: the file
+            :rtype: flask.Response
+            :throws: AuthorizationError if the link is not valid
+            :throws: ContentNotFoundError if there is no such file
+        """
+        storage = self.spaces.local_storage()
+        storage.verify('GET', key, request.args)
+        path = storage.path_for(key)
+        if not path.is_file():
+            raise ContentNotFoundError(f"{key} is not a stored file")
+        return send_file(path, conditional=True, max_age=self.spaces.SPACES_SHARE_TIME)
+
+    def _read_transaction(self):
+        # reads go to a replica, unless the reader has just written something of their own.
+        # a new transaction may see newer rows, so it starts with an empty identity map
+        self._identities = {}
+        return self.instance.start_transaction(
+            read_only=True,
+            consistent_for=self.authenticated_handle()
+        )
+
+    def _feed_version(self) -> int:
+        # a feed page only changes when a post is made, or its links are renewed
+        with self._read_transaction() as self._conn:
+            return Instance.query(self._conn, latest_post_version())[0][0]
+
+    def _slice_version(self, slice_id: int) -> str:
+        # posts are never edited, so only the derivative a size hint picks can change one.
+        # the share link epoch is added to the tag by conditional_response
+        size_hint = self._size_hint()
+        image = self._post_image(slice_id) if size_hint is not None else None
+        if image is None:
+            return str(slice_id)
+        return f"{slice_id}:{self.images.variant_for(image, size_hint)}"
+
+    def _post_image(self, slice_id: int) -> str:
+        image = self._post_images.get(slice_id)
+        if image is None:
+            with self._read_transaction() as self._conn:
+                result = Instance.query(self._conn, specific_post(slice_id))
+            if len(result) != 1:
+                return None # the slice itself answers with a 404
+            image = interpret_as(Post, result[0]).image
+            self._post_images.put(slice_id, image)
+        return image
+
+    def _get_latest_posts_after(self, limit: int, cursor: str) -> dict:
+        after = self._decode_cursor(cursor) if cursor else None
+        with self._read_transaction() as self._conn:
+            results = Instance.query(self._conn, keyset_posts(limit, after))
+            results = self._hydrate_posts([interpret_as(Post, r) for r in results])
+            next_cursor = self._encode_cursor(results[-1]) if results else cursor
+            return {
+                "page": results,
+                "next": f"{self.base_url}/api/v1/slices/latest?limit={limit}&cursor={next_cursor}"
+                        + self._size_query()
+            }
+
+    @staticmethod
+    def _encode_cursor(last_post: Post) -> str:
+        key = f"{last_post.created_at.isoformat()}|{last_post.post_id}"
+        return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> tuple:
+        try:
+            key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+            created_at, post_id = key.split('|')
+            return datetime.fromisoformat(created_at), int(post_id)
+        except ValueError as exc:
+            raise KeyError(f"Malformed page cursor {cursor}") from exc
+
     def _get_post_information(self, post_id: int) -> Post:
         result = Instance.query(self._conn, specific_post(post_id))
         if len(result) != 1:
@@ -157,89 +300,169 @@ class SliceOfLifeApiGetResponse(BaseSliceOfLifeApiResponse):
 
 
     def _get_basic_post_author_info(self, author_handle: str) -> User:
-        uinfo = interpret_as(
-            User,
-            Instance.query(self._conn, specific_user(author_handle))[0]
-        ) #should only be one anyway
-        # hide sensitive information
+        if ('user', author_handle) not in self._identities:
+            uinfo = self._profiles.get(author_handle)
+            if uinfo is None:
+                uinfo = self._remember_user(interpret_as(
+                    User,
+                    Instance.query(self._conn, specific_user(author_handle))[0]
+                )) #should only be one anyway
+            self._identities[('user', author_handle)] = self._mask_user(uinfo)
+        return self._identities[('user', author_handle)]
+
+    def _get_basic_authors_info(self, author_handles: set) -> dict:
+        missing = set()
+        for handle in author_handles:
+            if ('user', handle) in self._identities:
+                continue
+            uinfo = self._profiles.get(handle)
+            if uinfo is None:
+                missing.add(handle)
+            else:
+                self._identities[('user', handle)] = self._mask_user(uinfo)
+        if missing:
+            for row in Instance.query(self._conn, users_by_handles(sorted(missing))):
+                uinfo = self._remember_user(interpret_as(User, row))
+                self._identities[('user', uinfo.handle)] = self._mask_user(uinfo)
+        return {handle: self._identities[('user', handle)] for handle in author_handles}
+
+    def _remember_user(self, uinfo: User) -> User:
+        # hide sensitive information before the profile is shared with other requests
         uinfo.password_hash = "***"
         uinfo.salt = "***"
         uinfo.email = "***"
-        # get profile pic
-        uinfo.profile_pic = self.spaces.get_share_link(uinfo.profile_pic)
+        self._profiles.put(uinfo.handle, uinfo)
         return uinfo
 
+    def _mask_user(self, uinfo: User) -> User:
+        # each response gets its own copy with a link to the profile pic.
+        # avatars rarely change so their links can last longer
+        return replace(uinfo, profile_pic=self._share_link(
+            uinfo.profile_pic,
+            self.spaces.SPACES_AVATAR_SHARE_TIME
+        ))
+
     def _get_task_info(self, task_id: int) -> Task:
-        tinfo = interpret_as(
-            Task,
-            Instance.query(self._conn, specific_task(task_id))[0]
-        ) #should only be one anyway
-        return tinfo
+        if ('task', task_id) not in self._identities:
+            tinfo = self._tasks.get(task_id)
+            if tinfo is None:
+                tinfo = interpret_as(
+                    Task,
+                    Instance.query(self._conn, specific_task(task_id))[0]
+                ) #should only be one anyway
+                self._tasks.put(task_id, tinfo)
+            self._identities[('task', task_id)] = replace(tinfo)
+        return self._identities[('task', task_id)]
 
-    def _build_comment_tree_for_slice(self, slice_id: int) -> dict:
-        tree = {"threads": self._orphaned_comments(slice_id)}
-        for thread in tree["threads"]:
-            self._get_responses(thread, slice_id)
-        return tree
+    def _get_tasks_info(self, task_ids: set) -> dict:
+        missing = set()
+        for task_id in task_ids:
+            if ('task', task_id) in self._identities:
+                continue
+            tinfo = self._tasks.get(task_id)
+            if tinfo is None:
+                missing.add(task_id)
+            else:
+                self._identities[('task', task_id)] = replace(tinfo)
+        if missing:
+            for row in Instance.query(self._conn, tasks_by_ids(sorted(missing))):
+                tinfo = interpret_as(Task, row)
+                self._tasks.put(tinfo.task_id, tinfo)
+                self._identities[('task', tinfo.task_id)] = replace(tinfo)
+        return {task_id: self._identities[('task', task_id)] for task_id in task_ids}
 
-    def _orphaned_comments(self, slice_id: int) -> list:
-        return [
-                {
-                    "comment": self._comment_with_author(c),
-                    "responses": []
-                } for c in Instance.query(self._conn, top_level_comments(slice_id))
-        ]
-
-    def _non_orphaned_comments(self, slice_id: int, parent_comment_id: int) -> list:
-        return [
-            {
-                "comment": self._comment_with_author(c),
-                "responses": []
-            } for c in Instance.query(self._conn, comments_responding_to(
-                                                        slice_id,
-                                                        parent_comment_id
-                                                    )
-                                    )
-        ]
-
-    def _get_responses(self, thread, slice_id) -> None:
-        thread['responses'].extend(
-            self._non_orphaned_comments(slice_id, thread["comment"].comment_id)
-        )
-        for subthread in thread['responses']:
-            self._get_responses(subthread, slice_id)
-
-    def _comment_with_author(self, comment_data) -> dict:
-        comment_instance = interpret_as(Comment, comment_data)
-        comment_instance.comment_by = self._get_basic_post_author_info(comment_instance.comment_by)
-        return comment_instance
-
-    def _reactions_for_slice(self, slice_id: int) -> [Reaction]:
-        return [
-            interpret_as(Reaction, r)
-            for r in Instance.query(
-                self._conn,
-                reactions_by_group(slice_id)
+    def _share_link(self, key: str, share_time: int = None) -> str:
+        if ('link', key, share_time) not in self._identities:
+            self._identities[('link', key, share_time)] = self.spaces.get_share_link(
+                key,
+                share_time=share_time
             )
-        ]
+        return self._identities[('link', key, share_time)]
 
-    def _reaction_occurences(self, emoji_used: str, post_id: int) -> int:
-        return Instance.query(self._conn, reaction_counts(emoji_used, post_id))[0][0]
+    def _share_post_image(self, image: str) -> str:
+        # clients that say how wide they show images get a smaller copy, once it is made
+        size_hint = self._size_hint()
+        if size_hint is not None:
+            image = self.images.variant_for(image, size_hint)
+        return self._share_link(image)
 
-    def _reactors_for_slice(self, emoji_used: str, post_id: int) -> [str]:
-        return [
-            reactor[0] for reactor in Instance.query(
-                self._conn,
-                reactors_by_emoji(emoji_used, post_id)
-            )
-        ]
+    @staticmethod
+    def _size_hint() -> int:
+        # hints are rounded to the derivative they choose, so equal choices share a cache entry
+        size_hint = request.args.get('size')
+        if size_hint is None:
+            return None
+        try:
+            return closest_width(int(size_hint))
+        except ValueError as exc:
+            raise KeyError(f"Malformed size hint {size_hint}") from exc
+
+    @classmethod
+    def _feed_arguments(cls) -> tuple:
+        # the page size, offset, cursor and size hint a feed page is built from
+        cursor = request.args.get('cursor')
+        limit = min(max(cls._integer_argument('limit', 20), 1), MAXPAGESIZE)
+        offset = max(cls._integer_argument('offset', 0), 0) if cursor is None else None
+        return limit, offset, cursor, cls._size_hint()
+
+    @classmethod
+    def _slice_arguments(cls) -> tuple:
+        return (cls._size_hint(),)
+
+    @staticmethod
+    def _integer_argument(name: str, default: int) -> int:
+        value = request.args.get(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError as exc:
+            raise KeyError(f"Malformed {name} {value}") from exc
+
+    def _size_query(self) -> str:
+        # carry the size hint over to the next page
+        size_hint = self._size_hint()
+        return f"&size={size_hint}" if size_hint is not None else ""
+
+    def _hydrate_posts(self, posts: [Post]) -> [Post]:
+        # one lookup per table for the whole page, stitched together in memory
+        authors = self._get_basic_authors_info(
+            {p.posted_by for p in posts if not isinstance(p.posted_by, User)}
+        )
+        tasks = self._get_tasks_info(
+            {p.completes for p in posts if not isinstance(p.completes, Task)}
+        )
+        for post in posts:
+            if not isinstance(post.posted_by, User):
+                post.posted_by = authors[post.posted_by]
+            if not isinstance(post.completes, Task):
+                post.completes = tasks[post.completes]
+            post.image = self._share_post_image(post.image)
+        return posts
+
+    def _build_comment_tree_for_slice(self, slice_id: int) -> dict:
+        # rows arrive parents-first, so every response can be attached as it is read
+        tree = {"threads": []}
+        threads_by_id = {}
+        comment_width = len(fields(Comment))
+        for row in Instance.query(self._conn, comment_forest(slice_id)):
+            comment = interpret_as(Comment, row[:comment_width])
+            if ('user', comment.comment_by) not in self._identities:
+                self._identities[('user', comment.comment_by)] = self._mask_user(
+                    self._remember_user(interpret_as(User, row[comment_width:]))
+                )
+            comment.comment_by = self._identities[('user', comment.comment_by)]
+            thread = {"comment": comment, "responses": []}
+            threads_by_id[comment.comment_id] = thread
+            if comment.parent is None:
+                tree["threads"].append(thread)
+            else:
+                threads_by_id[comment.parent]["responses"].append(thread)
+        return tree
 
-    def _get_users_available_tasks(self, user_handle: str) -> [Task]:
-        return [
-            interpret_as(Task, t) for t in Instance.query(self._conn, available_tasks(user_handle))
-        ]
+    def _load_task_catalog(self) -> [Task]:
+        return [interpret_as(Task, t) for t in Instance.query(self._conn, all_tasks())]
 
-    def _get_users_completed_tasks(self, user_handle) -> [Task]:
-        return [
-            interpret_as(Task, t) for t in Instance.query(self._conn, completed_tasks(user_handle))
-        ]
+    def _get_users_completed_task_ids(self, user_handle: str) -> list:
+        # a single row holding every id as one array
+        return Instance.query(self._conn, completed_task_ids(user_handle))[0][0]
@@ -5,7 +5,6 @@
 """
 
 import logging
-import pathlib
 import hashlib
 import secrets
 import datetime
@@ -13,10 +12,13 @@ import datetime
 from flask import request
 
 from . import BaseSliceOfLifeApiResponse
-from ..exceptions import AuthorizationError
+from ..exceptions import AuthorizationError, ContentNotFoundError, \
+                         UploadTooLargeError, UnsupportedMediaError
+from ..toolkit import sniff_image_type, sniff_upload_type, guess_image_type, \
+                     IMAGE_TYPES, SIGNATURE_LENGTH
 from ..dbtools import Instance
-from ..dbtools.queries import specific_user, insert_user_account, \
-                              insert_post, insert_completion
+from ..dbtools.queries import specific_user, insert_user_account, insert_post, \
+                              insert_completion, completed_task_ids, lock_image, image_references
 from ..dbtools.schema import interpret_as, User, Post, Completion
 
 LOGGER = logging.getLogger('gunicorn.error')
@@ -38,11 +40,13 @@ class SliceOfLifeApiPostResponse(BaseSliceOfLifeApiResponse):
             'first_name': request.form['first_name'],
             'last_name': request.form['last_name'],
         }
-        with self.instance.start_transaction() as self._conn:
-            if self._handle_is_available(form_data['handle']):
-                self._make_user_account(form_data)
-                return f"CREATED {form_data['handle']}"
-            raise AuthorizationError(f"{form_data['handle']} is not available")
+        with self.instance.start_transaction(consistent_for=form_data['handle']) as self._conn:
+            if not self._handle_is_available(form_data['handle']):
+                raise AuthorizationError(f"{form_data['handle']} is not available")
+            self._make_user_account(form_data)
+            self.announce_change('profiles', form_data['handle'])
+        self.forget_user(form_data['handle'])
+        return f"CREATED {form_data['handle']}"
 
     @BaseSliceOfLifeApiResponse.safe_api_callback
     def authenticate_user(self) -> dict:
@@ -75,18 +79,154 @@ class SliceOfLifeApiPostResponse(BaseSliceOfLifeApiResponse):
             Create a new post. On success, return the message "CREATED"
             :returns: success message
             :rtype: str
+            :throws: UploadTooLargeError if the request is larger than allowed
+            :throws: UnsupportedMediaError if the slice image is not a supported image
         """
+        # refuse oversized uploads before any of the body is read. Files that are not
+        # images are refused while the form is parsed, as soon as their first bytes arrive
+        if request.content_length is not None \
+                and request.content_length > self.max_upload_bytes:
+            raise UploadTooLargeError(
+                f"Upload of {request.content_length} bytes exceeds {self.max_upload_bytes}"
+            )
         post_data = {
             'author': request.form['handle'],
             'slice_image': request.files['slice_image'],
             'free_text': request.form['free_text'],
             'task_id': request.form['task_id']
         }
-        with self.instance.start_transaction() as self._conn:
-            if self.verify_auth_token(post_data['author']):
-                self._insert_post_record(post_data)
-                return "CREATED"
+        post_data['content_type'] = sniff_upload_type(post_data['slice_image'].stream)
+        if post_data['content_type'] is None:
+            raise UnsupportedMediaError(f"{post_data['slice_image'].filename} is not an image")
+        image = None
+        try:
+            with self.instance.start_transaction(consistent_for=post_data['author']) \
+                    as self._conn:
+                if not self.verify_auth_token(post_data['author']):
+                    raise AuthorizationError(
+                        f"{post_data['author']} is not authorized to make a post"
+                    )
+                image, uploaded = self._save_post_data(post_data)
+                self._insert_post_record(post_data, image)
+                self.announce_change('responses', 'latest')
+        except Exception:
+            if image is not None:
+                self._release_unposted_image(image)
+            raise
+        if uploaded:
+            self.images.submit(image)
+        # the post is committed, other workers drop their feeds when the announcement arrives
+        self.forget_responses('latest')
+        return "CREATED"
+
+    @BaseSliceOfLifeApiResponse.safe_api_callback
+    def start_post_upload(self) -> dict:
+        """
+            Begin a new post by handing out a link the client can upload the post's image to
+            directly. Each upload is staged under a name of its own, and only becomes the
+            post's image once `finish_post_upload` has checked it. Staged uploads that are never
+            finished are left for the bucket's lifecycle rules to expire
+            :returns: the upload link, the content type to upload with and the image's key
+            :rtype: dict
+            :throws: AuthorizationError if the user already completed the task
+            :throws: UnsupportedMediaError if the file is not named like a supported image
+        """
+        upload_data = {
+            'author': request.form['handle'],
+            'task_id': request.form['task_id'],
+            'filename': request.form['filename']
+        }
+        if not self.verify_auth_token(upload_data['author']):
+            raise AuthorizationError(f"{upload_data['author']} is not authorized to make a post")
+        content_type = guess_image_type(upload_data['filename'])
+        if content_type is None:
+            raise UnsupportedMediaError(f"{upload_data['filename']} is not an image")
+        self._check_task_is_open(upload_data['author'], upload_data['task_id'])
+        image = self._staged_image_key(upload_data['author'], content_type)
+        return {
+            'upload_url': self.spaces.get_upload_link(image, content_type),
+            'content_type': content_type,
+            'image': image,
+            'expires_in': self.spaces.SPACES_UPLOAD_TIME
+        }
+
+    @BaseSliceOfLifeApiResponse.safe_api_callback
+    def finish_post_upload(self) -> str:
+        """
+            Create a new post from an image uploaded through `start_post_upload`. The image is
+            kept under its content addressed name, so identical images are stored once no
+            matter how they were posted. On success, return the message "CREATED"
+            :returns: success message
+            :rtype: str
+            :throws: AuthorizationError if the upload is not the user's, or the task is done
+            :throws: ContentNotFoundError if the image was never uploaded
+            :throws: UploadTooLargeError if the uploaded image is larger than allowed
+            :throws: UnsupportedMediaError if the uploaded file is not a supported image
+        """
+        post_data = {
+            'author': request.form['handle'],
+            'image': request.form['image'],
+            'free_text': request.form['free_text'],
+            'task_id': request.form['task_id']
+        }
+        if not self.verify_auth_token(post_data['author']):
             raise AuthorizationError(f"{post_data['author']} is not authorized to make a post")
+        if not self._is_staged_for(post_data['author'], post_data['image']):
+            raise AuthorizationError(f"{post_data['image']} does not belong to this post")
+        self._check_task_is_open(post_data['author'], post_data['task_id'])
+        content_type = self._check_uploaded_image(post_data['image'])
+        # stored under the same content addressed name as images posted through the API
+        image = self.spaces.stored_content_key(post_data['image'], content_type)
+        try:
+            with self.instance.start_transaction(consistent_for=post_data['author']) \
+                    as self._conn:
+                uploaded = self._keep_uploaded_image(post_data['image'], image)
+                self._insert_post_record(post_data, image)
+                self.announce_change('responses', 'latest')
+        except Exception:
+            # the staged upload is kept, so finishing can be retried without uploading again
+            self._release_unposted_image(image)
+            raise
+        self.spaces.delete_file(post_data['image'])
+        if uploaded:
+            self.images.submit(image)
+        # the post is committed, other workers drop their feeds when the announcement arrives
+        self.forget_responses('latest')
+        return "CREATED"
+
+    def _check_uploaded_image(self, staged: str) -> str:
+        # the client uploaded straight to storage, so neither its size nor its contents
+        # have been checked yet. Rejected uploads are deleted
+        size = self.spaces.file_size(staged)
+        if size is None:
+            raise ContentNotFoundError(f"{staged} has not been uploaded")
+        if size > self.max_upload_bytes:
+            self.spaces.delete_file(staged)
+            raise UploadTooLargeError(f"Upload of {size} bytes exceeds {self.max_upload_bytes}")
+        content_type = None
+        if size >= SIGNATURE_LENGTH:
+            content_type = sniff_image_type(self.spaces.read_file_start(staged, SIGNATURE_LENGTH))
+        if content_type is None:
+            self.spaces.delete_file(staged)
+            raise UnsupportedMediaError(f"{staged} is not an image")
+        return content_type
+
+    def _keep_uploaded_image(self, staged: str, image: str) -> bool:
+        # hold the image until the post is committed, so it cannot be released meanwhile
+        Instance.query_no_fetch(self._conn, lock_image(image))
+        if self.spaces.file_exists(image):
+            LOGGER.info("Already have a copy of %s, skipping copy", image)
+            return False
+        self.spaces.copy_file(staged, image)
+        return True
+
+    def _check_task_is_open(self, author: str, task_id) -> None:
+        # a task is completed by a single post, whose image must never be replaced
+        with self.instance.start_transaction(read_only=True, consistent_for=author) \
+                as self._conn:
+            completed = Instance.query(self._conn, completed_task_ids(author))[0][0]
+        if str(task_id) in {str(task) for task in completed}:
+            raise AuthorizationError(f"{author} has already completed task {task_id}")
 
     def _handle_is_available(self, handle) -> bool:
         return not Instance.query(self._conn, specific_user(handle))
@@ -111,11 +251,11 @@ class SliceOfLifeApiPostResponse(BaseSliceOfLifeApiResponse):
             expected.password_hash
         )
 
-    def _insert_post_record(self, post_info) -> None:
+    def _insert_post_record(self, post_info, image: str) -> None:
         new_post = Post(
             post_id=None,
             free_text=post_info['free_text'],
-            image=self._save_post_data(post_info),
+            image=image,
             created_at=datetime.datetime.utcnow(),
             posted_by=post_info['author'],
             completes=post_info['task_id']
@@ -129,12 +269,50 @@ class SliceOfLifeApiPostResponse(BaseSliceOfLifeApiResponse):
         Instance.query_no_fetch(self._conn, insert_post(new_post))
         Instance.query_no_fetch(self._conn, insert_completion(new_completion))
 
-    def _save_post_data(self, post_data) -> str:
-        file_location = f"posts/{post_data['author']}" \
-                        + f"/task{post_data['task_id']}" \
-                        + f"{pathlib.Path(post_data['slice_image'].filename).suffix}"
-        self.spaces.save_file(
+    @staticmethod
+    def _staged_image_key(author: str, content_type: str) -> str:
+        return f"uploads/{author}/{secrets.token_urlsafe(16)}{IMAGE_TYPES[content_type]}"
+
+    @staticmethod
+    def _is_staged_for(author: str, image: str) -> bool:
+        folder = f"uploads/{author}/"
+        return image.startswith(folder) and '/' not in image[len(folder):]
+
+    def _save_post_data(self, post_data) -> tuple:
+        file_location = self.spaces.content_key(
+            post_data['slice_image'],
+            post_data['content_type']
+        )
+        # hold the image until the post is committed, so it cannot be released meanwhile
+        Instance.query_no_fetch(self._conn, lock_image(file_location))
+        uploaded = self.spaces.save_content(
             file_location,
-            post_data['slice_image']
+            post_data['slice_image'],
+            post_data['content_type']
         )
-        return file_location
+        return file_location, uploaded
+
+    def release_image(self, image: str) -> bool:
+        """
+            Delete a stored image, and its derivatives, if no post uses it anymore. Images are
+            shared between posts with identical uploads, so they must only be deleted once the
+            last post is gone
+            :arg image: the image's key
+            :returns: whether the image was deleted
+            :rtype: bool
+        """
+        with self.instance.start_transaction() as self._conn:
+            Instance.query_no_fetch(self._conn, lock_image(image))
+            if Instance.query(self._conn, image_references(image))[0][0]:
+                return False
+            self.spaces.delete_file(image)
+            self.images.remove_derivatives(image)
+            return True
+
+    def _release_unposted_image(self, image: str) -> None:
+        # the post that was to use the image was not made. Other posts may still use it,
+        # and a failure here must not hide the reason the post was not made
+        try:
+            self.release_image(image)
+        except Exception as exc: # pylint: disable=broad-except
+            LOGGER.error("Could not release %s: %s", image, str(exc))
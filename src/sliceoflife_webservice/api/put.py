@@ -0,0 +1,47 @@
+"""
+    :module_name: put
+    :module_summary: response class that define PUT endpoints for the slice of life API
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import logging
+
+from flask import request
+
+from . import BaseSliceOfLifeApiResponse
+from ..exceptions import UploadTooLargeError, UnsupportedMediaError
+from ..toolkit import sniff_stream_type
+
+LOGGER = logging.getLogger('gunicorn.error')
+
+class SliceOfLifeApiPutResponse(BaseSliceOfLifeApiResponse):
+    """
+        A subclass of BaseSliceOfLifeApiResponse for specifically responding to PUT requests
+    """
+
+    @BaseSliceOfLifeApiResponse.safe_api_callback
+    def put_stored_file(self, key: str) -> str:
+        """
+            Save an upload made with a signed link into local storage. On success, return
+            the message "CREATED"
+            :arg key: the name the upload is saved under
+            :returns: success message
+            :rtype: str
+            :throws: AuthorizationError if the link is not valid for this upload
+            :throws: UploadTooLargeError if the upload is larger than allowed
+            :throws: UnsupportedMediaError if the upload is not the image it was signed for
+        """
+        storage = self.spaces.local_storage()
+        storage.verify('PUT', key, request.args, request.content_type or '')
+        # refuse oversized uploads before any of the body is read. Uploads without a
+        # declared length are cut off once they read past the limit
+        if request.content_length is not None \
+                and request.content_length > self.max_upload_bytes:
+            raise UploadTooLargeError(
+                f"Upload of {request.content_length} bytes exceeds {self.max_upload_bytes}"
+            )
+        content_type, upload = sniff_stream_type(request.stream)
+        if content_type is None or content_type != request.mimetype:
+            raise UnsupportedMediaError(f"{key} is not a {request.mimetype} image")
+        storage.save(key, upload, content_type)
+        return "CREATED"
@@ -5,3 +5,6 @@
 """
 
 from .instance import Instance
+from .pool import PoolLimits
+from .routing import Replication
+from .bus import InvalidationBus, invalidation_message
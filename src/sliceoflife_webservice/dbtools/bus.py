@@ -0,0 +1,143 @@
+"""
+    :module_name: bus
+    :module_summary: tells every worker when data they may have cached has changed
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import json
+import logging
+import select
+import threading
+
+import psycopg2
+
+from ..exceptions import ServiceNotReachable
+
+LOGGER = logging.getLogger('gunicorn.error')
+
+def invalidation_message(region: str, key=None) -> str:
+    """
+        The payload of a notification that the given key of a cache region has changed
+        :arg region: the name of the cache region
+        :arg key: the key that changed, or None if anything in the region may have
+                  (defaults to None)
+        :returns: notification payload
+        :rtype: str
+    """
+    return json.dumps({'region': region, 'key': key})
+
+class InvalidationBus:
+    """
+        Listens on a Postgres notification channel on a background thread and fans each
+        invalidation message out to the handlers subscribed to its cache region. Handlers
+        are called with the key that changed, or None when every key in the region must be
+        forgotten. That happens whenever the bus (re)connects, since messages sent while it
+        was not listening are lost
+    """
+    POLL_TIMEOUT = 5.0
+    RETRY_MIN = 0.5
+    RETRY_MAX = 30.0
+
+    def __init__(self, listen: callable, channel: str):
+        self._listen = listen
+        self._channel = channel
+        self._handlers = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, region: str, handler: callable) -> None:
+        """
+            Call the handler for every invalidation message sent to a cache region
+            :arg region: the name of the cache region
+            :arg handler: called with the key that changed, or None for every key
+            :returns: nothing
+            :rtype: NoneType
+        """
+        self._handlers.setdefault(region, []).append(handler)
+
+    def start(self) -> None:
+        """
+            Start listening for invalidation messages, if the bus is not already
+            :returns: nothing
+            :rtype: NoneType
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='invalidation-bus', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """
+            Stop listening for invalidation messages and wait for the listener to finish
+            :arg timeout: seconds to wait for the listener (defaults to waiting until done)
+            :returns: nothing
+            :rtype: NoneType
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_listening(self) -> bool:
+        """
+            Returns true if the listener is running, otherwise false
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def dispatch(self, payload: str) -> None:
+        """
+            Hand an invalidation message to the handlers of its region
+            :arg payload: the notification's payload
+            :returns: nothing
+            :rtype: NoneType
+        """
+        try:
+            message = json.loads(payload)
+            region, key = message['region'], message.get('key')
+        except (ValueError, TypeError, KeyError):
+            LOGGER.warning("Ignoring malformed invalidation message %s", payload)
+            return
+        for handler in self._handlers.get(region, ()):
+            self._notify(handler, region, key)
+
+    def _forget_everything(self) -> None:
+        for region, handlers in self._handlers.items():
+            for handler in handlers:
+                self._notify(handler, region, None)
+
+    @staticmethod
+    def _notify(handler: callable, region: str, key) -> None:
+        # a failing handler must not keep the others, or later messages, from being handled
+        try:
+            handler(key)
+        except Exception: # pylint: disable=broad-except
+            LOGGER.exception("Invalidation handler for %s failed on key %s", region, key)
+
+    def _run(self) -> None:
+        retry = self.RETRY_MIN
+        while not self._stopped.is_set():
+            try:
+                conn = self._listen(self._channel)
+            except (ServiceNotReachable, psycopg2.Error) as exc:
+                LOGGER.error("Could not listen for invalidations: %s", str(exc))
+                self._stopped.wait(retry)
+                retry = min(retry * 2, self.RETRY_MAX)
+                continue
+            retry = self.RETRY_MIN
+            LOGGER.info("Listening for invalidations on %s", self._channel)
+            try:
+                self._forget_everything()
+                self._receive(conn)
+            except (psycopg2.Error, OSError) as exc:
+                LOGGER.error("Stopped receiving invalidations: %s", str(exc))
+            finally:
+                conn.close()
+
+    def _receive(self, conn: psycopg2.extensions.connection) -> None:
+        while not self._stopped.is_set():
+            readable, _, _ = select.select([conn], [], [], self.POLL_TIMEOUT)
+            if not readable:
+                continue
+            conn.poll()
+            while conn.notifies:
+                self.dispatch(conn.notifies.pop(0).payload)
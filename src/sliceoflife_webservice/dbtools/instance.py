@@ -5,61 +5,167 @@
 """
 
 import logging
-import threading
-from dataclasses import dataclass
+import re
+import weakref
+from collections import OrderedDict
 from contextlib import contextmanager
+from functools import partial
 
 import psycopg2
+from psycopg2 import errorcodes, sql
 from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
 
-from ..exceptions import SliceOfLifeAPIException, ServiceNotReachable
+from ..exceptions import ServiceNotReachable
 from .queries.statement import PreparedStatement
+from .pool import ConnectionPool, PoolLimits
+from .routing import Replication, ReadRouter
 
 LOGGER = logging.getLogger('gunicorn.error')
 
-@dataclass
-class ControlledConnection:
+class StatementCache:
     """
-        Connection wrapper with availability attribute
+        The named statements prepared on a single connection. When full, the least recently
+        executed statement is deallocated to make room
     """
-    connection: psycopg2.extensions.connection
-    available: bool
+    _PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+    _UNKNOWN_STATEMENT = psycopg2.errors.lookup(errorcodes.INVALID_SQL_STATEMENT_NAME)
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._prepared = OrderedDict()
+
+    def execute(self, conn: psycopg2.extensions.connection,
+                cur: psycopg2.extensions.cursor,
+                query: PreparedStatement) -> None:
+        """
+            Execute the query as a server side prepared statement, preparing it first if this
+            connection has not seen it before
+            :arg conn: the connection this cache belongs to
+            :arg cur: a cursor on the connection
+            :arg query: a named query to execute
+            :returns: nothing
+            :rtype: NoneType
+        """
+        if query.name in self._prepared:
+            self._prepared.move_to_end(query.name)
+        else:
+            self._prepare(conn, cur, query)
+
+        server_name, arguments = self._prepared[query.name]
+        execute = f"EXECUTE {server_name}"
+        if arguments:
+            execute += " (" + ", ".join(f"%({arg})s" for arg in arguments) + ")"
+        try:
+            cur.execute(execute, query.parameters)
+        except self._UNKNOWN_STATEMENT:
+            # the server forgot our statements (e.g. DISCARD ALL), start over next time
+            self.invalidate()
+            raise
+
+    def invalidate(self) -> None:
+        """
+            Forget every statement prepared on this connection
+            :returns: nothing
+            :rtype: NoneType
+        """
+        self._prepared.clear()
+
+    def _prepare(self, conn: psycopg2.extensions.connection,
+                 cur: psycopg2.extensions.cursor,
+                 query: PreparedStatement) -> None:
+        if len(self._prepared) >= self._capacity:
+            _, (evicted, _) = self._prepared.popitem(last=False)
+            LOGGER.debug("Deallocating prepared statement %s", evicted)
+            cur.execute(f"DEALLOCATE {evicted}")
+
+        arguments = []
+        def positional(match):
+            if match.group(1) not in arguments:
+                arguments.append(match.group(1))
+            return f"${arguments.index(match.group(1)) + 1}"
+
+        text = self._PLACEHOLDER.sub(positional, query.statement.as_string(conn))
+        server_name = f"sliceoflife_{query.name}"
+        LOGGER.debug("Preparing statement %s", server_name)
+        cur.execute(f"PREPARE {server_name} AS {text.replace('%%', '%')}")
+        self._prepared[query.name] = (server_name, tuple(arguments))
 
 class Instance():
     """
         Object that represents a database instance for the Slice Of Life
     """
+    _statement_caches = weakref.WeakKeyDictionary()
 
-    def __init__(self, pool_size, **config):
+    def __init__(self, pool_limits, *, read_pool_limits=None,
+                 statement_cache_size: int = 64, replication: Replication = None, **config):
         self._conn_conf = config
-        self._pool = self._make_pool(pool_size)
-        self._pool_lock = threading.Lock()
+        self._statement_cache_size = statement_cache_size
+        if not isinstance(pool_limits, PoolLimits):
+            pool_limits = PoolLimits(max_size=pool_limits)
+        if read_pool_limits is None:
+            read_pool_limits = pool_limits
+        elif not isinstance(read_pool_limits, PoolLimits):
+            read_pool_limits = PoolLimits(max_size=read_pool_limits)
+        replication = replication or Replication()
+        self._pool = ConnectionPool(self._connect, pool_limits)
+        self._read_pool = ConnectionPool(self._connect_read_only, read_pool_limits)
+        self._replica_pools = [
+            ConnectionPool(partial(self._connect_read_only, replica), read_pool_limits)
+            for replica in replication.replicas
+        ]
+        self._router = ReadRouter(self._replica_pools, replication)
+
+    def wrote_recently(self, consistent_for: str) -> bool:
+        """
+            Whether reads for the given writer are kept on the primary, because replicas
+            may not have their latest writes yet
+            :arg consistent_for: who may have written
+            :returns: True if their reads bypass the replicas
+            :rtype: bool
+        """
+        return self._router.wrote_recently(consistent_for)
 
     @contextmanager
-    def start_transaction(self) -> psycopg2.extensions.connection:
+    def start_transaction(self, read_only: bool = False,
+                          consistent_for: str = None) -> psycopg2.extensions.connection:
         """
             Acquire a connection from the pool to be used in a transaction. Release when completed
+            Any exception rolls the transaction back before the connection is released.
+            Read only transactions are served by a separate pool of autocommit connections,
+            so no BEGIN or COMMIT is sent and the server rejects any attempt to write. When
+            replicas are configured, read only transactions go to them unless the reader
+            recently wrote to the primary
+            :arg read_only: whether the transaction only reads (defaults to False)
+            :arg consistent_for: who the transaction is for, if anyone. Their committed
+                                 writes are visible to their later reads (defaults to None)
             :returns: A secured sql connection from the connection pool
             :rtype: psycopg2.exceptions.connection
+            :throws: ServiceNotReachable if the connection is lost during the transaction
         """
-        resource = None
+        pool, resource = self._borrow(read_only, consistent_for)
         try:
-            resource = self._getconn()
             LOGGER.debug("Yielding connection to start transaction")
-            LOGGER.info("BEGIN TRANSACTION")
-            yield resource
-        except SliceOfLifeAPIException as exc:
+            if read_only:
+                yield resource
+                LOGGER.info("Read only transaction executed successfully")
+            else:
+                LOGGER.info("BEGIN TRANSACTION")
+                yield resource
+                LOGGER.info("Transaction executed successfully")
+                LOGGER.info("COMMIT TRANSACTION")
+                resource.commit()
+                if consistent_for is not None:
+                    self._router.record_write(consistent_for)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as exc:
+            LOGGER.error("Lost the database connection during transaction: %s", str(exc))
+            self._rollback(resource)
+            raise ServiceNotReachable("Lost the database connection") from exc
+        except Exception as exc:
             LOGGER.error("Exception occurred during transaction: %s", str(exc))
-            LOGGER.info("ROLLBACK TRANSACTION")
-            resource.rollback()
+            self._rollback(resource)
             raise # reraise and handle elsewhere
-        else:
-            LOGGER.info("Transaction executed successfully")
-            LOGGER.info("COMMIT TRANSACTION")
-            resource.commit()
         finally:
-            if resource:
-                self._putconn(resource)
+            pool.putconn(resource)
 
     @staticmethod
     def query(conn: psycopg2.extensions.connection, query: PreparedStatement) -> tuple:
@@ -75,8 +181,7 @@ class Instance():
             raise ServiceNotReachable("No active connection to execute query on")
 
         with conn.cursor() as cur:
-            LOGGER.debug("Execute query: %s", query.statement.as_string(conn))
-            cur.execute(query.statement, query.parameters)
+            Instance._execute(conn, cur, query)
             return cur.fetchall()
 
     @staticmethod
@@ -92,36 +197,96 @@ class Instance():
             raise ServiceNotReachable("No active connection ot execute query on")
 
         with conn.cursor() as cur:
-            LOGGER.debug("Execute query: %s", query.statement.as_string(conn))
-            cur.execute(query.statement, query.parameters)
+            Instance._execute(conn, cur, query)
+
+    def listen(self, channel: str) -> psycopg2.extensions.connection:
+        """
+            Open a connection to the primary, outside of the pools, that receives the
+            notifications sent on the given channel. The caller owns the connection and
+            must close it
+            :arg channel: the notification channel to listen on
+            :returns: a listening autocommit connection
+            :rtype: psycopg2.extensions.connection
+        """
+        conn = self._connect()
+        conn.set_session(autocommit=True)
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+        return conn
 
+    def stats(self, read_only: bool = False) -> dict:
+        """
+            Report utilization and wait time statistics for a connection pool
+            :arg read_only: report on the read only pool instead (defaults to False)
+            :returns: pool statistics
+            :rtype: dict
+        """
+        return self._pool_for(read_only).stats()
+
+    def replica_stats(self) -> list:
+        """
+            Report utilization and wait time statistics for each replica's connection pool
+            :returns: pool statistics, in the order the replicas were configured
+            :rtype: list
+        """
+        return [pool.stats() for pool in self._replica_pools]
 
-    def _connect(self) -> psycopg2.extensions.connection:
+    def _connect(self, overrides: dict = None) -> psycopg2.extensions.connection:
+        conf = {**self._conn_conf, **(overrides or {})}
         LOGGER.debug(
             "Establishing connection to psql://***@%s:%s",
-            self._conn_conf['dbname'],
-            self._conn_conf['port']
+            conf['dbname'],
+            conf['port']
         )
-        _conn = psycopg2.connect(**self._conn_conf)
+        _conn = psycopg2.connect(**conf)
         _conn.set_isolation_level(ISOLATION_LEVEL_READ_COMMITTED)
+        if self._statement_cache_size > 0:
+            # a new connection always starts with no prepared statements
+            self._statement_caches[_conn] = StatementCache(self._statement_cache_size)
         return _conn
 
-    def _make_pool(self, size: int):
-        LOGGER.debug("Making connection pool of size %d", size)
-        return [
-            ControlledConnection(self._connect(), True) for _ in range(size)
-        ]
+    def _connect_read_only(self, overrides: dict = None) -> psycopg2.extensions.connection:
+        _conn = self._connect(overrides)
+        _conn.set_session(readonly=True, autocommit=True)
+        return _conn
+
+    @staticmethod
+    def _execute(conn: psycopg2.extensions.connection,
+                 cur: psycopg2.extensions.cursor,
+                 query: PreparedStatement) -> None:
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            # rendering a composed statement is not free, only do it when it will be seen
+            LOGGER.debug("Execute query: %s", query.statement.as_string(conn))
+        cache = Instance._statement_caches.get(conn)
+        if cache is None or query.name is None:
+            cur.execute(query.statement, query.parameters)
+        else:
+            cache.execute(conn, cur, query)
+
+    @staticmethod
+    def _rollback(conn: psycopg2.extensions.connection) -> None:
+        LOGGER.info("ROLLBACK TRANSACTION")
+        try:
+            conn.rollback()
+        except psycopg2.Error as exc:
+            # the pool discards connections that cannot be reset when they are returned
+            LOGGER.error("Could not roll back transaction: %s", str(exc))
+
+    def _borrow(self, read_only: bool, consistent_for: str) -> tuple:
+        if not read_only:
+            return self._pool, self._pool.getconn()
+        for pool in self._router.candidates(consistent_for):
+            try:
+                return pool, pool.getconn()
+            except ServiceNotReachable as exc:
+                LOGGER.warning("Replica unavailable, trying the next one: %s", str(exc))
+        return self._read_pool, self._read_pool.getconn()
+
+    def _pool_for(self, read_only: bool) -> ConnectionPool:
+        return self._read_pool if read_only else self._pool
+
+    def _getconn(self, read_only: bool = False):
+        return self._pool_for(read_only).getconn()
 
-    def _getconn(self):
-        with self._pool_lock:
-            for conn in self._pool:
-                if conn.available:
-                    conn.available = False
-                    return conn.connection
-            raise ServiceNotReachable("No available database connections")
-
-    def _putconn(self, conn: psycopg2.extensions.connection):
-        with self._pool_lock:
-            for _conn in self._pool:
-                if id(_conn.connection) == id(conn):
-                    _conn.available = True
+    def _putconn(self, conn: psycopg2.extensions.connection, read_only: bool = False):
+        self._pool_for(read_only).putconn(conn)
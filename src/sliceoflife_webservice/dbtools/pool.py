@@ -0,0 +1,342 @@
+"""
+    :module_name: pool
+    :module_summary: a blocking connection pool for the Slice Of Life database
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+from ..exceptions import ServiceNotReachable
+
+LOGGER = logging.getLogger('gunicorn.error')
+
+@dataclass
+class ControlledConnection:
+    """
+        Connection wrapper with availability attribute
+    """
+    connection: psycopg2.extensions.connection
+    available: bool
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+
+@dataclass
+class PoolLimits:
+    """
+        Sizing and timing limits for a connection pool. The pool opens `min_size`
+        connections up front and grows on demand up to `max_size`. Connections beyond
+        `min_size` that sit idle for `idle_timeout` seconds are closed. Connections older
+        than `max_age` seconds are replaced, and connections idle for longer than
+        `check_after` seconds are pinged before they are lent out
+    """
+    max_size: int
+    min_size: int = 0
+    acquire_timeout: float = 2.5
+    idle_timeout: Optional[float] = 300.0
+    max_age: Optional[float] = 1800.0
+    check_after: Optional[float] = 30.0
+
+@dataclass
+class _PoolCounters:
+    """
+        Running totals describing how the pool has been used
+    """
+    in_use: int = 0
+    opened: int = 0
+    closed: int = 0
+    acquired: int = 0
+    timeouts: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+@dataclass
+class _Waiter:
+    """
+        A thread waiting its turn for a connection. Released connections are handed to
+        waiters directly, in the order they arrived
+    """
+    ready: threading.Event = field(default_factory=threading.Event)
+    handoff: Optional[ControlledConnection] = None
+    may_grow: bool = False
+
+class ConnectionPool: # pylint: disable=too-many-instance-attributes
+    """
+        An elastic pool of database connections. Borrowing and returning a connection are
+        constant time. When every connection is in use and the pool cannot grow, borrowers
+        wait in line for up to `acquire_timeout` seconds before giving up. Returned
+        connections are rolled back to a clean state, and broken or expired connections are
+        closed and replaced without the borrower noticing
+    """
+
+    def __init__(self, connect: callable, limits: PoolLimits):
+        self._connect = connect
+        self._limits = limits
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._idle = deque()
+        self._waiters = deque()
+        self._counters = _PoolCounters()
+        self._opening = 0
+        self._reaper = None
+        LOGGER.debug(
+            "Making connection pool of size %d to %d", limits.min_size, limits.max_size
+        )
+        for _ in range(limits.min_size):
+            self._idle.append(self._register(self._connect()))
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def __iter__(self):
+        return iter(list(self._connections.values()))
+
+    def getconn(self, timeout: float = None) -> psycopg2.extensions.connection:
+        """
+            Borrow a connection from the pool. Opens a new connection if none are idle and
+            the pool is below its maximum size, otherwise waits for one to be returned
+            :arg timeout: seconds to wait for a connection (defaults to the pool's timeout)
+            :returns: a connection reserved for the caller
+            :rtype: psycopg2.extensions.connection
+            :throws: ServiceNotReachable if no connection is available in time
+        """
+        timeout = self._limits.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        while True:
+            controlled, fresh = self._acquire(started, timeout)
+            if fresh or self._is_usable(controlled):
+                return controlled.connection
+            LOGGER.warning("Replacing a broken or expired database connection")
+            self._discard(controlled)
+
+    def putconn(self, conn: psycopg2.extensions.connection) -> None:
+        """
+            Return a borrowed connection to the pool, handing it to the longest waiting
+            borrower if there is one. Connections that cannot be reset are closed instead
+            :arg conn: the connection to return
+            :returns: nothing
+            :rtype: NoneType
+        """
+        with self._lock:
+            controlled = self._connections.get(id(conn))
+            if controlled is None or controlled.available:
+                LOGGER.warning("Ignoring a connection that is not on loan from this pool")
+                return
+
+        if not self._reset(controlled):
+            LOGGER.warning("Discarding a database connection that could not be reset")
+            self._discard(controlled)
+            return
+
+        with self._lock:
+            controlled.available = True
+            controlled.last_used = time.monotonic()
+            self._counters.in_use -= 1
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.handoff = controlled
+                waiter.ready.set()
+            else:
+                self._idle.append(controlled)
+
+    def stats(self) -> dict:
+        """
+            Report the pool's utilization and how long borrowers have waited for connections
+            :returns: pool statistics
+            :rtype: dict
+        """
+        with self._lock:
+            size = len(self._connections)
+            counters = self._counters
+            return {
+                'size': size,
+                'min_size': self._limits.min_size,
+                'max_size': self._limits.max_size,
+                'in_use': counters.in_use,
+                'idle': len(self._idle),
+                'waiting': len(self._waiters),
+                'utilization': counters.in_use / self._limits.max_size
+                               if self._limits.max_size else 0.0,
+                'opened': counters.opened,
+                'closed': counters.closed,
+                'acquired': counters.acquired,
+                'timeouts': counters.timeouts,
+                'wait_time_total': counters.wait_total,
+                'wait_time_max': counters.wait_max,
+                'wait_time_mean': counters.wait_total / counters.acquired
+                                  if counters.acquired else 0.0
+            }
+
+    def in_use(self) -> int:
+        """
+            The number of connections currently on loan
+            :returns: connections in use
+            :rtype: int
+        """
+        return self._counters.in_use
+
+    def reap(self) -> int:
+        """
+            Close connections beyond the pool's minimum size that have been idle for longer
+            than its idle timeout
+            :returns: the number of connections closed
+            :rtype: int
+        """
+        if self._limits.idle_timeout is None:
+            return 0
+        expired = []
+        with self._lock:
+            deadline = time.monotonic() - self._limits.idle_timeout
+            # the idle queue is used from the right, so the stalest connections are on the left
+            while self._idle and len(self._connections) > self._limits.min_size \
+                    and self._idle[0].last_used <= deadline:
+                expired.append(self._unregister(self._idle.popleft()))
+        for controlled in expired:
+            self._close(controlled)
+        if expired:
+            LOGGER.debug("Closed %d idle database connections", len(expired))
+        return len(expired)
+
+    def _acquire(self, started: float, timeout: float) -> tuple:
+        with self._lock:
+            if self._idle:
+                return self._lend(self._idle.pop(), started), False
+            if len(self._connections) + self._opening < self._limits.max_size:
+                self._opening += 1
+                waiter = None
+            else:
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+
+        if waiter is None:
+            return self._grow(started), True
+
+        remaining = max(0.0, timeout - (time.monotonic() - started))
+        LOGGER.debug("No idle connections, waiting up to %.2fs", remaining)
+        if not waiter.ready.wait(remaining):
+            with self._lock:
+                if waiter.handoff is None and not waiter.may_grow:
+                    self._waiters.remove(waiter)
+                    self._counters.timeouts += 1
+                    raise ServiceNotReachable(
+                        f"No database connection became available within {timeout}s"
+                    )
+        if waiter.handoff is None:
+            # a discarded connection freed up room, open a replacement for this waiter
+            return self._grow(started), True
+        with self._lock:
+            return self._lend(waiter.handoff, started), False
+
+    def _grow(self, started: float) -> ControlledConnection:
+        try:
+            conn = self._connect()
+        except psycopg2.Error as exc:
+            with self._lock:
+                self._opening -= 1
+            raise ServiceNotReachable("Could not open a new database connection") from exc
+        with self._lock:
+            self._opening -= 1
+            controlled = self._register(conn)
+            self._schedule_reaper()
+            return self._lend(controlled, started)
+
+    def _discard(self, controlled: ControlledConnection) -> None:
+        # the connection must be on loan. Its slot goes to the longest waiter, if any
+        with self._lock:
+            self._unregister(controlled)
+            self._counters.in_use -= 1
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.may_grow = True
+                self._opening += 1
+                waiter.ready.set()
+        self._close(controlled)
+
+    def _is_expired(self, controlled: ControlledConnection) -> bool:
+        return self._limits.max_age is not None \
+            and time.monotonic() - controlled.created_at >= self._limits.max_age
+
+    def _is_usable(self, controlled: ControlledConnection) -> bool:
+        conn = controlled.connection
+        if conn.closed or self._is_expired(controlled):
+            return False
+        if self._limits.check_after is None \
+                or time.monotonic() - controlled.last_used < self._limits.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error as exc:
+            LOGGER.warning("Database connection failed its liveness check: %s", str(exc))
+            return False
+        return True
+
+    def _reset(self, controlled: ControlledConnection) -> bool:
+        conn = controlled.connection
+        if conn.closed or self._is_expired(controlled):
+            return False
+        try:
+            status = conn.get_transaction_status()
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                return False
+            if status != TRANSACTION_STATUS_IDLE:
+                LOGGER.warning("Rolling back a connection returned mid-transaction")
+                conn.rollback()
+        except psycopg2.Error as exc:
+            LOGGER.warning("Could not reset a database connection: %s", str(exc))
+            return False
+        return True
+
+    def _register(self, conn: psycopg2.extensions.connection) -> ControlledConnection:
+        # caller must hold the pool lock (or be the constructor)
+        controlled = ControlledConnection(conn, True)
+        self._connections[id(conn)] = controlled
+        self._counters.opened += 1
+        return controlled
+
+    def _unregister(self, controlled: ControlledConnection) -> ControlledConnection:
+        # caller must hold the pool lock
+        del self._connections[id(controlled.connection)]
+        self._counters.closed += 1
+        return controlled
+
+    def _close(self, controlled: ControlledConnection) -> None:
+        try:
+            controlled.connection.close()
+        except psycopg2.Error as exc:
+            LOGGER.warning("Error while closing a database connection: %s", str(exc))
+
+    def _schedule_reaper(self) -> None:
+        # caller must hold the pool lock. The reaper runs only while the pool is above its
+        # minimum size, so quiet workers shrink back down without any incoming requests
+        if self._reaper is None and self._limits.idle_timeout is not None \
+                and len(self._connections) > self._limits.min_size:
+            self._reaper = threading.Thread(target=self._reap_until_minimum, daemon=True)
+            self._reaper.start()
+
+    def _reap_until_minimum(self) -> None:
+        while True:
+            time.sleep(self._limits.idle_timeout / 2)
+            self.reap()
+            with self._lock:
+                if len(self._connections) <= self._limits.min_size:
+                    self._reaper = None
+                    return
+
+    def _lend(self, controlled: ControlledConnection, started: float) -> ControlledConnection:
+        # caller must hold the pool lock
+        waited = time.monotonic() - started
+        controlled.available = False
+        self._counters.in_use += 1
+        self._counters.acquired += 1
+        self._counters.wait_total += waited
+        self._counters.wait_max = max(self._counters.wait_max, waited)
+        return controlled
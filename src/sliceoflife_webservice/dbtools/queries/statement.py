@@ -4,15 +4,41 @@
     module_auther: Nathan Mendoza (nathancm@uci.edu)
 """
 
+STATEMENTS = {}
+
+def register_statement(name: str, statement) -> str:
+    """
+        Register a composed SQL statement under a name so it is built only once, when its
+        module is imported, instead of every time a query is made
+        :arg name: the name to register the statement under
+        :arg statement: the composed statement
+        :returns: the name the statement was registered under
+        :rtype: str
+    """
+    STATEMENTS[name] = statement
+    return name
+
 class PreparedStatement:
     """
         A class that provides a convenient way to pass parameters to SQL statements
     """
 
-    def __init__(self, sql, **params):
+    def __init__(self, sql, name: str = None, **params):
         self._sql = sql
+        self._name = name
         self._params = params
 
+    @classmethod
+    def named(cls, name: str, **params):
+        """
+            Make a statement from a registered template
+            :arg name: the name the template was registered under
+            :returns: a statement sharing the registered template's composed sql
+            :rtype: PreparedStatement
+            :throws: KeyError if no template is registered under the name
+        """
+        return cls(STATEMENTS[name], name, **params)
+
     @property
     def statement(self):
         """
@@ -22,6 +48,16 @@ class PreparedStatement:
         """
         return self._sql
 
+    @property
+    def name(self) -> str:
+        """
+            Return the name of the template this statement was made from, if it has one.
+            Named statements can be prepared once per connection and reused
+            :returns: template name
+            :rtype: str or NoneType
+        """
+        return self._name
+
     @property
     def parameters(self) -> dict:
         """
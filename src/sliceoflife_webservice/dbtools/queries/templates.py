@@ -9,11 +9,21 @@ import logging
 from psycopg2 import sql
 
 from ..schema import User, Post, Completion
-from .statement import PreparedStatement
+from .statement import PreparedStatement, register_statement
 
 
 LOGGER = logging.getLogger('gunicorn.error')
 
+register_statement('paginated_posts', sql.SQL("""
+                      SELECT *
+                      FROM POSTS p
+                      ORDER BY p.created_at DESC
+                      LIMIT {limit} OFFSET {offset}
+                      """).format(
+    limit=sql.Placeholder("limit"),
+    offset=sql.Placeholder("offset")
+))
+
 def paginated_posts(page_size: int, page_offset: int = 0) -> PreparedStatement:
     """
         SQL query that selects the most recent posts up to a size of `page_size`
@@ -22,20 +32,19 @@ def paginated_posts(page_size: int, page_offset: int = 0) -> PreparedStatement:
         :returns: A templetate SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
-                      SELECT *
-                      FROM POSTS p
-                      ORDER BY p.created_at DESC
-                      LIMIT {limit} OFFSET {offset}
-                      """).format(
-        limit=sql.Placeholder("limit"),
-        offset=sql.Placeholder("offset")
-    )
     parameters = {
         'limit': page_size,
         'offset': page_offset
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('paginated_posts', **parameters)
+
+register_statement('specific_user', sql.SQL("""
+                    SELECT *
+                    FROM USERS u
+                    WHERE u.handle = {handle}
+                   """).format(
+    handle=sql.Placeholder("handle")
+))
 
 def specific_user(user_handle: str) -> PreparedStatement:
     """
@@ -44,17 +53,18 @@ def specific_user(user_handle: str) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
-                    SELECT *
-                    FROM USERS u
-                    WHERE u.handle = {handle}
-                   """).format(
-                    handle=sql.Placeholder("handle")
-                   )
     parameters = {
         'handle': user_handle
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('specific_user', **parameters)
+
+register_statement('specific_task', sql.SQL("""
+                    SELECT *
+                    FROM TASKS t
+                    WHERE t.task_id = {task}
+    """).format(
+    task = sql.Placeholder("taskid")
+))
 
 def specific_task(task_id: int) -> PreparedStatement:
     """
@@ -63,36 +73,135 @@ def specific_task(task_id: int) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
+    parameters = {
+        'taskid': task_id
+    }
+    return PreparedStatement.named('specific_task', **parameters)
+
+register_statement('keyset_posts_first', sql.SQL("""
+                          SELECT *
+                          FROM POSTS p
+                          ORDER BY p.created_at DESC, p.post_id DESC
+                          LIMIT {limit}
+                          """).format(
+    limit=sql.Placeholder("limit")
+))
+
+register_statement('keyset_posts', sql.SQL("""
+                      SELECT *
+                      FROM POSTS p
+                      WHERE (p.created_at, p.post_id) < ({created}, {post})
+                      ORDER BY p.created_at DESC, p.post_id DESC
+                      LIMIT {limit}
+                      """).format(
+    created=sql.Placeholder("aftertime"),
+    post=sql.Placeholder("afterpost"),
+    limit=sql.Placeholder("limit")
+))
+
+def keyset_posts(page_size: int, after: tuple = None) -> PreparedStatement:
+    """
+        SQL query that selects the most recent posts up to a size of `page_size` that were
+        posted before the given (created_at, post_id) key
+        :arg page_size: the size of the result set to ask for
+        :arg after: the (created_at, post_id) of the last post on the previous page
+                    (defaults to None, the first page)
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
+    if after is None:
+        return PreparedStatement.named('keyset_posts_first', limit=page_size)
+
+    parameters = {
+        'limit': page_size,
+        'aftertime': after[0],
+        'afterpost': after[1]
+    }
+    return PreparedStatement.named('keyset_posts', **parameters)
+
+register_statement('users_by_handles', sql.SQL("""
+                    SELECT *
+                    FROM USERS u
+                    WHERE u.handle = ANY({handles})
+                   """).format(
+    handles=sql.Placeholder("handles")
+))
+
+def users_by_handles(user_handles: list) -> PreparedStatement:
+    """
+        SQL query that selects every user whose handle is in the given collection
+        :arg user_handles: the handles to query for
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
+    parameters = {
+        'handles': list(user_handles)
+    }
+    return PreparedStatement.named('users_by_handles', **parameters)
+
+register_statement('tasks_by_ids', sql.SQL("""
                     SELECT *
                     FROM TASKS t
-                    WHERE t.task_id = {task}
+                    WHERE t.task_id = ANY({tasks})
     """).format(
-        task = sql.Placeholder("taskid")
-    )
+    tasks=sql.Placeholder("taskids")
+))
+
+def tasks_by_ids(task_ids: list) -> PreparedStatement:
+    """
+        SQL query that selects every task whose ID is in the given collection
+        :arg task_ids: the task IDs to query for
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
     parameters = {
-        'taskid': task_id
+        'taskids': list(task_ids)
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('tasks_by_ids', **parameters)
 
-def specific_post(post_id: int) -> PreparedStatement:
+register_statement('latest_post_version', sql.SQL("""
+                    SELECT COALESCE(MAX(p.post_id), 0)
+                    FROM Posts p
+    """))
+
+def latest_post_version() -> PreparedStatement:
     """
-        SQL query that selects a specific post by the given id
-        :arg post_id: the id to query for
+        SQL query that selects the id of the newest post, which changes whenever a post is
+        made. Answered from the primary key index without reading any posts
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
+    return PreparedStatement.named('latest_post_version')
+
+register_statement('specific_post', sql.SQL("""
                     SELECT *
                     FROM Posts p
                     WHERE p.post_id = {post}
     """).format(
-        post=sql.Placeholder("postid")
-    )
+    post=sql.Placeholder("postid")
+))
+
+def specific_post(post_id: int) -> PreparedStatement:
+    """
+        SQL query that selects a specific post by the given id
+        :arg post_id: the id to query for
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
     parameters = {
         'postid': post_id
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('specific_post', **parameters)
+
+register_statement('top_level_comments', sql.SQL("""
+                    SELECT *
+                    FROM Comments c
+                    WHERE c.comment_to = {post}
+                    AND c.parent is NULL
+                    ORDER BY c.created_at ASC
+    """).format(
+    post=sql.Placeholder('commentto')
+))
 
 def top_level_comments(post_id: int) -> PreparedStatement:
     """
@@ -101,19 +210,21 @@ def top_level_comments(post_id: int) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
+    parameters = {
+        'commentto': post_id
+    }
+    return PreparedStatement.named('top_level_comments', **parameters)
+
+register_statement('comments_responding_to', sql.SQL("""
                     SELECT *
                     FROM Comments c
-                    WHERE c.comment_to = {post}
-                    AND c.parent is NULL
+                    WHERE c.comment_to = {postid}
+                    AND c.parent = {commentid}
                     ORDER BY c.created_at ASC
     """).format(
-        post=sql.Placeholder('commentto')
-    )
-    parameters = {
-        'commentto': post_id
-    }
-    return PreparedStatement(statement, **parameters)
+    postid=sql.Placeholder('commentto'),
+    commentid=sql.Placeholder('commentid')
+))
 
 def comments_responding_to(post_id: int, parent_comment_id: int) -> PreparedStatement:
     """
@@ -123,40 +234,75 @@ def comments_responding_to(post_id: int, parent_comment_id: int) -> PreparedStat
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
-                    SELECT *
-                    FROM Comments c
-                    WHERE c.comment_to = {postid}
-                    AND c.parent = {commentid}
-                    ORDER BY c.created_at ASC
-    """).format(
-        postid=sql.Placeholder('commentto'),
-        commentid=sql.Placeholder('commentid')
-    )
     parameters = {
         'commentto': post_id,
         'commentid': parent_comment_id
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('comments_responding_to', **parameters)
 
-def reactions_by_group(post_id: int) -> PreparedStatement:
+register_statement('comment_forest', sql.SQL("""
+                    WITH RECURSIVE thread AS (
+                        SELECT c.*, 0 AS depth
+                        FROM Comments c
+                        WHERE c.comment_to = {postid}
+                        AND c.parent IS NULL
+                        UNION ALL
+                        SELECT c.*, t.depth + 1
+                        FROM Comments c
+                        JOIN thread t ON c.parent = t.comment_id
+                        WHERE c.comment_to = {postid}
+                    )
+                    SELECT t.comment_id, t.created_at, t.free_text,
+                           t.parent, t.comment_by, t.comment_to, u.*
+                    FROM thread t
+                    JOIN Users u ON u.handle = t.comment_by
+                    ORDER BY t.depth ASC, t.created_at ASC
+    """).format(
+    postid=sql.Placeholder('forestof')
+))
+
+def comment_forest(post_id: int) -> PreparedStatement:
     """
-        SQL query the selects that groups the reactions that have occured on a post
-        :arg post_id: the post id to gather reactions for
+        SQL query that selects every comment on a post, threads included, along with the
+        author of each comment. Parents are always ordered before their responses
+        :arg post_id: the post id to gather comments for
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
+    parameters = {
+        'forestof': post_id
+    }
+    return PreparedStatement.named('comment_forest', **parameters)
+
+register_statement('reactions_by_group', sql.SQL("""
                     SELECT DISTINCT ON (emoji) *
                     FROM Reactions r
                     WHERE r.reacted_to = {postid}
     """).format(
-        postid=sql.Placeholder('reactto')
-    )
+    postid=sql.Placeholder('reactto')
+))
+
+def reactions_by_group(post_id: int) -> PreparedStatement:
+    """
+        SQL query the selects that groups the reactions that have occured on a post
+        :arg post_id: the post id to gather reactions for
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
     parameters = {
         'reactto': post_id
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('reactions_by_group', **parameters)
+
+register_statement('reaction_counts', sql.SQL("""
+                    SELECT COUNT(*)
+                    FROM Reactions r
+                    WHERE r.reacted_to = {postid}
+                    AND r.emoji = {code}
+    """).format(
+    postid=sql.Placeholder('reactto'),
+    code=sql.Placeholder('codecount')
+))
 
 def reaction_counts(emoji_code: str, post_id: int) -> PreparedStatement:
     """
@@ -166,20 +312,21 @@ def reaction_counts(emoji_code: str, post_id: int) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
-                    SELECT COUNT(*)
-                    FROM Reactions r
-                    WHERE r.reacted_to = {postid}
-                    AND r.emoji = {code}
-    """).format(
-        postid=sql.Placeholder('reactto'),
-        code=sql.Placeholder('codecount')
-    )
     parameters = {
         'reactto': post_id,
         'codecount': emoji_code
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('reaction_counts', **parameters)
+
+register_statement('reactors_by_emoji', sql.SQL("""
+                    SELECT r.reacted_by
+                    FROM Reactions r
+                    WHERE r.reacted_to = {postid}
+                    AND r.emoji = {code}
+    """).format(
+    postid=sql.Placeholder('reactto'),
+    code=sql.Placeholder('codeused')
+))
 
 def reactors_by_emoji(emoji_code: str, post_id: int) -> PreparedStatement:
     """
@@ -189,40 +336,68 @@ def reactors_by_emoji(emoji_code: str, post_id: int) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
-                    SELECT r.reacted_by
-                    FROM Reactions r
-                    WHERE r.reacted_to = {postid}
-                    AND r.emoji = {code}
-    """).format(
-        postid=sql.Placeholder('reactto'),
-        code=sql.Placeholder('codeused')
-    )
     parameters = {
         'reactto': post_id,
         'codeused': emoji_code
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('reactors_by_emoji', **parameters)
 
-def insert_user_account(new_user: User) -> PreparedStatement:
+register_statement('reaction_summary', sql.SQL("""
+                    SELECT r.emoji,
+                           COUNT(*),
+                           COUNT(DISTINCT r.reacted_by),
+                           (ARRAY_AGG(r.reacted_by ORDER BY r.react_id)
+                               FILTER (WHERE r.first_reaction))
+                               [1:COALESCE({cap}::int, COUNT(*)::int)]
+                    FROM (
+                        SELECT emoji, reacted_by, react_id,
+                               react_id = MIN(react_id)
+                                   OVER (PARTITION BY emoji, reacted_by) AS first_reaction
+                        FROM Reactions
+                        WHERE reacted_to = {postid}
+                    ) r
+                    GROUP BY r.emoji
+                    ORDER BY r.emoji
+    """).format(
+    postid=sql.Placeholder('summaryof'),
+    cap=sql.Placeholder('reactorcap')
+))
+
+def reaction_summary(post_id: int, reactor_limit: int = None) -> PreparedStatement:
     """
-        SQL query that inserts the given user object into the database
-        :arg new_user: the user being added
+        SQL query that summarizes the reactions on a post, one row per emoji with the number of
+        times it was used, the number of distinct users that used it, and who those users are
+        :arg post_id: the post id to summarize reactions for
+        :arg reactor_limit: the most reactors to list per emoji (defaults to no limit)
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
+    parameters = {
+        'summaryof': post_id,
+        'reactorcap': reactor_limit
+    }
+    return PreparedStatement.named('reaction_summary', **parameters)
+
+register_statement('insert_user_account', sql.SQL("""
                     INSERT INTO Users VALUES
                     ({handle}, {password}, {email}, {salt}, {first}, {last}, {avatar})
     """).format(
-        handle=sql.Placeholder('handle'),
-        password=sql.Placeholder('password'),
-        email=sql.Placeholder('email'),
-        salt=sql.Placeholder('salt'),
-        first=sql.Placeholder('first'),
-        last=sql.Placeholder('last'),
-        avatar=sql.Placeholder('avatar')
-    )
+    handle=sql.Placeholder('handle'),
+    password=sql.Placeholder('password'),
+    email=sql.Placeholder('email'),
+    salt=sql.Placeholder('salt'),
+    first=sql.Placeholder('first'),
+    last=sql.Placeholder('last'),
+    avatar=sql.Placeholder('avatar')
+))
+
+def insert_user_account(new_user: User) -> PreparedStatement:
+    """
+        SQL query that inserts the given user object into the database
+        :arg new_user: the user being added
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
     parameters = {
         'handle': new_user.handle,
         'password': new_user.password_hash,
@@ -232,7 +407,18 @@ def insert_user_account(new_user: User) -> PreparedStatement:
         'last': new_user.last_name,
         'avatar': new_user.profile_pic
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('insert_user_account', **parameters)
+
+register_statement('insert_post', sql.SQL("""
+                    INSERT INTO Posts VALUES
+                    (DEFAULT, {free_text}, {image_url}, {created_at}, {post_author}, {task_completed})
+    """).format(
+    free_text=sql.Placeholder('freetext'),
+    image_url=sql.Placeholder('image'),
+    created_at=sql.Placeholder('date'),
+    post_author=sql.Placeholder('author'),
+    task_completed=sql.Placeholder('completes')
+))
 
 def insert_post(new_post: Post) -> PreparedStatement:
     """
@@ -241,16 +427,6 @@ def insert_post(new_post: Post) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
-                    INSERT INTO Posts VALUES
-                    (DEFAULT, {free_text}, {image_url}, {created_at}, {post_author}, {task_completed})
-    """).format(
-        free_text=sql.Placeholder('freetext'),
-        image_url=sql.Placeholder('image'),
-        created_at=sql.Placeholder('date'),
-        post_author=sql.Placeholder('author'),
-        task_completed=sql.Placeholder('completes')
-    )
     parameters = {
         'freetext': new_post.free_text,
         'image': new_post.image,
@@ -258,7 +434,15 @@ def insert_post(new_post: Post) -> PreparedStatement:
         'author': new_post.posted_by,
         'completes': new_post.completes
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('insert_post', **parameters)
+
+register_statement('insert_completion', sql.SQL("""
+                    INSERT INTO Completes VALUES
+                    ({user}, {task})
+    """).format(
+    user=sql.Placeholder('user'),
+    task=sql.Placeholder('task')
+))
 
 def insert_completion(new_completion: Completion) -> PreparedStatement:
     """
@@ -267,18 +451,23 @@ def insert_completion(new_completion: Completion) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
-                    INSERT INTO Completes VALUES
-                    ({user}, {task})
-    """).format(
-        user=sql.Placeholder('user'),
-        task=sql.Placeholder('task')
-    )
     parameters = {
         'user': new_completion.completed_by,
         'task': new_completion.completed_task
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('insert_completion', **parameters)
+
+register_statement('available_tasks', sql.SQL("""
+                    SELECT *
+                    FROM Tasks t
+                    WHERE t.task_id NOT IN (
+                        SELECT completed_task
+                        FROM Completes c
+                        WHERE c.completed_by = {handle}
+                    )
+    """).format(
+    handle=sql.Placeholder('incompletes')
+))
 
 def available_tasks(user_handle: str) -> PreparedStatement:
     """
@@ -287,21 +476,22 @@ def available_tasks(user_handle: str) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
+    parameters = {
+        'incompletes': user_handle
+    }
+    return PreparedStatement.named('available_tasks', **parameters)
+
+register_statement('completed_tasks', sql.SQL("""
                     SELECT *
                     FROM Tasks t
-                    WHERE t.task_id NOT IN (
+                    WHERE t.task_id IN (
                         SELECT completed_task
                         FROM Completes c
                         WHERE c.completed_by = {handle}
                     )
     """).format(
-        handle=sql.Placeholder('incompletes')
-    )
-    parameters = {
-        'incompletes': user_handle
-    }
-    return PreparedStatement(statement, **parameters)
+    handle=sql.Placeholder('completes')
+))
 
 def completed_tasks(user_handle: str) -> PreparedStatement:
     """
@@ -310,18 +500,103 @@ def completed_tasks(user_handle: str) -> PreparedStatement:
         :returns: A templated SQL statement
         :rtype: PreparedStatement
     """
-    statement = sql.SQL("""
+    parameters = {
+        'completes': user_handle
+    }
+    return PreparedStatement.named('completed_tasks', **parameters)
+
+register_statement('all_tasks', sql.SQL("""
                     SELECT *
                     FROM Tasks t
-                    WHERE t.task_id IN (
-                        SELECT completed_task
-                        FROM Completes c
-                        WHERE c.completed_by = {handle}
-                    )
+                    ORDER BY t.task_id
+    """))
+
+def all_tasks() -> PreparedStatement:
+    """
+        SQL query that selects every task, in task id order
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
+    return PreparedStatement.named('all_tasks')
+
+register_statement('completed_task_ids', sql.SQL("""
+                    SELECT COALESCE(array_agg(c.completed_task ORDER BY c.completed_task), '{{}}')
+                    FROM Completes c
+                    WHERE c.completed_by = {handle}
     """).format(
-        handle=sql.Placeholder('completes')
-    )
+    handle=sql.Placeholder('completedby')
+))
+
+def completed_task_ids(user_handle: str) -> PreparedStatement:
+    """
+        SQL query that gathers the ids of the tasks a given user has completed as a single
+        array, without reading the tasks themselves
+        :arg user_handle: the user to gather completed task ids for
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
     parameters = {
-        'completes': user_handle
+        'completedby': user_handle
+    }
+    return PreparedStatement.named('completed_task_ids', **parameters)
+
+register_statement('notify_invalidation', sql.SQL("""
+                    SELECT pg_notify({channel}, {payload})
+    """).format(
+    channel=sql.Placeholder('channel'),
+    payload=sql.Placeholder('payload')
+))
+
+def notify_invalidation(channel: str, payload: str) -> PreparedStatement:
+    """
+        SQL query that sends a notification to every connection listening on a channel.
+        Sent inside a transaction, it is only delivered if the transaction commits
+        :arg channel: the channel to notify
+        :arg payload: the notification's message
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
+    parameters = {
+        'channel': channel,
+        'payload': payload
+    }
+    return PreparedStatement.named('notify_invalidation', **parameters)
+
+register_statement('lock_image', sql.SQL("""
+                    SELECT pg_advisory_xact_lock(hashtext({image}))
+    """).format(
+    image=sql.Placeholder('lockimage')
+))
+
+def lock_image(image: str) -> PreparedStatement:
+    """
+        SQL query that holds a lock on an image's name until the end of the transaction, so it
+        cannot be deleted while a post that uses it is being made
+        :arg image: the image's key
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
+    parameters = {
+        'lockimage': image
+    }
+    return PreparedStatement.named('lock_image', **parameters)
+
+register_statement('image_references', sql.SQL("""
+                    SELECT COUNT(*)
+                    FROM Posts p
+                    WHERE p.image_url = {image}
+    """).format(
+    image=sql.Placeholder('referencedimage')
+))
+
+def image_references(image: str) -> PreparedStatement:
+    """
+        SQL query that counts the posts that use an image
+        :arg image: the image's key
+        :returns: A templated SQL statement
+        :rtype: PreparedStatement
+    """
+    parameters = {
+        'referencedimage': image
     }
-    return PreparedStatement(statement, **parameters)
+    return PreparedStatement.named('image_references', **parameters)
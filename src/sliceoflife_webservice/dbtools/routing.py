@@ -0,0 +1,85 @@
+"""
+    :module_name: routing
+    :module_summary: spreads reads across the Slice Of Life database replicas
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import itertools
+from dataclasses import dataclass, field
+
+from ..toolkit.cache import ExpiringLRUCache
+
+ROUTING_POLICIES = ('round_robin', 'least_busy')
+STICKY_WRITERS = 4096
+
+@dataclass
+class Replication:
+    """
+        Where read only transactions may be sent. Each replica is given as the connection
+        settings that differ from the primary's (usually just host and port). Replicas are
+        tried in an order chosen by `policy`, either taking turns (round_robin) or favouring
+        the replica with the fewest connections in use (least_busy). Reads by someone who
+        wrote to the primary within the last `sticky_window` seconds stay on the primary so
+        they always see their own writes. Writers are remembered in `recent_writes`, any
+        cache with get and put. A writer's next read is usually served by another worker, so
+        give every worker the same shared cache. Defaults to a cache private to the process
+    """
+    replicas: list = field(default_factory=list)
+    policy: str = 'round_robin'
+    sticky_window: float = 5.0
+    recent_writes: object = None
+
+class ReadRouter:
+    """
+        Chooses which replicas a read only transaction should try, and remembers who wrote
+        to the primary recently
+    """
+
+    def __init__(self, pools: list, replication: Replication):
+        if replication.policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown routing policy {replication.policy}")
+        self._pools = pools
+        self._policy = replication.policy
+        self._window = replication.sticky_window
+        self._turn = itertools.count()
+        self._recent_writes = replication.recent_writes
+        if self._recent_writes is None:
+            self._recent_writes = ExpiringLRUCache(STICKY_WRITERS)
+
+    def candidates(self, consistent_for: str = None) -> list:
+        """
+            Order the replica pools by preference for a read
+            :arg consistent_for: who the read is for, if anyone (defaults to None)
+            :returns: the pools to try, most preferred first. Empty if the read must be
+                      made against the primary
+            :rtype: list
+        """
+        if not self._pools or self.wrote_recently(consistent_for):
+            return []
+        if self._policy == 'least_busy':
+            return sorted(self._pools, key=lambda pool: pool.in_use())
+        start = next(self._turn) % len(self._pools)
+        return self._pools[start:] + self._pools[:start]
+
+    def record_write(self, key: str) -> None:
+        """
+            Note that the given key just wrote to the primary
+            :arg key: who made the write
+            :returns: nothing
+            :rtype: NoneType
+        """
+        if not self._pools or self._window <= 0:
+            return
+        # the entry expires with the window, and is dropped when it is next looked up
+        self._recent_writes.put(key, True, self._window)
+
+    def wrote_recently(self, key: str) -> bool:
+        """
+            Whether the given key's reads are kept on the primary after a write of theirs
+            :arg key: who may have made a write
+            :returns: True if the key wrote within the sticky window
+            :rtype: bool
+        """
+        if key is None:
+            return False
+        return self._recent_writes.get(key, False)
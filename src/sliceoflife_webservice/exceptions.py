@@ -34,6 +34,21 @@ class MismatchedCredentialsError(AuthorizationError):
         Exception thrown when an API request fails to authenticate a user
     """
 
+class UploadTooLargeError(SliceOfLifeAPIException):
+    """
+        Exception thrown when an API request uploads more data than is allowed
+    """
+
+class UnsupportedMediaError(SliceOfLifeAPIException):
+    """
+        Exception thrown when an API request uploads a file of a kind that is not accepted
+    """
+
+class ConfigurationError(SliceOfLifeAPIException):
+    """
+        Exception thrown when the service is missing settings it needs
+    """
+
 class ServiceNotReachable(SliceOfLifeAPIException):
     """
         Exception thrown when an API request fails becuase an external service is unreachable
@@ -5,3 +5,11 @@
 """
 
 from .spaces import SpaceIndex
+from .cache import ExpiringLRUCache
+from .catalog import TaskCatalog
+from .shared import SharedCache, region_cache
+from .flight import SingleFlight
+from .media import sniff_image_type, sniff_upload_type, sniff_stream_type, guess_image_type, \
+                   ImageUploadFile, IMAGE_TYPES, SIGNATURE_LENGTH
+from .images import ImagePipeline, derivative_key, closest_width, make_derivatives, can_decode
+from .storage import StorageBackend, S3Storage, LocalStorage
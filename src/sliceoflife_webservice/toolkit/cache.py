@@ -0,0 +1,131 @@
+"""
+    :module_name: cache
+    :module_summary: a bounded, expiring in-memory cache
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class ExpiringLRUCache: # pylint: disable=too-many-instance-attributes
+    """
+        A thread safe cache holding at most `capacity` entries. Each entry expires `ttl`
+        seconds after it is stored (never, if there is no ttl), and the least recently used
+        entry is evicted to make room for new ones. With `max_bytes`, values must be bytes,
+        and entries are also evicted to keep their total length within it
+    """
+
+    def __init__(self, capacity: int, ttl: float = None, max_bytes: int = None):
+        self._capacity = capacity
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._oversize = 0
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+            Look up a cached value
+            :arg key: the key the value was stored under
+            :arg default: what to return if the key is missing or expired (defaults to None)
+            :returns: the cached value
+            :rtype: any
+        """
+        with self._lock:
+            value, expires_at, _ = self._entries.get(key, (_MISSING, None, 0))
+            if value is _MISSING or (expires_at is not None and expires_at <= time.monotonic()):
+                if value is not _MISSING:
+                    self._remove(key)
+                self._misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key, value, ttl: float = None) -> None:
+        """
+            Store a value, evicting the least recently used entry if the cache is full
+            :arg key: the key to store the value under
+            :arg value: the value to cache
+            :arg ttl: seconds until the entry expires (defaults to the cache's ttl)
+            :returns: nothing
+            :rtype: NoneType
+        """
+        if self._capacity <= 0:
+            return
+        ttl = self._ttl if ttl is None else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        size = 0 if self._max_bytes is None else len(value)
+        with self._lock:
+            self._remove(key)
+            if self._max_bytes is not None and size > self._max_bytes:
+                self._oversize += 1
+                return
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._entries) > self._capacity or \
+                    (self._max_bytes is not None and self._bytes > self._max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key) -> None:
+        """
+            Forget a cached value, if there is one
+            :arg key: the key to forget
+            :returns: nothing
+            :rtype: NoneType
+        """
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_matching(self, predicate: callable) -> None:
+        """
+            Forget every cached value whose key satisfies the predicate
+            :arg predicate: called with each key, returns True for keys to forget
+            :returns: nothing
+            :rtype: NoneType
+        """
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        """
+            Forget every cached value
+            :returns: nothing
+            :rtype: NoneType
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """
+            Report how full the cache is and how often lookups found what they wanted
+            :returns: cache statistics
+            :rtype: dict
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'capacity': self._capacity,
+                'bytes': self._bytes,
+                'oversize': self._oversize,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0
+            }
+
+    def _remove(self, key) -> None:
+        # callers hold the lock
+        _, _, size = self._entries.pop(key, (None, None, 0))
+        self._bytes -= size
@@ -0,0 +1,73 @@
+"""
+    :module_name: catalog
+    :module_summary: an in-memory copy of the small, rarely changing sliceoflife task list
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import threading
+import time
+
+class TaskCatalog:
+    """
+        Every task, loaded once and shared by all requests in the worker until it is `ttl`
+        seconds old (never, if there is no ttl) or invalidated
+    """
+
+    def __init__(self, ttl: float = None):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._tasks = None
+        self._loaded_at = 0.0
+        self._loads = 0
+
+    def tasks(self, load: callable) -> tuple:
+        """
+            The catalog's tasks, loading them if they are missing or stale. Concurrent
+            requests wait for a single load instead of each making their own
+            :arg load: returns every task, ordered by task id
+            :returns: every task
+            :rtype: tuple
+        """
+        with self._lock:
+            if self._tasks is None or (self._ttl is not None and
+                                       time.monotonic() - self._loaded_at >= self._ttl):
+                self._tasks = tuple(load())
+                self._loaded_at = time.monotonic()
+                self._loads += 1
+            return self._tasks
+
+    def partition(self, load: callable, completed_ids) -> tuple:
+        """
+            Split the catalog into the tasks a user has completed and those still available
+            to them, keeping the catalog's order
+            :arg load: returns every task, ordered by task id
+            :arg completed_ids: the ids of the tasks the user has completed
+            :returns: the completed tasks and the available tasks
+            :rtype: tuple
+        """
+        completed_ids = frozenset(completed_ids)
+        completed, available = [], []
+        for task in self.tasks(load):
+            (completed if task.task_id in completed_ids else available).append(task)
+        return completed, available
+
+    def invalidate(self) -> None:
+        """
+            Forget the loaded tasks, so the next lookup loads them again
+            :returns: nothing
+            :rtype: NoneType
+        """
+        with self._lock:
+            self._tasks = None
+
+    def stats(self) -> dict:
+        """
+            Report how many tasks are loaded and how often they were loaded
+            :returns: catalog statistics
+            :rtype: dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._tasks) if self._tasks is not None else 0,
+                'loads': self._loads
+            }
@@ -0,0 +1,70 @@
+"""
+    :module_name: flight
+    :module_summary: lets concurrent identical calls share a single result
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import threading
+from dataclasses import dataclass, field
+
+@dataclass
+class _Flight:
+    done: threading.Event = field(default_factory=threading.Event)
+    result: object = None
+    error: BaseException = None
+
+class SingleFlight:
+    """
+        Coalesces concurrent calls made with the same key. The first caller runs the call
+        and every caller that arrives while it is still running waits for it and gets the
+        same result, or the same exception. Results are not kept once the call finishes
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._shared = 0
+
+    def do(self, key, function: callable):
+        """
+            Run the function, unless a call with the same key is already running, in which
+            case wait for that call to finish instead
+            :arg key: identifies calls that would return the same result
+            :arg function: makes the call, takes no arguments
+            :returns: the call's result
+            :rtype: any
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self) -> dict:
+        """
+            Report how many calls are running and how many callers shared another's call
+            :returns: coalescing statistics
+            :rtype: dict
+        """
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'shared': self._shared
+            }
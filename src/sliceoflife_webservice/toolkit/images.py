@@ -0,0 +1,190 @@
+"""
+    :module_name: images
+    :module_summary: generates smaller, feed friendly copies of uploaded images
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import logging
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from .shared import region_cache
+from .spaces import SpaceIndex
+from ..exceptions import ServiceNotReachable
+
+LOGGER = logging.getLogger('gunicorn.error')
+
+DERIVATIVE_WIDTHS = (320, 640, 1280)
+DERIVATIVE_QUALITY = 80
+
+def derivative_key(image: str, width: int) -> str:
+    """
+        The key a resized WebP copy of an image is saved under, next to the original.
+        For example, posts/user/task1.png at 320 pixels wide is posts/user/task1.w320.webp
+        :arg image: the original image's key
+        :arg width: the width of the copy
+        :returns: the copy's key
+        :rtype: str
+    """
+    return str(pathlib.PurePosixPath(image).with_suffix(f".w{width}.webp"))
+
+def closest_width(size_hint: int) -> int:
+    """
+        The narrowest derivative at least as wide as the client asked for
+        :arg size_hint: the width the client will display the image at
+        :returns: a derivative width
+        :rtype: int
+    """
+    for width in DERIVATIVE_WIDTHS:
+        if width >= size_hint:
+            return width
+    return DERIVATIVE_WIDTHS[-1]
+
+def can_decode(image: str) -> bool:
+    """
+        Whether images saved under names like this one can be opened with the Pillow plugins
+        installed. HEIC images, for one, need a plugin Pillow does not ship with
+        :arg image: the image's key
+        :returns: True if derivatives can be made of the image
+        :rtype: bool
+    """
+    return pathlib.PurePosixPath(image).suffix.lower() in Image.registered_extensions()
+
+def make_derivatives(original: bytes) -> dict:
+    """
+        Resize an image to each derivative width and encode it as WebP. Images are never
+        enlarged, so copies wider than the original keep the original's size
+        :arg original: the original image file
+        :returns: encoded copies by width
+        :rtype: dict
+    """
+    derivatives = {}
+    with Image.open(BytesIO(original)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        for width in DERIVATIVE_WIDTHS:
+            copy = image.copy()
+            copy.thumbnail((width, width * 4))
+            encoded = BytesIO()
+            copy.save(encoded, format='WEBP', quality=DERIVATIVE_QUALITY)
+            derivatives[width] = encoded.getvalue()
+    return derivatives
+
+class ImagePipeline:
+    """
+        Generates the derivatives of newly saved images on background threads, and tells
+        requests which derivatives are ready to be served. Requests never wait on storage:
+        until an image's derivatives are known to be ready the original is served, while
+        a background thread looks for them, or makes them if the image has none. Images that
+        cannot be decoded are remembered, and only tried again after `FAILED_RECHECK` seconds
+    """
+    READY_CACHE=4096
+    PENDING_RECHECK=30
+    FAILED_RECHECK=24 * 3600
+
+    def __init__(self, spaces: SpaceIndex, workers: int = 2):
+        self._spaces = spaces
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='image-derivatives')
+        # with SHAREDCACHEDIR set, derivatives made by one worker are served by every worker
+        self._ready = region_cache('derivatives', self.READY_CACHE)
+        self._lock = threading.Lock()
+        self._resolving = set()
+
+    def submit(self, image: str):
+        """
+            Queue the derivatives of a saved image to be made
+            :arg image: the key the original image is saved under
+            :returns: the queued job
+            :rtype: concurrent.futures.Future
+        """
+        LOGGER.info("Queueing derivatives for %s", image)
+        return self._executor.submit(self._derive, image)
+
+    def variant_for(self, image: str, size_hint: int) -> str:
+        """
+            The key of the derivative best suited to the given display width, if it is
+            known to be ready. Falls back to the original image otherwise, and queues a
+            check for the image's derivatives
+            :arg image: the original image's key
+            :arg size_hint: the width the client will display the image at
+            :returns: the key to share
+            :rtype: str
+        """
+        variant = derivative_key(image, closest_width(size_hint))
+        ready = self._ready.get(variant)
+        if ready is None:
+            self._resolve_later(image)
+        return variant if ready else image
+
+    def remove_derivatives(self, image: str) -> None:
+        """
+            Delete the derivatives of an image that is being deleted
+            :arg image: the original image's key
+            :returns: nothing
+            :rtype: NoneType
+            :throws: ServiceNotReachable if storage cannot be reached
+        """
+        for width in DERIVATIVE_WIDTHS:
+            variant = derivative_key(image, width)
+            self._ready.invalidate(variant)
+            self._spaces.delete_file(variant)
+
+    def _resolve_later(self, image: str) -> None:
+        with self._lock:
+            if image in self._resolving:
+                return
+            self._resolving.add(image)
+        self._executor.submit(self._resolve, image)
+
+    def _resolve(self, image: str) -> None:
+        variants = [derivative_key(image, width) for width in DERIVATIVE_WIDTHS]
+        try:
+            if not can_decode(image):
+                self._give_up(image, "its type cannot be decoded")
+            elif all(self._spaces.file_exists(variant) for variant in variants):
+                for variant in variants:
+                    self._ready.put(variant, True)
+            else:
+                # images saved before derivatives were made get them now
+                self._derive(image)
+        except ServiceNotReachable as exc:
+            LOGGER.warning("Could not check for derivatives of %s: %s", image, str(exc))
+        finally:
+            # derivatives still being made elsewhere may appear shortly, so look again later
+            for variant in variants:
+                if self._ready.get(variant) is None:
+                    self._ready.put(variant, False, self.PENDING_RECHECK)
+            with self._lock:
+                self._resolving.discard(image)
+
+    def _derive(self, image: str) -> None:
+        if not can_decode(image):
+            self._give_up(image, "its type cannot be decoded")
+            return
+        try:
+            original = self._spaces.read_file(image)
+            try:
+                derivatives = make_derivatives(original)
+            except Exception as exc: # pylint: disable=broad-except
+                # an image that cannot be decoded now will not decode later either
+                self._give_up(image, str(exc))
+                return
+            for width, encoded in derivatives.items():
+                variant = derivative_key(image, width)
+                self._spaces.save_file(variant, BytesIO(encoded), 'image/webp')
+                self._ready.put(variant, True)
+        except Exception as exc: # pylint: disable=broad-except
+            # nothing is waiting on this job, so failures can only be logged. Storage
+            # failures are tried again once the image is next asked for
+            LOGGER.error("Could not make derivatives for %s: %s", image, str(exc))
+
+    def _give_up(self, image: str, reason: str) -> None:
+        LOGGER.warning("Serving %s without derivatives, %s", image, reason)
+        for width in DERIVATIVE_WIDTHS:
+            self._ready.put(derivative_key(image, width), False, self.FAILED_RECHECK)
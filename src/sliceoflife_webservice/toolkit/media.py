@@ -0,0 +1,147 @@
+"""
+    :module_name: media
+    :module_summary: recognizes the kinds of images the sliceoflife accepts
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import pathlib
+import tempfile
+
+from ..exceptions import UnsupportedMediaError
+
+SIGNATURE_LENGTH = 12
+SPOOL_SIZE = 500 * 1024
+
+IMAGE_TYPES = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/heic': '.heic'
+}
+
+IMAGE_EXTENSIONS = {
+    **{extension: content_type for content_type, extension in IMAGE_TYPES.items()},
+    '.jpeg': 'image/jpeg'
+}
+
+def sniff_image_type(header: bytes) -> str:
+    """
+        Identify an image from the first bytes of its file, regardless of what it is named
+        :arg header: at least the first `SIGNATURE_LENGTH` bytes of the file
+        :returns: the image's content type, or None if it is not a supported image
+        :rtype: str or NoneType
+    """
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header[4:8] == b'ftyp' and header[8:12] in (b'heic', b'heix', b'mif1', b'msf1'):
+        return 'image/heic'
+    return None
+
+def sniff_upload_type(file_to_check) -> str:
+    """
+        Identify an uploaded image by peeking at its first bytes. The file is rewound
+        afterwards so it can still be read from the start
+        :arg file_to_check: seekable file-like object
+        :returns: the image's content type, or None if it is not a supported image
+        :rtype: str or NoneType
+    """
+    start = file_to_check.tell()
+    header = file_to_check.read(SIGNATURE_LENGTH)
+    file_to_check.seek(start)
+    return sniff_image_type(header)
+
+def sniff_stream_type(stream) -> tuple:
+    """
+        Identify an image arriving on a stream that cannot be rewound, such as a request
+        body, by reading its first bytes
+        :arg stream: file-like object to read from
+        :returns: the image's content type, or None if it is not a supported image, and a
+                  stream that reads the whole image, first bytes included
+        :rtype: tuple
+    """
+    header = b''
+    while len(header) < SIGNATURE_LENGTH:
+        chunk = stream.read(SIGNATURE_LENGTH - len(header))
+        if not chunk:
+            break
+        header += chunk
+    return sniff_image_type(header), _RejoinedStream(header, stream)
+
+class _RejoinedStream:
+    """
+        A stream whose first bytes were already read, put back in front of the rest
+    """
+
+    def __init__(self, header: bytes, rest):
+        self._header = header
+        self._rest = rest
+
+    def read(self, size: int = -1) -> bytes:
+        """
+            Read from the stream
+            :arg size: the most bytes to read, or everything if negative (defaults to -1)
+            :returns: the bytes read, empty at the end of the stream
+            :rtype: bytes
+        """
+        if not self._header:
+            return self._rest.read(size)
+        if size is None or size < 0:
+            data, self._header = self._header + self._rest.read(), b''
+        else:
+            data, self._header = self._header[:size], self._header[size:]
+        return data
+
+    def close(self):
+        """
+            Close the rest of the stream
+        """
+        self._header = b''
+        self._rest.close()
+
+def guess_image_type(filename: str) -> str:
+    """
+        Identify an image from the extension of its file name
+        :arg filename: the image's file name
+        :returns: the image's content type, or None if it is not named like a supported image
+        :rtype: str or NoneType
+    """
+    return IMAGE_EXTENSIONS.get(pathlib.PurePath(filename).suffix.lower())
+
+class ImageUploadFile:
+    """
+        Where an uploaded image is spooled while the request body is parsed. The file's
+        signature is checked as soon as its first `SIGNATURE_LENGTH` bytes are written, so
+        a file that is not an image is refused before the rest of the body is read.
+        Everything else is handed to a spooled temporary file
+    """
+
+    def __init__(self, spool_size: int = SPOOL_SIZE):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_size, mode='rb+') # pylint: disable=consider-using-with
+        self._header = b''
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def write(self, data: bytes) -> int:
+        """
+            Spool part of the upload
+            :arg data: the next bytes of the upload
+            :returns: the number of bytes written
+            :rtype: int
+            :throws: UnsupportedMediaError if the upload does not start like a supported image
+        """
+        if len(self._header) < SIGNATURE_LENGTH:
+            self._header += data[:SIGNATURE_LENGTH - len(self._header)]
+            if len(self._header) == SIGNATURE_LENGTH and sniff_image_type(self._header) is None:
+                raise UnsupportedMediaError("The upload is not a supported image")
+        return self._file.write(data)
@@ -0,0 +1,359 @@
+"""
+    :module_name: shared
+    :module_summary: a fixed size cache shared by every worker process on a machine
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from .cache import ExpiringLRUCache
+
+LOGGER = logging.getLogger('gunicorn.error')
+
+_MISSING = object()
+_EMPTY = (0, 0.0, b'', b'')
+
+class SharedCache: # pylint: disable=too-many-instance-attributes
+    """
+        A cache kept in a memory mapped file, so every process that opens the same file
+        shares its entries. The file holds a fixed size hash table of `capacity` slots of
+        `slot_size` bytes each. A key may live in any of the `PROBES` slots after its hash,
+        and when they are all taken the CLOCK algorithm picks one to evict: slots read
+        since the clock last passed them get a second chance. Keys and values are pickled,
+        and values too large for a slot are not cached, only counted. A file is sized for
+        its layout when it is made and never resized, since other processes may have it
+        mapped, so a file laid out for other settings is refused.
+
+        Reads take no lock. Each slot carries a sequence number that writers make odd
+        while they change the slot and even again when they are done, so a reader that
+        sees the number change, or sees it odd, knows its copy is torn and treats the
+        lookup as a miss. Writers take turns through an exclusive lock on the file.
+        Clearing the cache bumps a generation number instead of touching every slot.
+
+        Each process opens and maps the file for itself the first time it uses the cache,
+        so a cache made before workers are forked (gunicorn --preload) still keeps them
+        out of each other's way. Values are unpickled from the file, so it is made readable
+        by its owner only, a file that belongs to anybody else is refused, and the
+        directory it lives in must not be writable by other users
+    """
+    PROBES = 8
+    READ_ATTEMPTS = 3
+    _HEADER = struct.Struct('<Q')
+    _SLOT = struct.Struct('<QQQdIHBx')
+    _SEQUENCE = struct.Struct('<Q')
+
+    def __init__(self, path: str, capacity: int, ttl: float = None, slot_size: int = 512):
+        if slot_size <= self._SLOT.size:
+            raise ValueError(f"Slots of {slot_size} bytes cannot hold any entry")
+        self._capacity = capacity
+        self._ttl = ttl
+        self._slot_size = slot_size
+        self._hits = 0
+        self._misses = 0
+        self._oversize = 0
+        self._path = path
+        self._size = self._HEADER.size + capacity * slot_size
+        self._pid = None
+        self._fd = None
+        self._mapped = None
+        self._lock = threading.Lock()
+        self._attaching = threading.Lock()
+        # opening the file once up front finds an unusable path before any worker needs it
+        os.close(self._open())
+
+    def __len__(self) -> int:
+        generation = self._generation()
+        return sum(
+            1 for slot in range(self._capacity)
+            if self._live(self._header(slot), generation)
+        )
+
+    def close(self) -> None:
+        """
+            Unmap the cache file. The entries stay available to other processes
+            :returns: nothing
+            :rtype: NoneType
+        """
+        with self._attaching:
+            if self._pid == os.getpid():
+                self._mapped.close()
+                os.close(self._fd)
+            self._pid, self._fd, self._mapped = None, None, None
+
+    def get(self, key, default=None):
+        """
+            Look up a cached value
+            :arg key: the key the value was stored under
+            :arg default: what to return if the key is missing or expired (defaults to None)
+            :returns: the cached value
+            :rtype: any
+        """
+        packed = self._pack(key)
+        digest = self._digest(packed)
+        generation = self._generation()
+        for slot in self._window(digest):
+            value = self._read(slot, digest, packed, generation)
+            if value is not _MISSING:
+                self._hits += 1
+                return value
+        self._misses += 1
+        return default
+
+    def put(self, key, value, ttl: float = None) -> None:
+        """
+            Store a value, evicting another entry if the key's slots are all taken
+            :arg key: the key to store the value under
+            :arg value: the value to cache
+            :arg ttl: seconds until the entry expires (defaults to the cache's ttl)
+            :returns: nothing
+            :rtype: NoneType
+        """
+        packed = self._pack(key)
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = self._digest(packed)
+        ttl = self._ttl if ttl is None else ttl
+        expires_at = 0.0 if ttl is None else time.time() + ttl
+        with self._locked():
+            generation = self._generation()
+            slot = self._find(digest, packed, generation)
+            if self._SLOT.size + len(packed) + len(payload) > self._slot_size:
+                if slot is not None:
+                    self._write(slot, generation, _EMPTY)
+                self._oversize += 1
+                return
+            if slot is None:
+                slot = self._victim(digest, generation)
+            self._write(slot, generation, (digest, expires_at, packed, payload))
+
+    def invalidate(self, key) -> None:
+        """
+            Forget a cached value, if there is one
+            :arg key: the key to forget
+            :returns: nothing
+            :rtype: NoneType
+        """
+        packed = self._pack(key)
+        with self._locked():
+            generation = self._generation()
+            slot = self._find(self._digest(packed), packed, generation)
+            if slot is not None:
+                self._write(slot, generation, _EMPTY)
+
+    def invalidate_matching(self, predicate: callable) -> None:
+        """
+            Forget every cached value whose key satisfies the predicate
+            :arg predicate: called with each key, returns True for keys to forget
+            :returns: nothing
+            :rtype: NoneType
+        """
+        with self._locked():
+            generation = self._generation()
+            for slot in range(self._capacity):
+                header = self._header(slot)
+                if not self._live(header, generation):
+                    continue
+                start = self._offset(slot) + self._SLOT.size
+                if predicate(pickle.loads(self._map[start:start + header[5]])):
+                    self._write(slot, generation, _EMPTY)
+
+    def clear(self) -> None:
+        """
+            Forget every cached value
+            :returns: nothing
+            :rtype: NoneType
+        """
+        with self._locked():
+            self._HEADER.pack_into(self._map, 0, self._generation() + 1)
+
+    def stats(self) -> dict:
+        """
+            Report how full the cache is and how often this process found what it wanted
+            :returns: cache statistics
+            :rtype: dict
+        """
+        lookups = self._hits + self._misses
+        return {
+            'size': len(self),
+            'capacity': self._capacity,
+            'hits': self._hits,
+            'misses': self._misses,
+            'oversize': self._oversize,
+            'hit_rate': self._hits / lookups if lookups else 0.0
+        }
+
+    @property
+    def _map(self) -> mmap.mmap:
+        if self._pid != os.getpid():
+            return self._attach()
+        return self._mapped
+
+    def _attach(self) -> mmap.mmap:
+        # flock belongs to the open file description, which a forked child shares with its
+        # parent, so a file opened before a fork would let both hold the lock at once
+        with self._attaching:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    # only this process's copies of the parent's handles are closed
+                    self._mapped.close()
+                    os.close(self._fd)
+                self._lock = threading.Lock()
+                self._fd = self._open()
+                self._mapped = mmap.mmap(self._fd, self._size)
+                self._pid = os.getpid()
+        return self._mapped
+
+    def _open(self) -> int:
+        descriptor = os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            if os.fstat(descriptor).st_uid != os.getuid():
+                raise PermissionError(f"{self._path} belongs to another user")
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(descriptor).st_size
+                if size == 0:
+                    os.ftruncate(descriptor, self._size)
+                elif size != self._size:
+                    # shrinking a file another process has mapped would crash it
+                    raise OSError(f"{self._path} is laid out for another cache")
+            finally:
+                fcntl.flock(descriptor, fcntl.LOCK_UN)
+        except OSError:
+            os.close(descriptor)
+            raise
+        return descriptor
+
+    @contextmanager
+    def _locked(self):
+        # file locks keep other processes out, but not other threads of this one
+        if self._pid != os.getpid():
+            self._attach()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _pack(key) -> bytes:
+        return pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _digest(packed: bytes) -> int:
+        # python's own hash differs between processes, so it cannot place shared entries.
+        # zero marks an empty slot
+        return int.from_bytes(hashlib.blake2b(packed, digest_size=8).digest(), 'little') or 1
+
+    def _generation(self) -> int:
+        return self._HEADER.unpack_from(self._map, 0)[0]
+
+    def _offset(self, slot: int) -> int:
+        return self._HEADER.size + slot * self._slot_size
+
+    def _window(self, digest: int) -> list:
+        first = digest % self._capacity
+        return [(first + i) % self._capacity for i in range(min(self.PROBES, self._capacity))]
+
+    def _header(self, slot: int) -> tuple:
+        # sequence, digest, generation, expires at, value length, key length, referenced
+        return self._SLOT.unpack_from(self._map, self._offset(slot))
+
+    @staticmethod
+    def _live(header: tuple, generation: int) -> bool:
+        _, digest, slot_generation, expires_at, _, _, _ = header
+        return (digest != 0 and slot_generation == generation and
+                (expires_at == 0.0 or expires_at > time.time()))
+
+    def _read(self, slot: int, digest: int, packed: bytes, generation: int):
+        offset = self._offset(slot)
+        for _ in range(self.READ_ATTEMPTS):
+            header = self._header(slot)
+            if header[0] % 2:
+                continue # a writer is busy with this slot
+            if header[1] != digest or not self._live(header, generation):
+                return _MISSING
+            start = offset + self._SLOT.size
+            data = self._map[start:start + header[5] + header[4]]
+            if self._SEQUENCE.unpack_from(self._map, offset)[0] != header[0]:
+                continue # the slot changed while it was being copied
+            if data[:header[5]] != packed:
+                return _MISSING
+            if not header[6]:
+                # racing another reader here is harmless, both mean to set it
+                self._map[offset + self._SLOT.size - 2] = 1
+            return pickle.loads(data[header[5]:])
+        return _MISSING
+
+    def _find(self, digest: int, packed: bytes, generation: int):
+        for slot in self._window(digest):
+            header = self._header(slot)
+            if header[1] == digest and self._live(header, generation):
+                start = self._offset(slot) + self._SLOT.size
+                if self._map[start:start + header[5]] == packed:
+                    return slot
+        return None
+
+    def _victim(self, digest: int, generation: int) -> int:
+        window = self._window(digest)
+        for slot in window:
+            if not self._live(self._header(slot), generation):
+                return slot
+        for slot in window:
+            offset = self._offset(slot)
+            if not self._map[offset + self._SLOT.size - 2]:
+                return slot
+            self._map[offset + self._SLOT.size - 2] = 0
+        return window[0]
+
+    def _write(self, slot: int, generation: int, entry: tuple) -> None:
+        # entry is the digest, expiry, packed key and pickled value to store
+        digest, expires_at, packed, payload = entry
+        offset = self._offset(slot)
+        sequence = self._SEQUENCE.unpack_from(self._map, offset)[0]
+        self._SEQUENCE.pack_into(self._map, offset, sequence + 1)
+        start = offset + self._SLOT.size
+        self._map[start:start + len(packed) + len(payload)] = packed + payload
+        self._SLOT.pack_into(self._map, offset, sequence + 1, digest, generation, expires_at,
+                             len(payload), len(packed), 0)
+        self._SEQUENCE.pack_into(self._map, offset, sequence + 2)
+
+def region_cache(region: str, capacity: int, ttl: float = None, slot_size: int = 512,
+                 max_bytes: int = None):
+    """
+        A cache for the named region. When SHAREDCACHEDIR is set, the region is kept in a
+        SharedCache file in that directory, shared by every worker on the machine. The file
+        is named after the region and its layout, so workers started with other settings
+        keep to a file of their own. Cached values are unpickled, so the directory must
+        only be writable by the service's user.
+        Otherwise, or if the file cannot be opened, each process gets its own
+        ExpiringLRUCache
+        :arg region: the name of the cache region
+        :arg capacity: the most entries the cache holds
+        :arg ttl: seconds until entries expire (defaults to never)
+        :arg slot_size: bytes each shared entry may take up (defaults to 512)
+        :arg max_bytes: the most bytes of values the cache holds, for caches of bytes
+                        (defaults to no limit). A shared cache gets as many slots as fit
+        :returns: a cache
+        :rtype: SharedCache or ExpiringLRUCache
+    """
+    directory = os.getenv('SHAREDCACHEDIR')
+    if directory and capacity > 0:
+        try:
+            if max_bytes is not None:
+                capacity = max(1, min(capacity, max_bytes // slot_size))
+            return SharedCache(
+                os.path.join(directory, f"sliceoflife-{region}-{capacity}x{slot_size}.cache"),
+                capacity, ttl=ttl, slot_size=slot_size
+            )
+        except OSError as exc:
+            LOGGER.error("Could not share the %s cache, keeping it local: %s", region, str(exc))
+    return ExpiringLRUCache(capacity, ttl=ttl, max_bytes=max_bytes)
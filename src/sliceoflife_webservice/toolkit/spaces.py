@@ -4,33 +4,69 @@
     :module_author: Nathan Mendoza (nathancm@uci.edu)
 """
 
+import hashlib
 import logging
 import os
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 
-from ..exceptions import ServiceNotReachable
+from ..exceptions import ServiceNotReachable, ContentNotFoundError, ConfigurationError
+from .shared import region_cache
+from .media import IMAGE_TYPES
+from .storage import StorageBackend, S3Storage, LocalStorage
 
 LOGGER = logging.getLogger('gunicorn.error')
 
-class SpaceIndex:
+class SpaceIndex: # pylint: disable=too-many-instance-attributes
     """
-        Class that can communicate and accomplish tasks with CDN APIs
+        Class that can communicate and accomplish tasks with CDN APIs. Files are kept in an
+        S3 compatible object store, or in a local directory when SPACES_BACKEND is "local".
+        Local files are served by the API at SPACES_LOCAL_URL (BASE_URL, if unset) through
+        links signed with SPACES_LOCAL_KEY
     """
     SPACES_BUCKET="blob-sliceoflife"
     SPACES_SHARE_TIME=300
+    SPACES_AVATAR_SHARE_TIME=3600
+    SPACES_SHARE_MARGIN=60
+    SPACES_LINK_CACHE=4096
+    SPACES_UPLOAD_TIME=900
+    SPACES_PART_SIZE=8 * 1024 * 1024
+    SPACES_UPLOAD_THREADS=2
+    SPACES_HASH_CHUNK=1024 * 1024
 
     def __init__(self, **config):
         self._region = config.get("SPACES_REGION", os.getenv("SPACES_REGION"))
         self._endpoint = config.get("SPACES_ENDPOINT", os.getenv("SPACES_ENDPOINT"))
         self._access_key = config.get("SPACES_KEY", os.getenv("SPACES_KEY"))
         self._access_secret = config.get("SPACES_SECRET", os.getenv("SPACES_SECRET"))
+        self._backend = config.get("SPACES_BACKEND", os.getenv("SPACES_BACKEND", "s3"))
+        self._root = config.get("SPACES_ROOT", os.getenv("SPACES_ROOT", "spaces"))
+        self._local_url = config.get("SPACES_LOCAL_URL",
+                                     os.getenv("SPACES_LOCAL_URL", os.getenv("BASE_URL")))
+        self._local_key = config.get("SPACES_LOCAL_KEY", os.getenv("SPACES_LOCAL_KEY"))
         self._session = None
+        self._storage = None
+        self._links = region_cache(
+            'links',
+            int(config.get("SPACES_LINK_CACHE", os.getenv("SPACES_LINK_CACHE",
+                                                          str(self.SPACES_LINK_CACHE)))),
+            slot_size=2048
+        )
 
     def create_session(self) -> None:
         """
             Creates a new session with the sliceoflife CDN
+            :throws: ConfigurationError if files are kept locally without a URL or signing key
         """
+        if self._backend == 'local':
+            if not self._local_url or not self._local_key:
+                raise ConfigurationError(
+                    "Local storage needs SPACES_LOCAL_URL (or BASE_URL) and SPACES_LOCAL_KEY"
+                )
+            self._storage = LocalStorage(self._root, self._local_url, self._local_key)
+            LOGGER.info("New space index session to %s", self._root)
+            return
         self._session = boto3.session.Session().client(
             's3',
             endpoint_url=self._endpoint,
@@ -38,53 +74,232 @@ class SpaceIndex:
             aws_access_key_id=self._access_key,
             aws_secret_access_key=self._access_secret
         )
+        self._storage = S3Storage(
+            self._session,
+            self.SPACES_BUCKET,
+            TransferConfig(
+                multipart_threshold=self.SPACES_PART_SIZE,
+                multipart_chunksize=self.SPACES_PART_SIZE,
+                max_concurrency=self.SPACES_UPLOAD_THREADS
+            )
+        )
         LOGGER.info("New space index session to %s", self._endpoint)
 
     def has_active_session(self) -> bool:
         """
             Returns true if this space index has an active session, otherwise false
         """
-        return bool(self._session)
+        return bool(self._storage)
+
+    @property
+    def storage(self) -> StorageBackend:
+        """
+            The backend files are kept in
+            :returns: the active storage backend
+            :rtype: StorageBackend
+            :throws: ServiceNotReachable if no session is active
+        """
+        if not self._storage:
+            raise ServiceNotReachable("No session exists to interact with application CDN")
+        return self._storage
+
+    def local_storage(self) -> LocalStorage:
+        """
+            The local directory files are kept in, when files are served by the API itself
+            :returns: the active storage backend
+            :rtype: LocalStorage
+            :throws: ContentNotFoundError if files are not kept locally
+        """
+        if not isinstance(self._storage, LocalStorage):
+            raise ContentNotFoundError("Files are not served by this API")
+        return self._storage
 
-    def get_share_link(self, path_to_file: str) -> str:
+    def get_share_link(self, path_to_file: str, share_time: int = None) -> str:
         """
-            get a sharable link to the given file path
+            get a sharable link to the given file path. Links are reused for as long as they
+            stay valid for at least `SPACES_SHARE_MARGIN` more seconds, so the same file
+            keeps the same link (and browsers can cache it) for most of its lifetime
             :arg path_to_file: the file to generate a share link for
+            :arg share_time: seconds the link is valid for (defaults to SPACES_SHARE_TIME)
             :returns: sharelink
             :rtype: str
             :throws: ServiceNotReachable if no sesssion is active
         """
 
-        if not self._session:
-            raise ServiceNotReachable("No session exists to interact with application CDN")
+        storage = self.storage
+        share_time = self.SPACES_SHARE_TIME if share_time is None else share_time
+        link = self._links.get((path_to_file, share_time))
+        if link is not None:
+            return link
 
         LOGGER.info("Generating share link for file: %s", path_to_file)
-        return self._session.generate_presigned_url(
-            ClientMethod='get_object',
-            Params={
-                'Bucket': self.SPACES_BUCKET,
-                'Key': path_to_file
-            },
-            ExpiresIn=self.SPACES_SHARE_TIME
-        )
+        link = storage.share_link(path_to_file, share_time)
+        if share_time > self.SPACES_SHARE_MARGIN:
+            self._links.put((path_to_file, share_time), link, share_time - self.SPACES_SHARE_MARGIN)
+        return link
 
-    def save_file(self, save_as: str, file_to_save) -> None:
+    def get_upload_link(self, save_as: str, content_type: str) -> str:
         """
-            save the given file under the given name
-            :arg save_as: filename to use
+            get a link the client can PUT a file to directly, without going through the API
+            :arg save_as: filename the upload will be saved under
+            :arg content_type: the content type the client must upload with
+            :returns: upload link, valid for SPACES_UPLOAD_TIME seconds
+            :rtype: str
+            :throws: ServiceNotReachable if no session is active
+        """
+
+        storage = self.storage
+        LOGGER.info("Generating upload link for file: %s", save_as)
+        return storage.upload_link(save_as, content_type, self.SPACES_UPLOAD_TIME)
+
+    def content_key(self, file_to_save, content_type: str, prefix: str = 'images') -> str:
+        """
+            name a file after its contents, so identical files share a name. The file is
+            hashed in chunks and rewound afterwards
+            :arg file_to_save: seekable file-like object to name
+            :arg content_type: the file's content type
+            :arg prefix: folder the file belongs in (defaults to images)
+            :returns: the file's content addressed name
+            :rtype: str
+        """
+        start = file_to_save.tell()
+        key = self._digest_key(file_to_save, content_type, prefix)
+        file_to_save.seek(start)
+        return key
+
+    def stored_content_key(self, path_to_file: str, content_type: str,
+                           prefix: str = 'images') -> str:
+        """
+            name a saved file after its contents, the way `content_key` names a file that is
+            about to be saved. The file is streamed from storage in chunks
+            :arg path_to_file: the saved file to name
+            :arg content_type: the file's content type
+            :arg prefix: folder the file belongs in (defaults to images)
+            :returns: the file's content addressed name
+            :rtype: str
+            :throws: ServiceNotReachable if no session is active
+        """
+        stored = self.storage.open(path_to_file)
+        try:
+            return self._digest_key(stored, content_type, prefix)
+        finally:
+            stored.close()
+
+    def _digest_key(self, stream, content_type: str, prefix: str) -> str:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(self.SPACES_HASH_CHUNK), b''):
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        return f"{prefix}/{digest[:2]}/{digest}{IMAGE_TYPES.get(content_type, '')}"
+
+    def save_content(self, save_as: str, file_to_save, content_type: str) -> bool:
+        """
+            save a file under its content addressed name, unless a file with the same contents
+            was saved before
+            :arg save_as: the name given by `content_key`
             :arg file_to_save: file-like object to save
+            :arg content_type: the file's content type
+            :returns: whether the file was uploaded just now
+            :rtype: bool
+            :throws: ServiceNotReachable if no session is active
+        """
+        if self.file_exists(save_as):
+            LOGGER.info("Already have a copy of %s, skipping upload", save_as)
+            return False
+        self.save_file(save_as, file_to_save, content_type)
+        return True
+
+    def copy_file(self, path_to_file: str, save_as: str) -> None:
+        """
+            save a copy of a saved file under another name, without downloading it
+            :arg path_to_file: the file to copy
+            :arg save_as: filename to give the copy
             :returns: nothing
             :rtype: NoneType
             :throws: ServiceNotReachable if no session is active
         """
 
-        if not self._session:
-            raise ServiceNotReachable("no session exists to interact with application CDN")
+        storage = self.storage
+        LOGGER.info("Copying file %s to %s", path_to_file, save_as)
+        storage.copy(path_to_file, save_as)
 
-        self._session.put_object(
-            Bucket=self.SPACES_BUCKET,
-            Key=save_as,
-            Body=file_to_save,
-            ACL='private',
-            ContentType='image/*'
-        )
+    def delete_file(self, path_to_file: str) -> None:
+        """
+            delete a saved file
+            :arg path_to_file: the file to delete
+            :returns: nothing
+            :rtype: NoneType
+            :throws: ServiceNotReachable if no session is active
+        """
+
+        storage = self.storage
+        LOGGER.info("Deleting file: %s", path_to_file)
+        storage.delete(path_to_file)
+
+    def read_file(self, path_to_file: str) -> bytes:
+        """
+            read back the contents of a saved file
+            :arg path_to_file: the file to read
+            :returns: the file's contents
+            :rtype: bytes
+            :throws: ServiceNotReachable if no session is active
+        """
+
+        return self.storage.read(path_to_file)
+
+    def file_exists(self, path_to_file: str) -> bool:
+        """
+            Returns true if a file has been saved under the given name, otherwise false
+            :arg path_to_file: the file to look for
+            :returns: whether the file exists
+            :rtype: bool
+            :throws: ServiceNotReachable if no session is active or the CDN cannot be asked
+        """
+
+        return self.storage.exists(path_to_file)
+
+    def file_size(self, path_to_file: str) -> int:
+        """
+            Returns the size of a saved file in bytes, or None if there is no such file
+            :arg path_to_file: the file to measure
+            :returns: the file's size
+            :rtype: int or NoneType
+            :throws: ServiceNotReachable if no session is active or the CDN cannot be asked
+        """
+
+        return self.storage.size(path_to_file)
+
+    def read_file_start(self, path_to_file: str, length: int) -> bytes:
+        """
+            read the first bytes of a saved file, without downloading the rest
+            :arg path_to_file: the file to read
+            :arg length: how many bytes to read
+            :returns: up to `length` bytes from the start of the file
+            :rtype: bytes
+            :throws: ServiceNotReachable if no session is active
+        """
+
+        return self.storage.read_start(path_to_file, length)
+
+    def share_link_stats(self) -> dict:
+        """
+            Report how often share links were reused instead of generated
+            :returns: share link cache statistics
+            :rtype: dict
+        """
+        return self._links.stats()
+
+    def save_file(self, save_as: str, file_to_save, content_type: str = 'image/*') -> None:
+        """
+            save the given file under the given name. The file is streamed, and files larger
+            than `SPACES_PART_SIZE` are sent to object stores in parts, so at most a few parts
+            are held in memory at once
+            :arg save_as: filename to use
+            :arg file_to_save: file-like object to save
+            :arg content_type: the file's content type (defaults to image/*)
+            :returns: nothing
+            :rtype: NoneType
+            :throws: ServiceNotReachable if no session is active
+        """
+
+        self.storage.save(save_as, file_to_save, content_type)
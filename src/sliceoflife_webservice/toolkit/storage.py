@@ -0,0 +1,303 @@
+"""
+    :module_name: storage
+    :module_summary: places the sliceoflife can keep uploaded files
+    :module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import abc
+import hashlib
+import hmac
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from urllib.parse import quote
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from ..exceptions import ServiceNotReachable, AuthorizationError, ContentNotFoundError
+
+class StorageBackend(abc.ABC):
+    """
+        Interface for the places files can be kept. Keys are slash separated names
+    """
+
+    @abc.abstractmethod
+    def share_link(self, key: str, share_time: int) -> str:
+        """
+            get a link anyone can download the file from
+            :arg key: the file to share
+            :arg share_time: seconds the link is valid for
+            :returns: share link
+            :rtype: str
+        """
+
+    @abc.abstractmethod
+    def upload_link(self, key: str, content_type: str, share_time: int) -> str:
+        """
+            get a link the file can be uploaded to with a PUT request
+            :arg key: the name the upload will be saved under
+            :arg content_type: the content type the upload must be sent with
+            :arg share_time: seconds the link is valid for
+            :returns: upload link
+            :rtype: str
+        """
+
+    @abc.abstractmethod
+    def save(self, key: str, file_to_save, content_type: str) -> None:
+        """
+            save a file, replacing any file already saved under the same name
+            :arg key: the name to save the file under
+            :arg file_to_save: file-like object to save
+            :arg content_type: the file's content type
+            :returns: nothing
+            :rtype: NoneType
+        """
+
+    @abc.abstractmethod
+    def copy(self, source: str, key: str) -> None:
+        """
+            save a copy of a saved file, replacing any file already saved under the new name
+            :arg source: the file to copy
+            :arg key: the name to save the copy under
+            :returns: nothing
+            :rtype: NoneType
+        """
+
+    @abc.abstractmethod
+    def read(self, key: str) -> bytes:
+        """
+            read back the contents of a saved file
+            :arg key: the file to read
+            :returns: the file's contents
+            :rtype: bytes
+        """
+
+    @abc.abstractmethod
+    def open(self, key: str):
+        """
+            open a saved file to read it in pieces
+            :arg key: the file to read
+            :returns: a readable file-like object, to be closed by the caller
+            :rtype: file-like object
+        """
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        """
+            whether a file is saved under the given name
+            :arg key: the file to look for
+            :returns: True if the file exists
+            :rtype: bool
+        """
+
+    @abc.abstractmethod
+    def size(self, key: str) -> int:
+        """
+            how large a saved file is
+            :arg key: the file to measure
+            :returns: the file's size in bytes, or None if there is no such file
+            :rtype: int or NoneType
+        """
+
+    @abc.abstractmethod
+    def read_start(self, key: str, length: int) -> bytes:
+        """
+            read the first bytes of a saved file, without reading the rest
+            :arg key: the file to read
+            :arg length: how many bytes to read
+            :returns: up to `length` bytes from the start of the file
+            :rtype: bytes
+        """
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """
+            delete a saved file
+            :arg key: the file to delete
+            :returns: nothing
+            :rtype: NoneType
+        """
+
+class S3Storage(StorageBackend):
+    """
+        Files kept in a bucket of an S3 compatible object store, such as Spaces
+    """
+
+    def __init__(self, client, bucket: str, transfer: TransferConfig):
+        self._client = client
+        self._bucket = bucket
+        self._transfer = transfer
+
+    def share_link(self, key: str, share_time: int) -> str:
+        return self._client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={
+                'Bucket': self._bucket,
+                'Key': key
+            },
+            ExpiresIn=share_time
+        )
+
+    def upload_link(self, key: str, content_type: str, share_time: int) -> str:
+        return self._client.generate_presigned_url(
+            ClientMethod='put_object',
+            Params={
+                'Bucket': self._bucket,
+                'Key': key,
+                'ACL': 'private',
+                'ContentType': content_type
+            },
+            ExpiresIn=share_time
+        )
+
+    def save(self, key: str, file_to_save, content_type: str) -> None:
+        self._client.upload_fileobj(
+            file_to_save,
+            self._bucket,
+            key,
+            ExtraArgs={
+                'ACL': 'private',
+                'ContentType': content_type
+            },
+            Config=self._transfer
+        )
+
+    def copy(self, source: str, key: str) -> None:
+        # copied inside the store, the content type the file was uploaded with is kept
+        self._client.copy_object(
+            Bucket=self._bucket,
+            Key=key,
+            CopySource={'Bucket': self._bucket, 'Key': source},
+            ACL='private'
+        )
+
+    def read(self, key: str) -> bytes:
+        return self._client.get_object(Bucket=self._bucket, Key=key)['Body'].read()
+
+    def open(self, key: str):
+        return self._client.get_object(Bucket=self._bucket, Key=key)['Body']
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def size(self, key: str) -> int:
+        head = self._head(key)
+        return None if head is None else head['ContentLength']
+
+    def read_start(self, key: str, length: int) -> bytes:
+        return self._client.get_object(
+            Bucket=self._bucket,
+            Key=key,
+            Range=f"bytes=0-{length - 1}"
+        )['Body'].read()
+
+    def delete(self, key: str) -> None:
+        self._client.delete_object(Bucket=self._bucket, Key=key)
+
+    def _head(self, key: str) -> dict:
+        try:
+            return self._client.head_object(Bucket=self._bucket, Key=key)
+        except ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise ServiceNotReachable(f"Could not look up {key}") from exc
+
+class LocalStorage(StorageBackend):
+    """
+        Files kept in a directory on local disk and served by the API itself. Links are
+        signed with a secret so they expire just like presigned object store links
+    """
+    ROUTE = '/api/v1/files/'
+    COPY_BUFFER = 1024 * 1024
+
+    def __init__(self, root: str, base_url: str, secret: str):
+        self._root = pathlib.Path(root).resolve()
+        self._base_url = base_url.rstrip('/')
+        self._secret = secret.encode()
+
+    def share_link(self, key: str, share_time: int) -> str:
+        return self._signed_link('GET', key, '', share_time)
+
+    def upload_link(self, key: str, content_type: str, share_time: int) -> str:
+        return self._signed_link('PUT', key, content_type, share_time)
+
+    def save(self, key: str, file_to_save, content_type: str) -> None:
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write next to the destination and rename over it, so readers never see half a file
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix='.upload-', delete=False) as tmp:
+            try:
+                shutil.copyfileobj(file_to_save, tmp, self.COPY_BUFFER)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        os.replace(tmp.name, path)
+
+    def copy(self, source: str, key: str) -> None:
+        with self.path_for(source).open('rb') as stored:
+            self.save(key, stored, '')
+
+    def read(self, key: str) -> bytes:
+        return self.path_for(key).read_bytes()
+
+    def open(self, key: str):
+        return self.path_for(key).open('rb')
+
+    def exists(self, key: str) -> bool:
+        return self.path_for(key).is_file()
+
+    def size(self, key: str) -> int:
+        path = self.path_for(key)
+        return path.stat().st_size if path.is_file() else None
+
+    def read_start(self, key: str, length: int) -> bytes:
+        with self.path_for(key).open('rb') as stored:
+            return stored.read(length)
+
+    def delete(self, key: str) -> None:
+        self.path_for(key).unlink(missing_ok=True)
+
+    def path_for(self, key: str) -> pathlib.Path:
+        """
+            where a file is kept on disk
+            :arg key: the file's name
+            :returns: the file's path
+            :rtype: pathlib.Path
+            :throws: ContentNotFoundError if the name points outside of the storage directory
+        """
+        path = (self._root / key).resolve()
+        if self._root not in path.parents:
+            raise ContentNotFoundError(f"{key} is not a stored file")
+        return path
+
+    def verify(self, method: str, key: str, args: dict, content_type: str = '') -> None:
+        """
+            check a request made with a signed link
+            :arg method: the request's method
+            :arg key: the file requested
+            :arg args: the request's query arguments
+            :arg content_type: the request's content type, for uploads (defaults to '')
+            :returns: nothing
+            :rtype: NoneType
+            :throws: AuthorizationError if the link was not signed for the request, or expired
+        """
+        expires = args.get('expires', '')
+        expected = self._signature(method, key, content_type, expires)
+        if not hmac.compare_digest(expected, args.get('signature', '')):
+            raise AuthorizationError(f"Link to {key} is not signed for this request")
+        if not expires.isdigit() or int(expires) < time.time():
+            raise AuthorizationError(f"Link to {key} has expired")
+
+    def _signed_link(self, method: str, key: str, content_type: str, share_time: int) -> str:
+        expires = str(int(time.time()) + share_time)
+        signature = self._signature(method, key, content_type, expires)
+        return f"{self._base_url}{self.ROUTE}{quote(key)}?expires={expires}&signature={signature}"
+
+    def _signature(self, method: str, key: str, content_type: str, expires: str) -> str:
+        message = f"{method}\n{key}\n{content_type}\n{expires}".encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
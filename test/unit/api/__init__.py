@@ -49,6 +49,10 @@ def mock_db():
     }
 
 def lookup_db(conn, query):
+    if query.name == 'latest_post_version':
+        return ((max(post[0] for post in mock_db()['posts']),),)
+    if set(query.parameters.keys()) == {'referencedimage'}:
+        return ((len([post for post in mock_db()['posts'] if post[2] == query.parameters['referencedimage']]),),)
     if set(query.parameters.keys()) == {'limit', 'offset'}:
         return mock_db()['posts'][query.parameters['offset']:query.parameters['offset'] + query.parameters['limit']]
     if set(query.parameters.keys()) == {'handle'}:
@@ -56,6 +60,27 @@ def lookup_db(conn, query):
             if user[0] == query.parameters['handle']:
                 return (user,)
         return tuple()
+    if set(query.parameters.keys()) == {'limit'}:
+        return tuple(sorted(mock_db()['posts'], key=lambda post: (post[3], post[0]), reverse=True)[:query.parameters['limit']])
+    if set(query.parameters.keys()) == {'limit', 'aftertime', 'afterpost'}:
+        after = (query.parameters['aftertime'], query.parameters['afterpost'])
+        return tuple([
+            post
+            for post in sorted(mock_db()['posts'], key=lambda post: (post[3], post[0]), reverse=True)
+            if (post[3], post[0]) < after
+        ][:query.parameters['limit']])
+    if set(query.parameters.keys()) == {'handles'}:
+        return tuple([
+            user
+            for user in mock_db()['users']
+            if user[0] in query.parameters['handles']
+        ])
+    if set(query.parameters.keys()) == {'taskids'}:
+        return tuple([
+            task
+            for task in mock_db()['tasks']
+            if task[0] in query.parameters['taskids']
+        ])
     if set(query.parameters.keys()) == {'taskid'}:
         for task in mock_db()['tasks']:
             if task[0] == query.parameters['taskid']:
@@ -78,6 +103,24 @@ def lookup_db(conn, query):
             for comment in mock_db()['comments']
             if comment[5] == query.parameters['commentto'] and comment[3] == query.parameters['commentid']
         ])
+    if set(query.parameters.keys()) == {'forestof'}:
+        users = {user[0]: user for user in mock_db()['users']}
+        level = [
+            comment
+            for comment in mock_db()['comments']
+            if comment[5] == query.parameters['forestof'] and comment[3] is None
+        ]
+        forest = []
+        while level:
+            level.sort(key=lambda comment: comment[1])
+            forest.extend(level)
+            parents = {comment[0] for comment in level}
+            level = [
+                comment
+                for comment in mock_db()['comments']
+                if comment[5] == query.parameters['forestof'] and comment[3] in parents
+            ]
+        return tuple(comment + users[comment[4]] for comment in forest)
     if set(query.parameters.keys()) == {'reactto'}:
         result = []
         seen = set()
@@ -86,6 +129,16 @@ def lookup_db(conn, query):
                result.append(reaction)
                seen.add(reaction[1])
         return tuple(result)
+    if set(query.parameters.keys()) == {'summaryof', 'reactorcap'}:
+        groups = {}
+        for reaction in sorted(mock_db()['reactions']):
+            if reaction[3] == query.parameters['summaryof']:
+                groups.setdefault(reaction[1], []).append(reaction[2])
+        return tuple([
+            (emoji, len(reactors), len(set(reactors)),
+             list(dict.fromkeys(reactors))[:query.parameters['reactorcap']])
+            for emoji, reactors in sorted(groups.items())
+        ])
     if set(query.parameters.keys()) == {'reactto', 'codecount'}:
         count = len([
             reaction
@@ -108,6 +161,14 @@ def lookup_db(conn, query):
                            if completion[0] == query.parameters['completes']
                            ]
         ])
+    if set(query.parameters.keys()) == {'completedby'}:
+        return ((sorted(
+            completion[1]
+            for completion in mock_db()['completions']
+            if completion[0] == query.parameters['completedby']
+        ),),)
+    if not query.parameters:
+        return tuple(sorted(mock_db()['tasks']))
     if set(query.parameters.keys()) == {'incompletes'}:
         return tuple([
             task
@@ -7,18 +7,19 @@
 import json
 import datetime
 import time
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 from freezegun import freeze_time
 from flask import Response
 
 from sliceoflife_webservice import app
-from sliceoflife_webservice.api import BaseSliceOfLifeApiResponse, DBCONNECTIONS
-from sliceoflife_webservice.dbtools import Instance
+from sliceoflife_webservice.api import BaseSliceOfLifeApiResponse, DBCONNECTIONS, DBMINCONNECTIONS
+from sliceoflife_webservice.dbtools import Instance, InvalidationBus, invalidation_message
 from sliceoflife_webservice.toolkit import SpaceIndex
 from sliceoflife_webservice.exceptions import ContentNotFoundError, AuthorizationError, \
-                                              ServiceNotReachable, SliceOfLifeAPIException
+                                              ServiceNotReachable, SliceOfLifeAPIException, \
+                                              UploadTooLargeError, UnsupportedMediaError
 
 @pytest.fixture
 def mock_auth_token():
@@ -33,16 +34,41 @@ def test_shared_service_classes_not_defined_initially():
 
 def test_shared_instance_created_on_demand():
     res = BaseSliceOfLifeApiResponse()
-    with patch('psycopg2.connect') as mock_connect:
+    with patch('psycopg2.connect', side_effect=lambda **kwargs: MagicMock()) as mock_connect:
         assert isinstance(res.instance, Instance)
-        assert len(res.instance._pool) == DBCONNECTIONS
+        assert len(res.instance._pool) == DBMINCONNECTIONS
+        assert res.instance.stats()['max_size'] + res.instance.stats(read_only=True)['max_size'] \
+            == DBCONNECTIONS
+        assert res.instance.stats(read_only=True)['max_size'] == DBCONNECTIONS // 2
+
+@pytest.mark.parametrize('budget, reads, expected', [
+    (10, None, (5, 5)),
+    (10, '', (5, 5)),
+    (10, '3', (7, 3)),
+    (3, None, (2, 1))
+])
+def test_connection_budget_is_split(budget, reads, expected):
+    assert BaseSliceOfLifeApiResponse._split_connections(budget, reads) == expected
+
+@pytest.mark.parametrize('budget, reads', [(1, None), (10, '10'), (10, '0')])
+def test_connection_budget_leaves_room_for_both_pools(budget, reads):
+    with pytest.raises(ValueError):
+        BaseSliceOfLifeApiResponse._split_connections(budget, reads)
+
+@pytest.mark.parametrize('replicas, expected', [
+    ('', []),
+    ('replica1:5432', [{'host': 'replica1', 'port': '5432'}]),
+    ('replica1:5432, replica2', [{'host': 'replica1', 'port': '5432'}, {'host': 'replica2'}])
+])
+def test_replica_settings(replicas, expected):
+    assert BaseSliceOfLifeApiResponse._replica_settings(replicas) == expected
 
 def test_shared_spaces_created_on_demand():
     res = BaseSliceOfLifeApiResponse()
     assert isinstance(res.spaces, SpaceIndex)
     assert res.spaces.has_active_session()
 
-@pytest.mark.parametrize('outcome', [0, 1, 2, 3, 4, 5])
+@pytest.mark.parametrize('outcome', [0, 1, 2, 3, 4, 5, 6, 7])
 def test_safe_callback_decorator(outcome):
     @BaseSliceOfLifeApiResponse.safe_api_callback
     def mock_response_function(res: int):
@@ -58,6 +84,10 @@ def test_safe_callback_decorator(outcome):
             raise KeyError()
         if res == 4:
             raise ServiceNotReachable()
+        if res == 6:
+            raise UploadTooLargeError()
+        if res == 7:
+            raise UnsupportedMediaError()
         raise SliceOfLifeAPIException()
     outcomes = {
         0: Response(response='{"key":"value"}\n', status=200),
@@ -65,12 +95,23 @@ def test_safe_callback_decorator(outcome):
         2: Response(response="Not authorized", status=401),
         3: Response(response="Bad request", status=400),
         4: Response(response="Bad gateway", status=504),
-        5: Response(response="Internal server error", status=500)
+        5: Response(response="Internal server error", status=500),
+        6: Response(response="Payload too large", status=413),
+        7: Response(response="Unsupported media type", status=415)
     }
     with app.test_request_context('/', method='GET'):
         assert mock_response_function(outcome).get_data() == outcomes[outcome].get_data()
         assert mock_response_function(outcome).status == outcomes[outcome].status
 
+def test_authenticated_handle(mock_auth_token):
+    with app.test_request_context('/', method='GET'):
+        assert BaseSliceOfLifeApiResponse().authenticated_handle() is None
+    with app.test_request_context('/', method='GET', headers={'x-auth-token': 'garbage'}):
+        assert BaseSliceOfLifeApiResponse().authenticated_handle() is None
+    with freeze_time(datetime.datetime.utcnow() + datetime.timedelta(seconds=3)):
+        with app.test_request_context('/', method='GET', headers={'x-auth-token': mock_auth_token}):
+            assert BaseSliceOfLifeApiResponse().authenticated_handle() == 'user'
+
 def test_create_JWTs(mock_auth_token):
     assert isinstance(mock_auth_token, str)
 
@@ -98,3 +139,35 @@ def test_missing_JWT():
     with app.test_request_context('/api/users/authenticate', method='POST'):
         with pytest.raises(AuthorizationError):
             BaseSliceOfLifeApiResponse().verify_auth_token('user')
+
+def test_announced_changes_are_sent_with_the_transaction():
+    res = BaseSliceOfLifeApiResponse()
+    with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch:
+        res.announce_change('profiles', 'user1')
+        query = mock_query_no_fetch.call_args[0][1]
+        assert query.parameters['channel'] == res.invalidation_channel
+        assert json.loads(query.parameters['payload']) == {'region': 'profiles', 'key': 'user1'}
+
+def test_invalidation_bus_clears_caches():
+    with patch.object(InvalidationBus, 'start') as mock_start:
+        with patch.object(BaseSliceOfLifeApiResponse, '_bus', None):
+            with patch.object(BaseSliceOfLifeApiResponse, '_instance', MagicMock()):
+                bus = BaseSliceOfLifeApiResponse.start_invalidation_bus()
+                assert BaseSliceOfLifeApiResponse.start_invalidation_bus() is bus
+        assert mock_start.call_count == 2
+    BaseSliceOfLifeApiResponse._profiles.put('user1', 'profile')
+    BaseSliceOfLifeApiResponse._profiles.put('user2', 'profile')
+    BaseSliceOfLifeApiResponse._responses.put(('latest', (), (), 1), b'page')
+    BaseSliceOfLifeApiResponse._responses.put(('slice', (1,), (), 1), b'slice')
+    BaseSliceOfLifeApiResponse._tasks.put(1, 'task')
+    bus.dispatch(invalidation_message('profiles', 'user1'))
+    bus.dispatch(invalidation_message('responses', 'latest'))
+    assert BaseSliceOfLifeApiResponse._profiles.get('user1') is None
+    assert BaseSliceOfLifeApiResponse._profiles.get('user2') == 'profile'
+    assert BaseSliceOfLifeApiResponse._responses.get(('latest', (), (), 1)) is None
+    assert BaseSliceOfLifeApiResponse._responses.get(('slice', (1,), (), 1)) == b'slice'
+    bus.dispatch(invalidation_message('tasks'))
+    bus.dispatch(invalidation_message('profiles'))
+    assert BaseSliceOfLifeApiResponse._tasks.get(1) is None
+    assert BaseSliceOfLifeApiResponse._profiles.get('user2') is None
+    BaseSliceOfLifeApiResponse._responses.clear()
@@ -4,18 +4,35 @@
     module_author: Nathan Mendoza (nathancm@uci.edu)
 """
 
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 
 import pytest
+from freezegun import freeze_time
 
 from sliceoflife_webservice.dbtools import Instance
-from sliceoflife_webservice.toolkit import SpaceIndex
+from sliceoflife_webservice.toolkit import SpaceIndex, ImagePipeline
 from sliceoflife_webservice.api.get import SliceOfLifeApiGetResponse
 from sliceoflife_webservice import app
 
 from . import lookup_db
 
+@pytest.fixture(autouse=True)
+def clear_record_caches():
+    """Start each test without records or responses cached by earlier tests"""
+    SliceOfLifeApiGetResponse._profiles.clear()
+    SliceOfLifeApiGetResponse._tasks.clear()
+    SliceOfLifeApiGetResponse._catalog.invalidate()
+    SliceOfLifeApiGetResponse._responses.clear()
+    SliceOfLifeApiGetResponse._post_images.clear()
+    yield
+    SliceOfLifeApiGetResponse._profiles.clear()
+    SliceOfLifeApiGetResponse._tasks.clear()
+    SliceOfLifeApiGetResponse._catalog.invalidate()
+    SliceOfLifeApiGetResponse._responses.clear()
+    SliceOfLifeApiGetResponse._post_images.clear()
 
 def test_greeting_response():
     with app.test_request_context('/api/v1/greeting', method='GET'):
@@ -36,10 +53,44 @@ def test_latest_posts_response(limit, offset, result):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_latest_posts().get_data() == result
                 assert SliceOfLifeApiGetResponse().get_latest_posts().status == '200 OK'
 
+@pytest.mark.parametrize('limit', [1, 2, 3, 4, 5])
+def test_latest_posts_cursor_pages(limit):
+    seen = []
+    path = f'/slices/latest?limit={limit}&cursor='
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            for _ in range(5):
+                with app.test_request_context(path, method='GET'):
+                    response = SliceOfLifeApiGetResponse().get_latest_posts()
+                    assert response.status == '200 OK'
+                    page = response.get_json()
+                    seen.extend(post['post_id'] for post in page['page'])
+                    assert 'offset' not in page['next']
+                    path = page['next'].replace('http://127.0.0.1:8000/api/v1', '')
+    assert seen == [1, 2, 3, 4]
+
+def test_latest_posts_malformed_cursor():
+    with app.test_request_context('/slices/latest?cursor=not-a-cursor', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            mock_query.side_effect = lookup_db
+            assert SliceOfLifeApiGetResponse().get_latest_posts().status == '400 BAD REQUEST'
+
+@pytest.mark.parametrize('limit', [1, 2, 4])
+def test_latest_posts_query_count_is_constant(limit):
+    with app.test_request_context(f'/slices/latest?limit={limit}', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                assert SliceOfLifeApiGetResponse().get_latest_posts().status == '200 OK'
+                assert mock_query.call_count == 4 # version, page, authors and tasks
+
 @pytest.mark.parametrize('sliceid, result', [
     (1, b'{"completes":{"active":true,"description":"task2 description","task_id":2,"title":"task2"},"created_at":"Thu, 15 Dec 2022 00:00:00 GMT","free_text":"post text 1","image":"post pic 1","post_id":1,"posted_by":{"email":"***","first_name":"user1first","handle":"user1","last_name":"user1last","password_hash":"***","profile_pic":"user1.png","salt":"***"}}\n'),
     (2, b'{"completes":{"active":true,"description":"task3 description","task_id":3,"title":"task3"},"created_at":"Thu, 08 Dec 2022 00:00:00 GMT","free_text":"post text 2","image":"post pic 2","post_id":2,"posted_by":{"email":"***","first_name":"user1first","handle":"user1","last_name":"user1last","password_hash":"***","profile_pic":"user1.png","salt":"***"}}\n'),
@@ -51,7 +102,7 @@ def test_slice_by_id_response(sliceid, result):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_slice_by_id(sliceid).get_data() == result
                 assert SliceOfLifeApiGetResponse().get_slice_by_id(sliceid).status == '200 OK'
 
@@ -66,31 +117,59 @@ def test_comment_tree_building(postid, result):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_comments_for_slice(postid).get_data() == result
                 assert SliceOfLifeApiGetResponse().get_comments_for_slice(postid).status == '200 OK'
 
+@pytest.mark.parametrize('postid', [1, 2, 3, 4])
+def test_comment_tree_built_from_single_query(postid):
+    with app.test_request_context(f'/slices/{postid}/comments', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                assert SliceOfLifeApiGetResponse().get_comments_for_slice(postid).status == '200 OK'
+                assert mock_query.call_count == 2 # post lookup and comment forest
+
 @pytest.mark.parametrize('postid, result', [
-    (1, b'[{"count":1,"reaction":"code1","reactors":["user2"]}]\n'),
-    (2, b'[{"count":1,"reaction":"code2","reactors":["user2"]}]\n'),
-    (3, b'[{"count":2,"reaction":"code2","reactors":["user1","user2"]}]\n'),
-    (4, b'[{"count":1,"reaction":"code1","reactors":["user1"]},{"count":1,"reaction":"code2","reactors":["user1"]}]\n')
+    (1, b'[{"count":1,"reaction":"code1","reactors":["user2"],"total_reactors":1}]\n'),
+    (2, b'[{"count":1,"reaction":"code2","reactors":["user2"],"total_reactors":1}]\n'),
+    (3, b'[{"count":2,"reaction":"code2","reactors":["user1","user2"],"total_reactors":2}]\n'),
+    (4, b'[{"count":1,"reaction":"code1","reactors":["user1"],"total_reactors":1},{"count":1,"reaction":"code2","reactors":["user1"],"total_reactors":1}]\n')
 ])
 def test_gather_reaction_stats(postid, result):
     with app.test_request_context(f'/slices/{postid}/reactions', method='GET'):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_reactions_for_slice(postid).get_data() == result
                 assert SliceOfLifeApiGetResponse().get_reactions_for_slice(postid).status == '200 OK'
 
+def test_reaction_stats_with_reactor_limit():
+    with app.test_request_context('/slices/3/reactions?max_reactors=1', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                assert SliceOfLifeApiGetResponse().get_reactions_for_slice(3).get_data() == \
+                    b'[{"count":2,"reaction":"code2","reactors":["user1"],"total_reactors":2}]\n'
+                assert mock_query.call_count == 2 # post lookup and reaction summary
+
+@pytest.mark.parametrize('limit', ['abc', '1.5'])
+def test_reaction_stats_with_malformed_reactor_limit(limit):
+    with app.test_request_context(f'/slices/3/reactions?max_reactors={limit}', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            mock_query.side_effect = lookup_db
+            assert SliceOfLifeApiGetResponse().get_reactions_for_slice(3).status == '400 BAD REQUEST'
+            assert mock_query.call_count == 0
+
 def test_nonexistant_slice_response():
     with app.test_request_context('/slices/5', method='GET'):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_slice_by_id(5).get_data() == b'Not found'
                 assert SliceOfLifeApiGetResponse().get_slice_by_id(5).status == '404 NOT FOUND'
 
@@ -104,7 +183,7 @@ def test_profile_access_with_token(user, access_token, result):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_user_profile(user).get_data() == result
                 assert SliceOfLifeApiGetResponse().get_user_profile(user).status == '200 OK'
 
@@ -114,7 +193,7 @@ def test_profile_access_without_token(user):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_user_profile(user).get_data() == b'Not authorized'
                 assert SliceOfLifeApiGetResponse().get_user_profile(user).status == '401 UNAUTHORIZED'
 
@@ -128,7 +207,7 @@ def test_tasklist_access_with_token(user, access_token, result):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_user_tasklist(user).get_data() == result
                 assert SliceOfLifeApiGetResponse().get_user_tasklist(user).status == '200 OK'
 
@@ -138,7 +217,7 @@ def test_tasklist_access_without_token(user):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_user_tasklist(user).get_data() == b'Not authorized'
                 assert SliceOfLifeApiGetResponse().get_user_tasklist(user).status == '401 UNAUTHORIZED'
 
@@ -152,7 +231,7 @@ def test_profile_access_with_invalid_token(user, invalid_token):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_user_profile(user).get_data() == b'Not authorized'
                 assert SliceOfLifeApiGetResponse().get_user_profile(user).status == '401 UNAUTHORIZED'
 
@@ -166,7 +245,422 @@ def test_tasklist_access_with_invalid_token(user, invalid_token):
         with patch.object(Instance, 'query') as mock_query:
             with patch.object(SpaceIndex, 'get_share_link') as mock_share:
                 mock_query.side_effect = lookup_db
-                mock_share.side_effect = lambda x: x
+                mock_share.side_effect = lambda x, **kwargs: x
                 assert SliceOfLifeApiGetResponse().get_user_tasklist(user).get_data() == b'Not authorized'
                 assert SliceOfLifeApiGetResponse().get_user_tasklist(user).status == '401 UNAUTHORIZED'
 
+
+@pytest.mark.parametrize('stats_key, headers, status', [
+    (None, {'x-stats-key': 'statskey'}, '404 NOT FOUND'),
+    ('statskey', {}, '401 UNAUTHORIZED'),
+    ('statskey', {'x-stats-key': 'wrongkey'}, '401 UNAUTHORIZED')
+])
+def test_service_stats_are_private(stats_key, headers, status):
+    with app.test_request_context('/stats', method='GET', headers=headers):
+        with patch.object(SliceOfLifeApiGetResponse, 'stats_key', stats_key):
+            assert SliceOfLifeApiGetResponse().get_service_stats().status == status
+
+@patch.object(SliceOfLifeApiGetResponse, 'stats_key', 'statskey')
+def test_service_stats_response():
+    with app.test_request_context('/stats', method='GET', headers={'x-stats-key': 'statskey'}):
+        response = SliceOfLifeApiGetResponse().get_service_stats()
+        assert response.status == '200 OK'
+        assert {'size', 'in_use', 'utilization', 'wait_time_max'} <= set(response.get_json()['database'])
+        assert {'size', 'in_use', 'utilization', 'wait_time_max'} <= set(response.get_json()['database_read_only'])
+        assert response.get_json()['database_replicas'] == []
+        assert {'hits', 'misses', 'hit_rate'} <= set(response.get_json()['share_links'])
+        assert {'hits', 'misses', 'hit_rate'} <= set(response.get_json()['profiles'])
+        assert {'hits', 'misses', 'hit_rate'} <= set(response.get_json()['tasks'])
+        assert {'size', 'loads'} <= set(response.get_json()['task_catalog'])
+        assert {'hits', 'misses', 'hit_rate'} <= set(response.get_json()['responses'])
+        assert {'in_flight', 'shared'} <= set(response.get_json()['coalesced'])
+
+def test_latest_posts_with_size_hint():
+    with app.test_request_context('/slices/latest?limit=1&offset=0&size=300', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                with patch.object(ImagePipeline, 'variant_for') as mock_variant:
+                    mock_query.side_effect = lookup_db
+                    mock_share.side_effect = lambda x, **kwargs: x
+                    mock_variant.side_effect = lambda image, size: f"{image}@{size}"
+                    response = SliceOfLifeApiGetResponse().get_latest_posts().get_json()
+                    # hints are rounded to the derivative they choose
+                    assert response['page'][0]['image'] == 'post pic 1@320'
+                    assert response['next'].endswith('&size=320')
+
+@pytest.mark.parametrize('path', ['/slices/latest?limit=1&size=abc', '/slices/1?size=abc'])
+def test_malformed_size_hint(path):
+    with app.test_request_context(path, method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                if path.startswith('/slices/latest'):
+                    response = SliceOfLifeApiGetResponse().get_latest_posts()
+                else:
+                    response = SliceOfLifeApiGetResponse().get_slice_by_id(1)
+                assert response.status == '400 BAD REQUEST'
+
+def test_slice_with_size_hint():
+    with app.test_request_context('/slices/1?size=640', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                with patch.object(ImagePipeline, 'variant_for') as mock_variant:
+                    mock_query.side_effect = lookup_db
+                    mock_share.side_effect = lambda x, **kwargs: x
+                    mock_variant.side_effect = lambda image, size: f"{image}@{size}"
+                    response = SliceOfLifeApiGetResponse().get_slice_by_id(1).get_json()
+                    assert response['image'] == 'post pic 1@640'
+
+def test_authors_and_tasks_cached_across_requests():
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            with app.test_request_context('/slices/latest?limit=4', method='GET'):
+                first = SliceOfLifeApiGetResponse().get_latest_posts().get_json()
+            assert mock_query.call_count == 4
+            SliceOfLifeApiGetResponse().forget_responses('latest')
+            with app.test_request_context('/slices/latest?limit=4', method='GET'):
+                second = SliceOfLifeApiGetResponse().get_latest_posts().get_json()
+            assert mock_query.call_count == 6 # only the version and the page itself
+            assert first == second
+            with app.test_request_context('/slices/1', method='GET'):
+                assert SliceOfLifeApiGetResponse().get_slice_by_id(1).status == '200 OK'
+            assert mock_query.call_count == 7 # only the post itself
+
+def test_cached_records_are_not_shared_between_responses():
+    with app.test_request_context('/slices/1', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: f"signed {x}"
+                res = SliceOfLifeApiGetResponse()
+                author = res._get_basic_post_author_info('user1')
+                task = res._get_task_info(1)
+                author.first_name = 'changed'
+                task.title = 'changed'
+                assert author.profile_pic == 'signed user1.png'
+                other = SliceOfLifeApiGetResponse()
+                assert other._get_basic_post_author_info('user1').first_name == 'user1first'
+                assert other._get_task_info(1).title == 'task1'
+                assert SliceOfLifeApiGetResponse._profiles.get('user1').profile_pic == 'user1.png'
+                assert mock_query.call_count == 2
+
+def test_forgotten_user_is_looked_up_again():
+    with app.test_request_context('/slices/1', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                res = SliceOfLifeApiGetResponse()
+                res._get_basic_post_author_info('user1')
+                res.forget_user('user1')
+                SliceOfLifeApiGetResponse()._get_basic_post_author_info('user1')
+                assert mock_query.call_count == 2
+
+def test_repeated_lookups_within_a_request_are_made_once():
+    with app.test_request_context('/slices/1', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                res = SliceOfLifeApiGetResponse()
+                authors = [res._get_basic_post_author_info(h) for h in ['user1', 'user2'] * 100]
+                tasks = [res._get_task_info(t) for t in [1, 2, 3] * 100]
+                assert authors[0] is authors[2]
+                assert tasks[0] is tasks[3]
+                assert res._get_basic_authors_info({'user1', 'user2'}) == {
+                    'user1': authors[0], 'user2': authors[1]
+                }
+                assert mock_query.call_count == 5
+                assert mock_share.call_count == 2
+
+def test_identity_map_starts_empty_for_each_transaction():
+    with app.test_request_context('/slices/1', method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                res = SliceOfLifeApiGetResponse()
+                with res._read_transaction():
+                    first = res._get_basic_post_author_info('user1')
+                with res._read_transaction():
+                    second = res._get_basic_post_author_info('user1')
+                assert first == second
+                assert first is not second
+                assert mock_share.call_count == 2
+
+def test_tasklist_reads_catalog_once():
+    access_token = SliceOfLifeApiGetResponse().create_auth_token('user1')
+    time.sleep(2) # allow token to be activated
+    with patch.object(Instance, 'query') as mock_query:
+        mock_query.side_effect = lookup_db
+        for handle, expected_queries in [('user1', 2), ('user1', 3)]:
+            with app.test_request_context(f'/users/{handle}/tasklist', method='GET',
+                                          headers={'x-auth-token': access_token}):
+                response = SliceOfLifeApiGetResponse().get_user_tasklist(handle).get_json()
+                assert [t['task_id'] for t in response['completed']] == [2, 3]
+                assert [t['task_id'] for t in response['available']] == [1]
+                assert mock_query.call_count == expected_queries
+
+def test_feed_responses_are_cached_per_query():
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            for path in ['/slices/latest?limit=2&offset=0', '/slices/latest?offset=0&limit=2']:
+                with app.test_request_context(path, method='GET'):
+                    response = SliceOfLifeApiGetResponse().get_latest_posts()
+                    assert response.status == '200 OK'
+                    assert len(response.get_json()['page']) == 2
+            assert mock_query.call_count == 5 # a version check each, and one page
+            with app.test_request_context('/slices/latest?limit=1&offset=0', method='GET'):
+                assert len(SliceOfLifeApiGetResponse().get_latest_posts().get_json()['page']) == 1
+            assert mock_query.call_count == 7
+            SliceOfLifeApiGetResponse().forget_responses('latest')
+            with app.test_request_context('/slices/latest?limit=2&offset=0', method='GET'):
+                SliceOfLifeApiGetResponse().get_latest_posts()
+            assert mock_query.call_count == 9
+
+def test_feed_responses_ignore_other_query_arguments():
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            SliceOfLifeApiGetResponse._responses.clear()
+            size = SliceOfLifeApiGetResponse._responses.stats()['size']
+            for path in ['/slices/latest?limit=2&junk=1', '/slices/latest?limit=2&junk=2',
+                         '/slices/latest?limit=02&offset=0&junk=3&size=300',
+                         '/slices/latest?limit=2&size=320']:
+                with app.test_request_context(path, method='GET'):
+                    assert SliceOfLifeApiGetResponse().get_latest_posts().status == '200 OK'
+            # one page without a size hint, and one with
+            assert SliceOfLifeApiGetResponse._responses.stats()['size'] == size + 2
+
+@pytest.mark.parametrize('path, limit', [
+    ('/slices/latest?limit=100000', 100),
+    ('/slices/latest?limit=0', 1),
+    ('/slices/latest?limit=-5&offset=-5', 1)
+])
+def test_feed_page_size_is_bounded(path, limit):
+    with app.test_request_context(path, method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                SliceOfLifeApiGetResponse().forget_responses('latest')
+                assert SliceOfLifeApiGetResponse().get_latest_posts().status == '200 OK'
+                page = [c.args[1].parameters for c in mock_query.call_args_list
+                        if set(c.args[1].parameters) == {'limit', 'offset'}]
+                assert page == [{'limit': limit, 'offset': 0}]
+
+@pytest.mark.parametrize('path', ['/slices/latest?limit=abc', '/slices/latest?offset=1.5'])
+def test_malformed_page_arguments(path):
+    with app.test_request_context(path, method='GET'):
+        with patch.object(Instance, 'query') as mock_query:
+            mock_query.side_effect = lookup_db
+            assert SliceOfLifeApiGetResponse().get_latest_posts().status == '400 BAD REQUEST'
+
+def test_slice_responses_are_cached_by_id():
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            with app.test_request_context('/slices/1', method='GET'):
+                first = SliceOfLifeApiGetResponse().get_slice_by_id(1).get_json()
+                assert SliceOfLifeApiGetResponse().get_slice_by_id(1).get_json() == first
+                assert SliceOfLifeApiGetResponse().get_slice_by_id(2).get_json()['post_id'] == 2
+                assert SliceOfLifeApiGetResponse().get_slice_by_id(5).status == '404 NOT FOUND'
+                assert SliceOfLifeApiGetResponse().get_slice_by_id(5).status == '404 NOT FOUND'
+            # the version needs no query. user1 is already cached for slice 2
+            assert mock_query.call_count == 3 + 0 + 2 + 1 + 1
+
+def test_unchanged_feed_is_not_modified():
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            with freeze_time('2023-01-01 00:00:00') as frozen:
+                with app.test_request_context('/slices/latest?limit=2', method='GET'):
+                    response = SliceOfLifeApiGetResponse().get_latest_posts()
+                    etag = response.get_etag()[0]
+                    assert response.status == '200 OK'
+                    assert etag
+                with app.test_request_context('/slices/latest?limit=2', method='GET',
+                                              headers={'If-None-Match': f'"{etag}"'}):
+                    SliceOfLifeApiGetResponse().forget_responses('latest')
+                    calls = mock_query.call_count
+                    response = SliceOfLifeApiGetResponse().get_latest_posts()
+                    assert response.status == '304 NOT MODIFIED'
+                    assert response.get_data() == b''
+                    assert response.get_etag()[0] == etag
+                    assert mock_query.call_count == calls + 1 # only the version
+                with app.test_request_context('/slices/latest?limit=3', method='GET',
+                                              headers={'If-None-Match': f'"{etag}"'}):
+                    assert SliceOfLifeApiGetResponse().get_latest_posts().status == '200 OK'
+                frozen.tick(SpaceIndex.SPACES_SHARE_MARGIN)
+                with app.test_request_context('/slices/latest?limit=2', method='GET',
+                                              headers={'If-None-Match': f'"{etag}"'}):
+                    # the page's share links have been renewed since
+                    assert SliceOfLifeApiGetResponse().get_latest_posts().status == '200 OK'
+
+def test_new_post_changes_feed_etag():
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            with freeze_time('2023-01-01 00:00:00'):
+                with app.test_request_context('/slices/latest?limit=2', method='GET'):
+                    etag = SliceOfLifeApiGetResponse().get_latest_posts().get_etag()[0]
+                with app.test_request_context('/slices/latest?limit=2', method='GET',
+                                              headers={'If-None-Match': f'"{etag}"'}):
+                    with patch.object(SliceOfLifeApiGetResponse, '_feed_version', return_value=5):
+                        response = SliceOfLifeApiGetResponse().get_latest_posts()
+                        assert response.status == '200 OK'
+                        assert response.get_etag()[0] != etag
+
+def test_unchanged_slice_is_not_modified():
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            with freeze_time('2023-01-01 00:00:00'):
+                with app.test_request_context('/slices/1', method='GET'):
+                    etag = SliceOfLifeApiGetResponse().get_slice_by_id(1).get_etag()[0]
+                with app.test_request_context('/slices/1', method='GET',
+                                              headers={'If-None-Match': f'"{etag}"'}):
+                    calls = mock_query.call_count
+                    assert SliceOfLifeApiGetResponse().get_slice_by_id(1).status == '304 NOT MODIFIED'
+                    assert mock_query.call_count == calls
+                    assert SliceOfLifeApiGetResponse().get_slice_by_id(2).status == '200 OK'
+                    assert SliceOfLifeApiGetResponse().get_slice_by_id(5).status == '404 NOT FOUND'
+
+def test_cached_slice_is_not_served_past_its_epoch():
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            mock_query.side_effect = lookup_db
+            mock_share.side_effect = lambda x, **kwargs: x
+            with freeze_time('2023-01-01 00:00:29') as frozen:
+                with app.test_request_context('/slices/1', method='GET'):
+                    etag = SliceOfLifeApiGetResponse().get_slice_by_id(1).get_etag()[0]
+                calls = mock_query.call_count
+                frozen.tick(2)
+                with app.test_request_context('/slices/1', method='GET',
+                                              headers={'If-None-Match': f'"{etag}"'}):
+                    # the cached body and its links were built in the previous epoch
+                    response = SliceOfLifeApiGetResponse().get_slice_by_id(1)
+                    assert response.status == '200 OK'
+                    assert response.get_etag()[0] != etag
+                    assert mock_query.call_count > calls
+
+def test_ready_derivative_changes_slice_etag():
+    ready = False
+    def variant(image, size):
+        return f"{image}@{size}" if ready else image
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            with patch.object(ImagePipeline, 'variant_for') as mock_variant:
+                mock_query.side_effect = lookup_db
+                mock_share.side_effect = lambda x, **kwargs: x
+                mock_variant.side_effect = variant
+                with freeze_time('2023-01-01 00:00:00'):
+                    with app.test_request_context('/slices/1?size=640', method='GET'):
+                        response = SliceOfLifeApiGetResponse().get_slice_by_id(1)
+                        etag = response.get_etag()[0]
+                        assert response.get_json()['image'] == 'post pic 1'
+                    with app.test_request_context('/slices/1?size=640', method='GET',
+                                                  headers={'If-None-Match': f'"{etag}"'}):
+                        calls = mock_query.call_count
+                        response = SliceOfLifeApiGetResponse().get_slice_by_id(1)
+                        assert response.status == '304 NOT MODIFIED'
+                        # the post's image is remembered
+                        assert mock_query.call_count == calls
+                        ready = True
+                        response = SliceOfLifeApiGetResponse().get_slice_by_id(1)
+                        assert response.status == '200 OK'
+                        assert response.get_json()['image'] == 'post pic 1@640'
+
+@pytest.mark.parametrize('handler, path', [
+    ('get_comments_for_slice', '/slices/1/comments'),
+    ('get_reactions_for_slice', '/slices/1/reactions'),
+    ('get_slice_by_id', '/slices/1')
+])
+def test_concurrent_reads_of_a_slice_are_coalesced(handler, path):
+    readers = 6
+    arrived = threading.Barrier(readers + 1)
+    release = threading.Event()
+    def slow_lookup(conn, query):
+        release.wait(5)
+        return lookup_db(conn, query)
+    def read(_):
+        with app.test_request_context(path, method='GET'):
+            arrived.wait(5)
+            return getattr(SliceOfLifeApiGetResponse(), handler)(1).get_json()
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            with patch.object(SliceOfLifeApiGetResponse, '_slice_version', return_value='1'):
+                mock_query.side_effect = slow_lookup
+                mock_share.side_effect = lambda x, **kwargs: x
+                shared = SliceOfLifeApiGetResponse._flights.stats()['shared']
+                with ThreadPoolExecutor(readers) as pool:
+                    results = pool.map(read, range(readers))
+                    arrived.wait(5)
+                    deadline = time.monotonic() + 5
+                    while (SliceOfLifeApiGetResponse._flights.stats()['shared'] < shared + readers - 1
+                           and time.monotonic() < deadline):
+                        time.sleep(0.001)
+                    release.set()
+                    results = list(results)
+                assert all(r == results[0] for r in results)
+                assert SliceOfLifeApiGetResponse._flights.stats()['shared'] == shared + readers - 1
+                solo = mock_query.call_count
+                mock_query.reset_mock()
+                SliceOfLifeApiGetResponse._profiles.clear()
+                SliceOfLifeApiGetResponse._tasks.clear()
+                SliceOfLifeApiGetResponse._responses.clear()
+                with app.test_request_context(path, method='GET'):
+                    getattr(SliceOfLifeApiGetResponse(), handler)(1)
+                assert solo == mock_query.call_count
+
+def test_recent_writers_do_not_share_other_viewers_reads():
+    entered = threading.Event()
+    release = threading.Event()
+    def slow_lookup(conn, query):
+        if threading.current_thread().name == 'anonymous':
+            entered.set()
+            release.wait(5)
+        return lookup_db(conn, query)
+    def anonymous_read():
+        with app.test_request_context('/slices/1', method='GET'):
+            SliceOfLifeApiGetResponse().get_slice_by_id(1)
+    token = SliceOfLifeApiGetResponse().create_auth_token('user1')
+    time.sleep(2) # allow token to be activated
+    with patch.object(Instance, 'query') as mock_query:
+        with patch.object(SpaceIndex, 'get_share_link') as mock_share:
+            with patch.object(Instance, 'wrote_recently', side_effect=lambda who: who == 'user1'):
+                mock_query.side_effect = slow_lookup
+                mock_share.side_effect = lambda x, **kwargs: x
+                SliceOfLifeApiGetResponse._responses.clear()
+                shared = SliceOfLifeApiGetResponse._flights.stats()['shared']
+                reader = threading.Thread(target=anonymous_read, name='anonymous')
+                reader.start()
+                try:
+                    assert entered.wait(5)
+                    with app.test_request_context('/slices/1', method='GET',
+                                                  headers={'x-auth-token': token}):
+                        # the writer runs the read itself, instead of waiting on the other one
+                        assert SliceOfLifeApiGetResponse().get_slice_by_id(1).status == '200 OK'
+                    assert not release.is_set()
+                    assert SliceOfLifeApiGetResponse._flights.stats()['shared'] == shared
+                finally:
+                    release.set()
+                    reader.join(5)
+                calls = mock_query.call_count
+                with app.test_request_context('/slices/1', method='GET',
+                                              headers={'x-auth-token': token}):
+                    assert SliceOfLifeApiGetResponse().get_slice_by_id(1).status == '200 OK'
+                assert mock_query.call_count == calls # the writer's own response is cached
+                with app.test_request_context('/slices/1', method='GET'):
+                    assert SliceOfLifeApiGetResponse().get_slice_by_id(1).status == '200 OK'
+                assert mock_query.call_count == calls
@@ -9,16 +9,27 @@ import secrets
 from unittest.mock import patch
 from io import BytesIO
 
+import psycopg2
 import pytest
 import jwt
+from flask import request
 
 from sliceoflife_webservice.dbtools import Instance
-from sliceoflife_webservice.toolkit import SpaceIndex
+from sliceoflife_webservice.toolkit import SpaceIndex, ImagePipeline, IMAGE_TYPES
 from sliceoflife_webservice.api.post import SliceOfLifeApiPostResponse
+from sliceoflife_webservice.exceptions import ServiceNotReachable
 from sliceoflife_webservice import app
 
 from . import update_db, lookup_db, mock_db
 
+PNG_IMAGE = b'\x89PNG\r\n\x1a\n Slice Image'
+
+@pytest.fixture(autouse=True)
+def mock_image_pipeline():
+    """Keep new posts from making image derivatives in the background"""
+    with patch.object(ImagePipeline, 'submit') as mock_submit:
+        yield mock_submit
+
 def test_create_new_user_with_available_handle():
     form ={
         "handle": "user3",
@@ -33,8 +44,14 @@ def test_create_new_user_with_available_handle():
                 with patch.object(SpaceIndex, 'save_file') as mock_save:
                     mock_query_no_fetch.side_effect = update_db
                     mock_query.side_effect = lookup_db
-                    mock_save.side_effect = lambda x, y: time.sleep(3)
-                    assert SliceOfLifeApiPostResponse().create_user().get_data() == b'"CREATED user3"\n'
+                    mock_save.side_effect = lambda x, y, **kwargs: time.sleep(3)
+                    with patch.object(SliceOfLifeApiPostResponse, 'forget_user') as mock_forget:
+                        assert SliceOfLifeApiPostResponse().create_user().get_data() == b'"CREATED user3"\n'
+                        mock_forget.assert_called_once_with('user3')
+                        assert any(
+                            call[0][1].name == 'notify_invalidation'
+                            for call in mock_query_no_fetch.call_args_list
+                        )
                     assert SliceOfLifeApiPostResponse().create_user().status == '200 OK'
 
 def test_create_new_user_with_unavailable_handle():
@@ -51,7 +68,7 @@ def test_create_new_user_with_unavailable_handle():
                 with patch.object(SpaceIndex, 'save_file') as mock_save:
                     mock_query_no_fetch.side_effect = update_db
                     mock_query.side_effect = lookup_db
-                    mock_save.side_effect = lambda x, y: time.sleep(3)
+                    mock_save.side_effect = lambda x, y, **kwargs: time.sleep(3)
                     assert SliceOfLifeApiPostResponse().create_user().get_data() == b'Not authorized'
                     assert SliceOfLifeApiPostResponse().create_user().status == '401 UNAUTHORIZED'
 
@@ -68,7 +85,7 @@ def test_successful_authentication(mock_digest, mock_jwt):
                 with patch.object(SpaceIndex, 'save_file') as mock_save:
                     mock_query_no_fetch.side_effect = update_db
                     mock_query.side_effect = lookup_db
-                    mock_save.side_effect = lambda x, y: time.sleep(3)
+                    mock_save.side_effect = lambda x, y, **kwargs: time.sleep(3)
                     assert SliceOfLifeApiPostResponse().authenticate_user().get_data() == b'{"token":"testtoken"}\n'
                     assert SliceOfLifeApiPostResponse().authenticate_user().status == '200 OK'
 
@@ -84,7 +101,7 @@ def test_incorrect_credentials_authentication(mock_digest):
                 with patch.object(SpaceIndex, 'save_file') as mock_save:
                     mock_query_no_fetch.side_effect = update_db
                     mock_query.side_effect = lookup_db
-                    mock_save.side_effect = lambda x, y: time.sleep(3)
+                    mock_save.side_effect = lambda x, y, **kwargs: time.sleep(3)
                     assert SliceOfLifeApiPostResponse().authenticate_user().get_data() == b'Not authorized'
                     assert SliceOfLifeApiPostResponse().authenticate_user().status == '401 UNAUTHORIZED'
 
@@ -99,7 +116,7 @@ def test_fake_credentials_authentication():
                 with patch.object(SpaceIndex, 'save_file') as mock_save:
                     mock_query_no_fetch.side_effect = update_db
                     mock_query.side_effect = lookup_db
-                    mock_save.side_effect = lambda x, y: time.sleep(3)
+                    mock_save.side_effect = lambda x, y, **kwargs: time.sleep(3)
                     assert SliceOfLifeApiPostResponse().authenticate_user().get_data() == b'Not authorized'
                     assert SliceOfLifeApiPostResponse().authenticate_user().status == '401 UNAUTHORIZED'
 
@@ -109,16 +126,22 @@ def test_authorized_post_creation(mock_auth):
         'handle': 'user1',
         'free_text': 'new post text',
         'task_id': 1,
-        'slice_image': (BytesIO(b'Slice Image'), 'slice_image.png')
+        'slice_image': (BytesIO(PNG_IMAGE), 'slice_image.png')
     }
     with app.test_request_context('/slices/new', method='POST', data=form):
         with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch:
             with patch.object(Instance, 'query') as mock_query:
-                with patch.object(SpaceIndex, 'save_file') as mock_save:
+                with patch.object(SpaceIndex, 'save_content') as mock_save:
                     mock_query_no_fetch.side_effect = update_db
                     mock_query.side_effect = lookup_db
-                    mock_save.side_effect = lambda x, y: time.sleep(3)
-                    assert SliceOfLifeApiPostResponse().create_new_post().get_data() == b'"CREATED"\n'
+                    mock_save.side_effect = lambda x, y, z: time.sleep(3)
+                    with patch.object(SliceOfLifeApiPostResponse, 'forget_responses') as mock_forget:
+                        assert SliceOfLifeApiPostResponse().create_new_post().get_data() == b'"CREATED"\n'
+                        mock_forget.assert_called_once_with('latest')
+                        assert any(
+                            call[0][1].name == 'notify_invalidation'
+                            for call in mock_query_no_fetch.call_args_list
+                        )
                     assert SliceOfLifeApiPostResponse().create_new_post().status == '200 OK'
 
 @patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=False)
@@ -127,14 +150,341 @@ def test_unauthorized_post_creation(mock_auth):
         'handle': 'user1',
         'free_text': 'new post text',
         'task_id': 1,
-        'slice_image': (BytesIO(b'Slice Image'), 'slice_image.png')
+        'slice_image': (BytesIO(PNG_IMAGE), 'slice_image.png')
     }
     with app.test_request_context('/slices/new', method='POST', data=form):
         with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch:
             with patch.object(Instance, 'query') as mock_query:
-                with patch.object(SpaceIndex, 'save_file') as mock_save:
+                with patch.object(SpaceIndex, 'save_content') as mock_save:
                     mock_query_no_fetch.side_effect = update_db
                     mock_query.side_effect = lookup_db
-                    mock_save.side_effect = lambda x, y: time.sleep(3)
+                    mock_save.side_effect = lambda x, y, z: time.sleep(3)
                     assert SliceOfLifeApiPostResponse().create_new_post().get_data() == b'Not authorized'
                     assert SliceOfLifeApiPostResponse().create_new_post().status == '401 UNAUTHORIZED'
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_authorized_post_upload_start(mock_auth):
+    form = {
+        'handle': 'user1',
+        'task_id': 1,
+        'filename': 'slice_image.png'
+    }
+    with app.test_request_context('/slices/upload', method='POST', data=form):
+        with patch.object(SpaceIndex, 'get_upload_link', return_value='upload link') as mock_link, \
+                patch.object(Instance, 'query', side_effect=lookup_db), \
+                patch('secrets.token_urlsafe', return_value='token'):
+            response = SliceOfLifeApiPostResponse().start_post_upload()
+            assert response.status == '200 OK'
+            assert response.get_json() == {
+                'upload_url': 'upload link',
+                'content_type': 'image/png',
+                'image': 'uploads/user1/token.png',
+                'expires_in': SpaceIndex.SPACES_UPLOAD_TIME
+            }
+            mock_link.assert_called_once_with('uploads/user1/token.png', 'image/png')
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_upload_start_names_each_upload_uniquely(mock_auth):
+    form = {
+        'handle': 'user1',
+        'task_id': 1,
+        'filename': 'slice_image.png'
+    }
+    with patch.object(SpaceIndex, 'get_upload_link', return_value='upload link'), \
+            patch.object(Instance, 'query', side_effect=lookup_db):
+        images = set()
+        for _ in range(2):
+            with app.test_request_context('/slices/upload', method='POST', data=form):
+                images.add(SliceOfLifeApiPostResponse().start_post_upload().get_json()['image'])
+        assert len(images) == 2
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_upload_start_for_a_completed_task(mock_auth):
+    form = {
+        'handle': 'user1',
+        'task_id': 2,
+        'filename': 'slice_image.png'
+    }
+    with app.test_request_context('/slices/upload', method='POST', data=form):
+        with patch.object(SpaceIndex, 'get_upload_link') as mock_link, \
+                patch.object(Instance, 'query', side_effect=lookup_db):
+            assert SliceOfLifeApiPostResponse().start_post_upload().status == '401 UNAUTHORIZED'
+            assert not mock_link.called
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=False)
+def test_unauthorized_post_upload_start(mock_auth):
+    form = {
+        'handle': 'user1',
+        'task_id': 1,
+        'filename': 'slice_image.png'
+    }
+    with app.test_request_context('/slices/upload', method='POST', data=form):
+        with patch.object(SpaceIndex, 'get_upload_link') as mock_link:
+            assert SliceOfLifeApiPostResponse().start_post_upload().status == '401 UNAUTHORIZED'
+            assert not mock_link.called
+
+@pytest.mark.parametrize('auth, image, task, uploaded, status', [
+    (True, 'uploads/user1/token.png', 1, True, '200 OK'),
+    (True, 'uploads/user1/token.png', 1, False, '404 NOT FOUND'),
+    (True, 'uploads/user2/token.png', 1, True, '401 UNAUTHORIZED'),
+    (True, 'uploads/user1/other/token.png', 1, True, '401 UNAUTHORIZED'),
+    (True, 'posts/user1/task1.png', 1, True, '401 UNAUTHORIZED'),
+    (True, 'uploads/user1/token.png', 2, True, '401 UNAUTHORIZED'),
+    (False, 'uploads/user1/token.png', 1, True, '401 UNAUTHORIZED')
+])
+def test_post_upload_finish(auth, image, task, uploaded, status, mock_image_pipeline):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': task,
+        'image': image
+    }
+    with app.test_request_context('/slices/upload/finish', method='POST', data=form):
+        with patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=auth):
+            with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch, \
+                    patch.object(Instance, 'query', side_effect=lookup_db):
+                with patch.object(SpaceIndex, 'file_size', return_value=len(PNG_IMAGE) if uploaded else None), \
+                        patch.object(SpaceIndex, 'read_file_start', return_value=PNG_IMAGE[:12]), \
+                        patch.object(SpaceIndex, 'stored_content_key', return_value='images/ab/abc.png'), \
+                        patch.object(SpaceIndex, 'file_exists', return_value=False), \
+                        patch.object(SpaceIndex, 'copy_file') as mock_copy, \
+                        patch.object(SpaceIndex, 'delete_file') as mock_delete:
+                    with patch.object(SliceOfLifeApiPostResponse, 'forget_responses') as mock_forget:
+                        mock_query_no_fetch.side_effect = update_db
+                        assert SliceOfLifeApiPostResponse().finish_post_upload().status == status
+                        assert mock_query_no_fetch.called == (status == '200 OK')
+                        assert mock_image_pipeline.called == (status == '200 OK')
+                        assert mock_forget.called == (status == '200 OK')
+                        if status == '200 OK':
+                            mock_copy.assert_called_once_with(image, 'images/ab/abc.png')
+                            mock_delete.assert_called_once_with(image)
+                        else:
+                            assert not mock_copy.called
+
+@pytest.mark.parametrize('known', [True, False])
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_upload_finish_reuses_stored_images(mock_auth, known, mock_image_pipeline):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'image': 'uploads/user1/token.png'
+    }
+    with app.test_request_context('/slices/upload/finish', method='POST', data=form):
+        with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch, \
+                patch.object(Instance, 'query', side_effect=lookup_db):
+            with patch.object(SpaceIndex, 'file_size', return_value=len(PNG_IMAGE)), \
+                    patch.object(SpaceIndex, 'read_file_start', return_value=PNG_IMAGE[:12]), \
+                    patch.object(SpaceIndex, 'stored_content_key', return_value='images/ab/abc.png') as mock_key, \
+                    patch.object(SpaceIndex, 'file_exists', return_value=known), \
+                    patch.object(SpaceIndex, 'copy_file') as mock_copy, \
+                    patch.object(SpaceIndex, 'delete_file') as mock_delete:
+                mock_query_no_fetch.side_effect = update_db
+                assert SliceOfLifeApiPostResponse().finish_post_upload().status == '200 OK'
+                mock_key.assert_called_once_with('uploads/user1/token.png', 'image/png')
+                issued = [c.args[1].parameters for c in mock_query_no_fetch.call_args_list]
+                assert issued[0] == {'lockimage': 'images/ab/abc.png'}
+                assert issued[1]['image'] == 'images/ab/abc.png'
+                assert mock_copy.called is not known
+                mock_delete.assert_called_once_with('uploads/user1/token.png')
+                assert mock_image_pipeline.called is not known
+
+@pytest.mark.parametrize('contents, status', [
+    (PNG_IMAGE + b'0' * 64, '413 REQUEST ENTITY TOO LARGE'),
+    (b'#!/bin/sh pretending to be a png', '415 UNSUPPORTED MEDIA TYPE'),
+    (b'\x89PNG', '415 UNSUPPORTED MEDIA TYPE')
+])
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_upload_finish_rejects_unchecked_uploads(mock_auth, contents, status, mock_image_pipeline):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'image': 'uploads/user1/token.png'
+    }
+    with app.test_request_context('/slices/upload/finish', method='POST', data=form):
+        with patch.object(SliceOfLifeApiPostResponse, 'max_upload_bytes', 48):
+            with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch, \
+                    patch.object(Instance, 'query', side_effect=lookup_db):
+                with patch.object(SpaceIndex, 'file_size', return_value=len(contents)), \
+                        patch.object(SpaceIndex, 'read_file_start', side_effect=lambda key, length: contents[:length]), \
+                        patch.object(SpaceIndex, 'copy_file') as mock_copy, \
+                        patch.object(SpaceIndex, 'delete_file') as mock_delete:
+                    assert SliceOfLifeApiPostResponse().finish_post_upload().status == status
+                    mock_delete.assert_called_once_with('uploads/user1/token.png')
+                    assert not mock_copy.called
+                    assert not mock_query_no_fetch.called
+                    assert not mock_image_pipeline.called
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_creation_rejects_non_images(mock_auth):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'slice_image': (BytesIO(b'#!/bin/sh pretending to be a png'), 'slice_image.png')
+    }
+    with app.test_request_context('/slices/new', method='POST', data=form):
+        with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch:
+            with patch.object(SpaceIndex, 'save_content') as mock_save:
+                assert SliceOfLifeApiPostResponse().create_new_post().status == '415 UNSUPPORTED MEDIA TYPE'
+                assert not mock_save.called
+                assert not mock_query_no_fetch.called
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_creation_rejects_large_uploads(mock_auth):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'slice_image': (BytesIO(PNG_IMAGE + b'0' * 64), 'slice_image.png')
+    }
+    with app.test_request_context('/slices/new', method='POST', data=form):
+        with patch.object(SliceOfLifeApiPostResponse, 'max_upload_bytes', 32):
+            with patch.object(SpaceIndex, 'save_content') as mock_save:
+                assert SliceOfLifeApiPostResponse().create_new_post().status == '413 REQUEST ENTITY TOO LARGE'
+                assert not mock_save.called
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_authorized_post_creation_sets_content_type(mock_auth):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'slice_image': (BytesIO(PNG_IMAGE), 'slice_image.jpg')
+    }
+    with app.test_request_context('/slices/new', method='POST', data=form):
+        with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch:
+            with patch.object(SpaceIndex, 'save_content') as mock_save:
+                mock_query_no_fetch.side_effect = update_db
+                assert SliceOfLifeApiPostResponse().create_new_post().status == '200 OK'
+                assert mock_save.call_args.args[0].endswith('.png')
+                assert mock_save.call_args.args[2] == 'image/png'
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_creation_rejects_non_images_before_reading_the_body(mock_auth):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'slice_image': (BytesIO(b'#!/bin/sh pretending to be a png' + b'0' * 1024 * 1024), 'slice_image.png')
+    }
+    with app.test_request_context('/slices/new', method='POST', data=form):
+        with patch.object(SpaceIndex, 'save_content') as mock_save:
+            assert SliceOfLifeApiPostResponse().create_new_post().status == '415 UNSUPPORTED MEDIA TYPE'
+            assert not mock_save.called
+            assert len(request.stream.read()) > 512 * 1024
+
+@pytest.mark.parametrize('filename, content_type', [
+    ('slice_image.heic', 'image/heic'),
+    ('slice_image.jpeg', 'image/jpeg')
+])
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_upload_start_names_images_by_extension(mock_auth, filename, content_type):
+    form = {
+        'handle': 'user1',
+        'task_id': 1,
+        'filename': filename
+    }
+    with app.test_request_context('/slices/upload', method='POST', data=form):
+        with patch.object(SpaceIndex, 'get_upload_link', return_value='upload link') as mock_link, \
+                patch.object(Instance, 'query', side_effect=lookup_db):
+            response = SliceOfLifeApiPostResponse().start_post_upload()
+            assert response.status == '200 OK'
+            assert response.get_json()['content_type'] == content_type
+            assert response.get_json()['image'].endswith(IMAGE_TYPES[content_type])
+            assert mock_link.call_args.args[1] == content_type
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_upload_start_rejects_non_images(mock_auth):
+    form = {
+        'handle': 'user1',
+        'task_id': 1,
+        'filename': 'slice_image.exe'
+    }
+    with app.test_request_context('/slices/upload', method='POST', data=form):
+        with patch.object(SpaceIndex, 'get_upload_link') as mock_link:
+            assert SliceOfLifeApiPostResponse().start_post_upload().status == '415 UNSUPPORTED MEDIA TYPE'
+            assert not mock_link.called
+
+@pytest.mark.parametrize('uploaded', [True, False])
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_post_creation_reuses_stored_images(mock_auth, uploaded, mock_image_pipeline):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'slice_image': (BytesIO(PNG_IMAGE), 'slice_image.png')
+    }
+    with app.test_request_context('/slices/new', method='POST', data=form):
+        with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch:
+            with patch.object(SpaceIndex, 'save_content', return_value=uploaded) as mock_save:
+                mock_query_no_fetch.side_effect = update_db
+                assert SliceOfLifeApiPostResponse().create_new_post().status == '200 OK'
+                image = mock_save.call_args.args[0]
+                issued = [c.args[1].parameters for c in mock_query_no_fetch.call_args_list]
+                assert issued[0] == {'lockimage': image}
+                assert issued[1]['image'] == image
+                assert mock_image_pipeline.called is uploaded
+
+@pytest.mark.parametrize('image, deleted', [('post pic 1', False), ('images/ab/abc.png', True)])
+def test_release_image(image, deleted):
+    with patch.object(Instance, 'query_no_fetch'):
+        with patch.object(Instance, 'query') as mock_query:
+            with patch.object(SpaceIndex, 'delete_file') as mock_delete:
+                mock_query.side_effect = lookup_db
+                assert SliceOfLifeApiPostResponse().release_image(image) is deleted
+                assert [c.args[0] for c in mock_delete.call_args_list] == ([
+                    'images/ab/abc.png',
+                    'images/ab/abc.w320.webp',
+                    'images/ab/abc.w640.webp',
+                    'images/ab/abc.w1280.webp'
+                ] if deleted else [])
+
+def fail_to_insert_post(conn, query):
+    if 'freetext' in query.parameters:
+        raise psycopg2.IntegrityError("duplicate key value violates unique constraint")
+    return update_db(conn, query)
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_failed_post_creation_releases_its_image(mock_auth, mock_image_pipeline):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'slice_image': (BytesIO(PNG_IMAGE), 'slice_image.png')
+    }
+    with app.test_request_context('/slices/new', method='POST', data=form):
+        with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch:
+            with patch.object(SpaceIndex, 'save_content', return_value=True) as mock_save:
+                with patch.object(SliceOfLifeApiPostResponse, 'release_image') as mock_release:
+                    mock_query_no_fetch.side_effect = fail_to_insert_post
+                    with pytest.raises(psycopg2.IntegrityError):
+                        SliceOfLifeApiPostResponse().create_new_post()
+                    mock_release.assert_called_once_with(mock_save.call_args.args[0])
+                    assert not mock_image_pipeline.called
+
+@patch.object(SliceOfLifeApiPostResponse, 'verify_auth_token', return_value=True)
+def test_failed_post_upload_finish_releases_its_image(mock_auth):
+    form = {
+        'handle': 'user1',
+        'free_text': 'new post text',
+        'task_id': 1,
+        'image': 'uploads/user1/token.png'
+    }
+    with app.test_request_context('/slices/upload/finish', method='POST', data=form):
+        with patch.object(Instance, 'query_no_fetch') as mock_query_no_fetch, \
+                patch.object(Instance, 'query', side_effect=lookup_db):
+            with patch.object(SpaceIndex, 'file_size', return_value=len(PNG_IMAGE)), \
+                    patch.object(SpaceIndex, 'read_file_start', return_value=PNG_IMAGE[:12]), \
+                    patch.object(SpaceIndex, 'stored_content_key', return_value='images/ab/abc.png'), \
+                    patch.object(SpaceIndex, 'file_exists', return_value=False), \
+                    patch.object(SpaceIndex, 'copy_file'), \
+                    patch.object(SpaceIndex, 'delete_file') as mock_delete:
+                with patch.object(SliceOfLifeApiPostResponse, 'release_image',
+                                  side_effect=ServiceNotReachable("storage is down")) as mock_release:
+                    mock_query_no_fetch.side_effect = fail_to_insert_post
+                    with pytest.raises(psycopg2.IntegrityError):
+                        SliceOfLifeApiPostResponse().finish_post_upload()
+                    mock_release.assert_called_once_with('images/ab/abc.png')
+                    assert not mock_delete.called # kept, so finishing can be retried
@@ -4,7 +4,11 @@
     module_author: Nathan Mendoza (nathacm@uci.edu)
 """
 
-from sliceoflife_webservice.dbtools.queries.statement import PreparedStatement
+import pytest
+
+from sliceoflife_webservice.dbtools.queries.statement import (
+    PreparedStatement, register_statement, STATEMENTS
+)
 
 def test_prepared_statement_creation_with_parmeters():
     """Test prepared statement creation"""
@@ -17,3 +21,23 @@ def test_prepared_statement_creation_without_parmeters():
     pstmt = PreparedStatement(sql = 'SELECT 1')
     assert pstmt.statement == 'SELECT 1'
     assert not pstmt.parameters
+
+def test_prepared_statement_creation_with_name():
+    """Test prepared statement creation from a named template"""
+    pstmt = PreparedStatement('SELECT %(n)s', name='template', n=1)
+    assert pstmt.name == 'template'
+    assert pstmt.parameters == {'n': 1}
+    assert PreparedStatement('SELECT 1').name is None
+
+def test_prepared_statement_creation_from_registered_template():
+    """Test prepared statement creation from a registered template"""
+    register_statement('registered', 'SELECT %(n)s')
+    pstmt = PreparedStatement.named('registered', n=1)
+    assert pstmt.name == 'registered'
+    assert pstmt.statement is STATEMENTS['registered']
+    assert pstmt.parameters == {'n': 1}
+
+def test_prepared_statement_creation_from_unknown_template():
+    """Test prepared statement creation from a template that was never registered"""
+    with pytest.raises(KeyError):
+        PreparedStatement.named('unregistered')
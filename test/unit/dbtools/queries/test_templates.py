@@ -21,6 +21,22 @@ def test_paginated_posts_templates_with_offset():
     assert template.statement
     assert template.parameters == {'limit': 20, 'offset': 5}
 
+def test_keyset_posts_template_first_page():
+    """Test the keyset_posts template without a key"""
+    template = templates.keyset_posts(20)
+    assert template.statement
+    assert template.parameters == {'limit': 20}
+
+def test_keyset_posts_template_after_key():
+    """Test the keyset_posts template after a key"""
+    template = templates.keyset_posts(20, (datetime.datetime(2022, 12, 15), 1))
+    assert template.statement
+    assert template.parameters == {
+        'limit': 20,
+        'aftertime': datetime.datetime(2022, 12, 15),
+        'afterpost': 1
+    }
+
 def test_specific_user_templates():
     """Test the specific_user template"""
     template = templates.specific_user('handle')
@@ -33,6 +49,18 @@ def test_specific_task_template():
     assert template.statement
     assert template.parameters == {'taskid': 1}
 
+def test_users_by_handles_template():
+    """Test the users_by_handles template"""
+    template = templates.users_by_handles({'handle'})
+    assert template.statement
+    assert template.parameters == {'handles': ['handle']}
+
+def test_tasks_by_ids_template():
+    """Test the tasks_by_ids template"""
+    template = templates.tasks_by_ids((1, 2))
+    assert template.statement
+    assert template.parameters == {'taskids': [1, 2]}
+
 def test_specific_post_template():
     """Test the specific_post template"""
     template = templates.specific_post(1)
@@ -51,6 +79,12 @@ def test_comments_responding_to_template():
     assert template.statement
     assert template.parameters == {'commentto': 1, 'commentid': 1}
 
+def test_comment_forest_template():
+    """Test the comment_forest template"""
+    template = templates.comment_forest(1)
+    assert template.statement
+    assert template.parameters == {'forestof': 1}
+
 def test_reaction_by_groups_template():
     """Test the reactions_by_group template"""
     template = templates.reactions_by_group(1)
@@ -69,6 +103,31 @@ def test_reactors_by_emoji_template():
     assert template.statement
     assert template.parameters == {'reactto': 1, 'codeused': 'code'}
 
+def test_reaction_summary_template_with_no_limit():
+    """Test the reaction_summary template with no reactor limit"""
+    template = templates.reaction_summary(1)
+    assert template.statement
+    assert template.parameters == {'summaryof': 1, 'reactorcap': None}
+
+def test_reaction_summary_template_with_limit():
+    """Test the reaction_summary template with a reactor limit"""
+    template = templates.reaction_summary(1, 5)
+    assert template.statement
+    assert template.parameters == {'summaryof': 1, 'reactorcap': 5}
+
+def test_reaction_summary_lists_each_reactor_once():
+    """Test the reaction_summary template lists a user that reacted twice once"""
+    statement = templates.reaction_summary(1).statement.as_string(None)
+    assert 'FILTER (WHERE r.first_reaction)' in statement
+    assert 'PARTITION BY emoji, reacted_by' in statement
+
+def test_templates_are_composed_once():
+    """Test that a template reuses the same composed statement between calls"""
+    assert templates.specific_post(1).statement is templates.specific_post(2).statement
+    assert templates.keyset_posts(10).statement is not templates.keyset_posts(
+        10, (datetime.datetime(2023, 1, 1), 1)
+    ).statement
+
 def test_insert_user_account_template():
     """Test the insert_user_account template"""
     template = templates.insert_user_account(User('handle',
@@ -125,3 +184,39 @@ def test_completed_tasks_template():
     template = templates.completed_tasks('handle')
     assert template.statement
     assert template.parameters == {'completes': 'handle'}
+
+def test_lock_image_template():
+    """Test the lock_image template"""
+    template = templates.lock_image('images/ab/abc.png')
+    assert template.statement
+    assert template.parameters == {'lockimage': 'images/ab/abc.png'}
+
+def test_image_references_template():
+    """Test the image_references template"""
+    template = templates.image_references('images/ab/abc.png')
+    assert 'p.image_url = ' in template.statement.as_string(None)
+    assert template.parameters == {'referencedimage': 'images/ab/abc.png'}
+
+def test_all_tasks_template():
+    """Test the all_tasks template"""
+    template = templates.all_tasks()
+    assert template.statement
+    assert template.parameters == {}
+
+def test_completed_task_ids_template():
+    """Test the completed_task_ids template"""
+    template = templates.completed_task_ids('handle')
+    assert template.statement
+    assert template.parameters == {'completedby': 'handle'}
+
+def test_latest_post_version_template():
+    """Test the latest_post_version template"""
+    template = templates.latest_post_version()
+    assert template.statement
+    assert template.parameters == {}
+
+def test_notify_invalidation_template():
+    """Test the notify_invalidation template"""
+    template = templates.notify_invalidation('channel', 'payload')
+    assert template.statement
+    assert template.parameters == {'channel': 'channel', 'payload': 'payload'}
@@ -0,0 +1,124 @@
+"""
+    module_name: test_bus
+    module_summary: tests for the InvalidationBus class
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import threading
+from collections import namedtuple
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+import pytest
+
+from sliceoflife_webservice.dbtools import InvalidationBus, invalidation_message
+
+Notify = namedtuple('Notify', ['pid', 'channel', 'payload'])
+
+@pytest.fixture
+def mock_bus():
+    """Test bus with a handler for a single region"""
+    bus = InvalidationBus(MagicMock(), 'changes')
+    bus.POLL_TIMEOUT = 0.01
+    bus.RETRY_MIN = 0.01
+    return bus
+
+def test_messages_reach_their_region(mock_bus):
+    """Test messages are only handed to the handlers of their region"""
+    profiles, responses = MagicMock(), MagicMock()
+    mock_bus.subscribe('profiles', profiles)
+    mock_bus.subscribe('responses', responses)
+    mock_bus.dispatch(invalidation_message('profiles', 'user1'))
+    mock_bus.dispatch(invalidation_message('responses'))
+    mock_bus.dispatch(invalidation_message('tasks', 1))
+    profiles.assert_called_once_with('user1')
+    responses.assert_called_once_with(None)
+
+@pytest.mark.parametrize('payload', ['not json', '[]', '{"key": "user1"}'])
+def test_malformed_messages_are_ignored(mock_bus, payload):
+    """Test messages that are not invalidations do not reach any handler"""
+    handler = MagicMock()
+    mock_bus.subscribe('profiles', handler)
+    mock_bus.dispatch(payload)
+    assert not handler.called
+
+def test_failing_handler_does_not_stop_the_others(mock_bus):
+    """Test a handler that raises is logged and the bus moves on"""
+    failing, handler = MagicMock(side_effect=RuntimeError('broken')), MagicMock()
+    mock_bus.subscribe('profiles', failing)
+    mock_bus.subscribe('profiles', handler)
+    mock_bus.dispatch(invalidation_message('profiles', 'user1'))
+    mock_bus.dispatch(invalidation_message('profiles', 'user2'))
+    assert failing.call_count == 2
+    assert [c.args for c in handler.call_args_list] == [('user1',), ('user2',)]
+
+def test_listener_delivers_notifications(mock_bus):
+    """Test notifications received by the listening connection reach their handlers"""
+    received = threading.Event()
+    conn = MagicMock(notifies=[])
+    def poll():
+        conn.notifies.append(Notify(1, 'changes', invalidation_message('profiles', 'user1')))
+    conn.poll.side_effect = poll
+    mock_bus._listen.return_value = conn
+    keys = []
+    def handler(key):
+        keys.append(key)
+        if key is not None:
+            received.set()
+    mock_bus.subscribe('profiles', handler)
+    with patch('select.select', return_value=([conn], [], [])):
+        mock_bus.start()
+        assert received.wait(2)
+        mock_bus.stop(2)
+    assert not mock_bus.is_listening()
+    assert keys[0] is None # everything is forgotten when listening starts
+    assert keys[1] == 'user1'
+    mock_bus._listen.assert_called_with('changes')
+    assert conn.close.called
+
+def test_listener_survives_failing_handlers(mock_bus):
+    """Test the listener keeps delivering notifications after a handler raises"""
+    received = threading.Event()
+    conn = MagicMock(notifies=[])
+    def poll():
+        conn.notifies.append(Notify(1, 'changes', invalidation_message('profiles', 'user1')))
+    conn.poll.side_effect = poll
+    mock_bus._listen.return_value = conn
+    calls = []
+    def handler(key):
+        calls.append(key)
+        if len(calls) == 3:
+            received.set()
+        raise RuntimeError('broken')
+    mock_bus.subscribe('profiles', handler)
+    with patch('select.select', return_value=([conn], [], [])):
+        mock_bus.start()
+        assert received.wait(2)
+        assert mock_bus.is_listening()
+        mock_bus.stop(2)
+    assert calls[:3] == [None, 'user1', 'user1']
+    assert mock_bus._listen.call_count == 1
+
+def test_listener_reconnects(mock_bus):
+    """Test the listener keeps trying to listen, and starts over after losing its connection"""
+    reconnected = threading.Event()
+    conn = MagicMock(notifies=[])
+    conn.poll.side_effect = psycopg2.OperationalError("connection lost")
+    attempts = []
+    def listen(channel):
+        attempts.append(channel)
+        if len(attempts) == 1:
+            raise psycopg2.OperationalError("no database")
+        return conn
+    mock_bus._listen.side_effect = listen
+    forgotten = []
+    def handler(key):
+        forgotten.append(key)
+        if len(forgotten) == 2:
+            reconnected.set()
+    mock_bus.subscribe('profiles', handler)
+    with patch('select.select', return_value=([conn], [], [])):
+        mock_bus.start()
+        assert reconnected.wait(2)
+        mock_bus.stop(2)
+    assert forgotten[:2] == [None, None]
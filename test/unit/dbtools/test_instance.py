@@ -7,12 +7,12 @@
 from unittest.mock import MagicMock, patch
 import pytest
 
-from psycopg2.extensions import connection, cursor
+from psycopg2.extensions import connection, cursor, TRANSACTION_STATUS_IDLE
 from psycopg2.sql import SQL
 import psycopg2
 
 from sliceoflife_webservice.exceptions import ServiceNotReachable, SliceOfLifeAPIException
-from sliceoflife_webservice.dbtools import Instance
+from sliceoflife_webservice.dbtools import Instance, PoolLimits, Replication
 from sliceoflife_webservice.dbtools.queries.statement import PreparedStatement
 
 class MockConnection(connection):
@@ -20,6 +20,8 @@ class MockConnection(connection):
     def commit(self): pass
     def rollback(self): pass
     def cursor(self): return MockCursor()
+    def get_transaction_status(self): return TRANSACTION_STATUS_IDLE
+    def set_session(self, **kwargs): pass
 
 class MockCursor(cursor):
     def __init__(self): pass
@@ -39,42 +41,120 @@ config = {
 @pytest.fixture
 def mock_database_instance():
     """Test database instance"""
-    return Instance(5, **config)
+    return Instance(PoolLimits(max_size=5, acquire_timeout=0.1), **config)
 
 @pytest.fixture
 def mock_sql_query():
     """Test sql query"""
     return PreparedStatement(SQL("SELECT 1"))
 
-psycopg2.connect = MagicMock(return_value=MockConnection(**config))
+psycopg2.connect = MagicMock(side_effect=lambda **kwargs: MockConnection(**kwargs))
 
 def test_instance_exists(mock_database_instance):
     """Test creation of mocked instance class"""
     assert isinstance(mock_database_instance, Instance)
-    assert len(mock_database_instance._pool) == 5
+    assert len(mock_database_instance._pool) == 0
+    assert mock_database_instance.stats()['max_size'] == 5
 
-def test_all_connections_initially_available(mock_database_instance):
-    """Test that all connection available initially"""
-    assert all(c.available for c in mock_database_instance._pool)
+def test_instance_opens_minimum_connections():
+    """Test that the minimum number of connections are opened up front"""
+    instance = Instance(PoolLimits(max_size=5, min_size=2), **config)
+    assert len(instance._pool) == 2
+    assert all(c.available for c in instance._pool)
 
 def test_borrow_connection_from_pool(mock_database_instance):
     """Test the connection borrowing feature"""
     with mock_database_instance.start_transaction() as conn:
         assert isinstance(conn, MockConnection)
-        assert mock_database_instance._pool[0].available is False
+        assert mock_database_instance.stats()['in_use'] == 1
+        assert len([c for c in mock_database_instance._pool if not c.available]) == 1
 
-    assert mock_database_instance._pool[0].available is True
+    assert mock_database_instance.stats()['in_use'] == 0
+    assert all(c.available for c in mock_database_instance._pool)
 
 def test_exception_raised_if_no_more_connections_to_borrow(mock_database_instance):
     """Test exception raised when no connection available"""
     all_borrowed = [mock_database_instance._getconn() for _ in range(5)]
+    assert len(mock_database_instance._pool) == 5
     assert all(c.available is False for c in mock_database_instance._pool)
     with pytest.raises(ServiceNotReachable):
         mock_database_instance._getconn()
+    assert mock_database_instance.stats()['timeouts'] == 1
     for conn in all_borrowed:
         mock_database_instance._putconn(conn)
     assert all(c.available for c in mock_database_instance._pool)
 
+def test_read_only_transaction_uses_its_own_pool(mock_database_instance):
+    """Test read only transactions borrow autocommit connections from a separate pool"""
+    with patch.object(MockConnection, 'set_session') as mock_session, \
+         patch.object(MockConnection, 'commit') as mock_commit:
+        with mock_database_instance.start_transaction(read_only=True) as conn:
+            assert isinstance(conn, MockConnection)
+            assert mock_database_instance.stats(read_only=True)['in_use'] == 1
+            assert mock_database_instance.stats()['in_use'] == 0
+
+    mock_session.assert_called_once_with(readonly=True, autocommit=True)
+    mock_commit.assert_not_called()
+    assert len(mock_database_instance._read_pool) == 1
+    assert len(mock_database_instance._pool) == 0
+    assert mock_database_instance.stats(read_only=True)['in_use'] == 0
+
+def test_read_only_pool_limits():
+    """Test the read only pool can be sized separately"""
+    instance = Instance(PoolLimits(max_size=5), read_pool_limits=2, **config)
+    assert instance.stats()['max_size'] == 5
+    assert instance.stats(read_only=True)['max_size'] == 2
+    assert Instance(5, **config).stats(read_only=True)['max_size'] == 5
+
+def test_reads_are_routed_to_replicas():
+    """Test read only transactions go to the replicas and writes go to the primary"""
+    instance = Instance(5, replication=Replication(replicas=[{'host': 'replica1'},
+                                                             {'host': 'replica2'}]), **config)
+    with patch('psycopg2.connect', side_effect=lambda **kwargs: MockConnection(**kwargs)) as mock_connect:
+        for _ in range(2):
+            with instance.start_transaction(read_only=True):
+                pass
+        with instance.start_transaction():
+            pass
+
+    hosts = [c.kwargs['host'] for c in mock_connect.call_args_list]
+    assert hosts == ['replica1', 'replica2', config['host']]
+    assert [len(pool) for pool in instance._replica_pools] == [1, 1]
+    assert [s['in_use'] for s in instance.replica_stats()] == [0, 0]
+    assert len(instance._read_pool) == 0
+
+def test_reads_fall_back_to_primary_when_replicas_are_down():
+    """Test a read only transaction is served by the primary when no replica is reachable"""
+    instance = Instance(5, replication=Replication(replicas=[{'host': 'replica1'}]), **config)
+    def connect(**kwargs):
+        if kwargs['host'] == 'replica1':
+            raise psycopg2.OperationalError("replica is down")
+        return MockConnection(**kwargs)
+
+    with patch('psycopg2.connect', side_effect=connect):
+        with instance.start_transaction(read_only=True) as conn:
+            assert isinstance(conn, MockConnection)
+            assert instance.stats(read_only=True)['in_use'] == 1
+
+def test_reads_after_own_write_stay_on_primary():
+    """Test a writer's next reads go to the primary so they see their write"""
+    instance = Instance(5, replication=Replication(replicas=[{'host': 'replica1'}]), **config)
+    with instance.start_transaction(consistent_for='user1'):
+        pass
+    with instance.start_transaction(read_only=True, consistent_for='user1'):
+        assert instance.stats(read_only=True)['in_use'] == 1
+    with instance.start_transaction(read_only=True, consistent_for='user2'):
+        assert instance.replica_stats()[0]['in_use'] == 1
+
+def test_failed_write_does_not_stick_to_primary():
+    """Test a rolled back write does not keep the writer's reads on the primary"""
+    instance = Instance(5, replication=Replication(replicas=[{'host': 'replica1'}]), **config)
+    with pytest.raises(SliceOfLifeAPIException):
+        with instance.start_transaction(consistent_for='user1'):
+            raise SliceOfLifeAPIException()
+    with instance.start_transaction(read_only=True, consistent_for='user1'):
+        assert instance.replica_stats()[0]['in_use'] == 1
+
 def test_query_cannot_be_made_with_non_connection_object(mock_sql_query):
     """Test query prohibition without borrowed connection"""
     with pytest.raises(ServiceNotReachable):
@@ -103,3 +183,102 @@ def test_transaction_rollback_when_failure(mock_database_instance):
                 raise ServiceNotReachable("The database transaction failed")
 
         assert mock_cancel.called
+
+def test_transaction_rollback_on_any_exception(mock_database_instance):
+    with patch('test_instance.MockConnection.rollback') as mock_cancel:
+        with pytest.raises(ValueError):
+            with mock_database_instance.start_transaction():
+                raise ValueError("Not an API exception")
+
+        assert mock_cancel.called
+    assert mock_database_instance.stats()['in_use'] == 0
+
+def test_lost_connection_during_transaction(mock_database_instance):
+    with pytest.raises(ServiceNotReachable):
+        with mock_database_instance.start_transaction():
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    assert mock_database_instance.stats()['in_use'] == 0
+
+@pytest.fixture
+def mock_named_query():
+    """Test sql query made from a named template"""
+    return PreparedStatement(SQL("SELECT * FROM Users u WHERE u.handle = %(handle)s OR u.email = %(handle)s"),
+                             name='user_lookup', handle='user1')
+
+def test_named_query_is_prepared_once_per_connection(mock_database_instance, mock_named_query):
+    with patch.object(MockCursor, 'execute') as mock_execute:
+        with mock_database_instance.start_transaction() as conn:
+            Instance.query(conn, mock_named_query)
+            Instance.query(conn, mock_named_query)
+
+    statements = [c.args[0] for c in mock_execute.call_args_list]
+    assert statements == [
+        'PREPARE sliceoflife_user_lookup AS SELECT * FROM Users u WHERE u.handle = $1 OR u.email = $1',
+        'EXECUTE sliceoflife_user_lookup (%(handle)s)',
+        'EXECUTE sliceoflife_user_lookup (%(handle)s)'
+    ]
+    assert mock_execute.call_args_list[-1].args[1] == {'handle': 'user1'}
+
+def test_least_recently_used_statement_is_deallocated(mock_sql_query):
+    instance = Instance(PoolLimits(max_size=1), statement_cache_size=2, **config)
+    queries = [PreparedStatement(SQL("SELECT %(n)s"), name=f'q{i}', n=i) for i in range(3)]
+    with patch.object(MockCursor, 'execute') as mock_execute:
+        with instance.start_transaction() as conn:
+            Instance.query(conn, queries[0])
+            Instance.query(conn, queries[1])
+            Instance.query(conn, queries[0])
+            Instance.query(conn, queries[2])
+
+    statements = [c.args[0] for c in mock_execute.call_args_list]
+    assert 'DEALLOCATE sliceoflife_q1' in statements
+    assert statements.count('PREPARE sliceoflife_q0 AS SELECT $1') == 1
+
+def test_unnamed_and_foreign_queries_are_not_prepared(mock_database_instance, mock_sql_query, mock_named_query):
+    with patch.object(MockCursor, 'execute') as mock_execute:
+        with mock_database_instance.start_transaction() as conn:
+            Instance.query(conn, mock_sql_query)
+        Instance.query(MockConnection(**config), mock_named_query)
+
+    assert mock_execute.call_args_list[0].args == (mock_sql_query.statement, {})
+    assert mock_execute.call_args_list[1].args == (mock_named_query.statement, {'handle': 'user1'})
+
+def test_statement_cache_disabled():
+    instance = Instance(PoolLimits(max_size=1), statement_cache_size=0, **config)
+    with instance.start_transaction() as conn:
+        assert conn not in Instance._statement_caches
+
+def test_forgotten_statements_are_prepared_again(mock_database_instance, mock_named_query):
+    with patch.object(MockCursor, 'execute') as mock_execute:
+        with mock_database_instance.start_transaction() as conn:
+            Instance.query(conn, mock_named_query)
+            mock_execute.side_effect = psycopg2.errors.InvalidSqlStatementName
+            with pytest.raises(psycopg2.errors.InvalidSqlStatementName):
+                Instance.query_no_fetch(conn, mock_named_query)
+            mock_execute.side_effect = None
+            Instance.query(conn, mock_named_query)
+
+    statements = [c.args[0] for c in mock_execute.call_args_list]
+    assert statements.count('PREPARE sliceoflife_user_lookup AS SELECT * FROM Users u WHERE u.handle = $1 OR u.email = $1') == 2
+
+def test_query_is_not_rendered_unless_debugging(mock_database_instance):
+    query = MagicMock(spec=PreparedStatement, parameters={})
+    query.name = None
+    with mock_database_instance.start_transaction() as conn:
+        with patch('sliceoflife_webservice.dbtools.instance.LOGGER') as mock_logger:
+            mock_logger.isEnabledFor.return_value = False
+            Instance.query_no_fetch(conn, query)
+            query.statement.as_string.assert_not_called()
+            mock_logger.isEnabledFor.return_value = True
+            Instance.query_no_fetch(conn, query)
+            query.statement.as_string.assert_called_once_with(conn)
+
+def test_listen_opens_dedicated_connection(mock_database_instance):
+    """Test a listening connection is made outside of the pools"""
+    with patch.object(MockCursor, 'execute') as mock_execute:
+        with patch.object(MockConnection, 'set_session') as mock_session:
+            conn = mock_database_instance.listen('changes')
+            assert isinstance(conn, MockConnection)
+            mock_session.assert_called_once_with(autocommit=True)
+            assert 'LISTEN' in repr(mock_execute.call_args[0][0])
+            assert 'changes' in repr(mock_execute.call_args[0][0])
+    assert len(mock_database_instance._pool) == 0
@@ -0,0 +1,200 @@
+"""
+    module_name: test_pool
+    module_summary: tests for the ConnectionPool class
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR, \
+                               TRANSACTION_STATUS_UNKNOWN
+
+from sliceoflife_webservice.exceptions import ServiceNotReachable
+from sliceoflife_webservice.dbtools.pool import ConnectionPool, PoolLimits
+
+def mock_connect():
+    """Open a mocked connection that is healthy and idle"""
+    conn = MagicMock(closed=0)
+    conn.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+    return conn
+
+@pytest.fixture
+def mock_pool():
+    """Test pool of up to two mocked connections"""
+    return ConnectionPool(mock_connect, PoolLimits(max_size=2, acquire_timeout=0.1))
+
+def test_pool_is_empty_on_creation(mock_pool):
+    """Test that the pool opens connections lazily"""
+    assert len(mock_pool) == 0
+    assert mock_pool.stats()['opened'] == 0
+
+def test_pool_opens_minimum_on_creation():
+    """Test that the pool opens its minimum number of connections up front"""
+    pool = ConnectionPool(mock_connect, PoolLimits(max_size=4, min_size=2))
+    assert len(pool) == 2
+    assert all(c.available for c in pool)
+    assert pool.stats()['idle'] == 2
+
+def test_pool_grows_on_demand(mock_pool):
+    """Test that the pool opens connections only when none are idle"""
+    conn = mock_pool.getconn()
+    assert len(mock_pool) == 1
+    mock_pool.putconn(conn)
+    assert mock_pool.getconn() is conn
+    assert len(mock_pool) == 1
+    mock_pool.getconn()
+    assert len(mock_pool) == 2
+
+def test_borrowed_connections_are_distinct(mock_pool):
+    """Test that a connection is lent to one borrower at a time"""
+    first, second = mock_pool.getconn(), mock_pool.getconn()
+    assert first is not second
+    assert mock_pool.stats()['in_use'] == 2
+    assert mock_pool.stats()['utilization'] == 1.0
+
+def test_borrow_times_out_when_exhausted(mock_pool):
+    """Test that borrowing gives up after the acquire timeout"""
+    mock_pool.getconn()
+    mock_pool.getconn()
+    started = time.monotonic()
+    with pytest.raises(ServiceNotReachable):
+        mock_pool.getconn()
+    assert time.monotonic() - started >= 0.1
+    assert mock_pool.stats()['timeouts'] == 1
+    assert mock_pool.stats()['waiting'] == 0
+
+def test_waiting_borrower_receives_returned_connection(mock_pool):
+    """Test that a waiting borrower is handed a connection when one is returned"""
+    first = mock_pool.getconn()
+    mock_pool.getconn()
+    threading.Timer(0.02, mock_pool.putconn, args=(first,)).start()
+    assert mock_pool.getconn(timeout=1) is first
+    assert mock_pool.stats()['wait_time_max'] > 0
+
+def test_waiting_borrowers_are_served_in_order(mock_pool):
+    """Test that returned connections go to waiters first come first served"""
+    held = [mock_pool.getconn(), mock_pool.getconn()]
+    served = []
+
+    def borrow(name):
+        mock_pool.getconn(timeout=1)
+        served.append(name)
+
+    waiters = []
+    for name in range(2):
+        waiter = threading.Thread(target=borrow, args=(name,))
+        waiter.start()
+        waiters.append(waiter)
+        while mock_pool.stats()['waiting'] != name + 1:
+            time.sleep(0.001)
+    for conn in held:
+        mock_pool.putconn(conn)
+    for waiter in waiters:
+        waiter.join()
+    assert served == [0, 1]
+
+def test_returning_a_foreign_connection_is_ignored(mock_pool):
+    """Test that connections the pool did not lend are not adopted"""
+    mock_pool.putconn(mock_pool.getconn())
+    mock_pool.putconn(MagicMock())
+    assert len(mock_pool) == 1
+    assert mock_pool.stats()['idle'] == 1
+
+def test_failed_growth_is_reported_as_unreachable():
+    """Test that a failure to open a connection does not use up pool capacity"""
+    connect = MagicMock(side_effect=psycopg2.OperationalError)
+    pool = ConnectionPool(connect, PoolLimits(max_size=1, acquire_timeout=0.1))
+    with pytest.raises(ServiceNotReachable):
+        pool.getconn()
+    connect.side_effect = None
+    assert pool.getconn()
+
+def test_idle_connections_above_minimum_are_reaped():
+    """Test that stale idle connections are closed down to the minimum size"""
+    pool = ConnectionPool(mock_connect, PoolLimits(max_size=3, min_size=1, idle_timeout=60))
+    borrowed = [pool.getconn() for _ in range(3)]
+    for conn in borrowed:
+        pool.putconn(conn)
+    assert pool.reap() == 0
+    with patch('time.monotonic', return_value=time.monotonic() + 61):
+        assert pool.reap() == 2
+    assert len(pool) == 1
+    assert pool.stats()['closed'] == 2
+    assert sum(conn.close.called for conn in borrowed) == 2
+
+def test_reaper_shrinks_a_quiet_pool():
+    """Test that the background reaper closes idle connections without new requests"""
+    pool = ConnectionPool(mock_connect, PoolLimits(max_size=2, idle_timeout=0.02))
+    pool.putconn(pool.getconn())
+    deadline = time.monotonic() + 1
+    while len(pool) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(pool) == 0
+
+def test_connection_is_rolled_back_when_returned_mid_transaction(mock_pool):
+    """Test that connections are reset before they are lent again"""
+    conn = mock_pool.getconn()
+    conn.get_transaction_status.return_value = TRANSACTION_STATUS_INERROR
+    mock_pool.putconn(conn)
+    assert conn.rollback.called
+    assert mock_pool.stats()['idle'] == 1
+
+@pytest.mark.parametrize('breakage', [
+    {'closed': 2},
+    {'get_transaction_status.return_value': TRANSACTION_STATUS_UNKNOWN},
+    {'rollback.side_effect': psycopg2.InterfaceError,
+     'get_transaction_status.return_value': TRANSACTION_STATUS_INERROR},
+])
+def test_broken_connection_is_discarded_when_returned(mock_pool, breakage):
+    """Test that connections that cannot be reset are closed"""
+    conn = mock_pool.getconn()
+    conn.configure_mock(**breakage)
+    mock_pool.putconn(conn)
+    assert conn.close.called
+    assert len(mock_pool) == 0
+    assert mock_pool.stats()['in_use'] == 0
+
+def test_dead_idle_connection_is_replaced_on_borrow(mock_pool):
+    """Test that a connection that died while idle is swapped for a new one"""
+    conn = mock_pool.getconn()
+    mock_pool.putconn(conn)
+    conn.closed = 1
+    replacement = mock_pool.getconn()
+    assert replacement is not conn
+    assert len(mock_pool) == 1
+    assert mock_pool.stats()['closed'] == 1
+
+def test_stale_idle_connection_is_pinged_on_borrow():
+    """Test that long idle connections must pass a liveness check before being lent"""
+    pool = ConnectionPool(mock_connect, PoolLimits(max_size=1, check_after=5))
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert not conn.cursor.called
+    pool.putconn(conn)
+    conn.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError
+    with patch('time.monotonic', return_value=time.monotonic() + 6):
+        assert pool.getconn() is not conn
+    assert conn.close.called
+
+def test_old_connection_is_recycled():
+    """Test that connections past their maximum age are replaced"""
+    pool = ConnectionPool(mock_connect, PoolLimits(max_size=1, max_age=60))
+    conn = pool.getconn()
+    with patch('time.monotonic', return_value=time.monotonic() + 61):
+        pool.putconn(conn)
+    assert conn.close.called
+    assert len(pool) == 0
+
+def test_waiter_gets_replacement_for_discarded_connection(mock_pool):
+    """Test that discarding a connection makes room for a waiting borrower"""
+    held = [mock_pool.getconn(), mock_pool.getconn()]
+    held[0].closed = 2
+    threading.Timer(0.02, mock_pool.putconn, args=(held[0],)).start()
+    replacement = mock_pool.getconn(timeout=1)
+    assert replacement not in held
+    assert len(mock_pool) == 2
@@ -0,0 +1,86 @@
+"""
+    module_name: test_routing
+    module_summary: tests for the ReadRouter class
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+from unittest.mock import MagicMock
+
+import pytest
+from freezegun import freeze_time
+
+from sliceoflife_webservice.dbtools.pool import ConnectionPool
+from sliceoflife_webservice.dbtools.routing import ReadRouter, Replication
+from sliceoflife_webservice.toolkit import ExpiringLRUCache, SharedCache
+
+@pytest.fixture
+def mock_replica_pools():
+    """Test pools for three replicas"""
+    return [MagicMock(spec=ConnectionPool) for _ in range(3)]
+
+def test_round_robin_takes_turns(mock_replica_pools):
+    """Test that each read starts with the next replica"""
+    router = ReadRouter(mock_replica_pools, Replication(policy='round_robin'))
+    first = [router.candidates()[0] for _ in range(6)]
+    assert first == mock_replica_pools * 2
+    assert set(router.candidates()) == set(mock_replica_pools)
+
+def test_least_busy_prefers_idle_replicas(mock_replica_pools):
+    """Test that the replica with the fewest connections in use is tried first"""
+    for pool, in_use in zip(mock_replica_pools, [3, 0, 1]):
+        pool.in_use.return_value = in_use
+    router = ReadRouter(mock_replica_pools, Replication(policy='least_busy'))
+    assert router.candidates() == [mock_replica_pools[1],
+                                   mock_replica_pools[2],
+                                   mock_replica_pools[0]]
+
+def test_unknown_policy():
+    """Test that a misspelled policy is caught up front"""
+    with pytest.raises(ValueError):
+        ReadRouter([], Replication(policy='random'))
+
+def test_no_replicas():
+    """Test that every read goes to the primary without replicas"""
+    router = ReadRouter([], Replication())
+    router.record_write('user1')
+    assert router.candidates('user1') == []
+    assert router.candidates() == []
+
+def test_reads_stick_to_primary_after_a_write(mock_replica_pools):
+    """Test that a writer reads from the primary until the sticky window passes"""
+    router = ReadRouter(mock_replica_pools, Replication(sticky_window=5.0))
+    with freeze_time('2023-01-01 00:00:00') as frozen:
+        router.record_write('user1')
+        assert router.candidates('user1') == []
+        assert router.candidates('user2')
+        assert router.candidates()
+        assert router.wrote_recently('user1')
+        assert not router.wrote_recently('user2')
+        assert not router.wrote_recently(None)
+        frozen.tick(6)
+        assert router.candidates('user1')
+        assert not router.wrote_recently('user1')
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_workers_share_recent_writes(mock_replica_pools, tmp_path, shared):
+    """Test that a write recorded by one worker keeps the writer's reads on the primary in another"""
+    if shared:
+        caches = [SharedCache(str(tmp_path / 'writes.cache'), 16) for _ in range(2)]
+    else:
+        caches = [ExpiringLRUCache(16)] * 2
+    writer, reader = (ReadRouter(mock_replica_pools, Replication(recent_writes=cache))
+                      for cache in caches)
+    writer.record_write('user1')
+    assert reader.candidates('user1') == []
+    assert reader.candidates('user2')
+
+def test_recent_writes_expire_lazily(mock_replica_pools):
+    """Test that a writer is forgotten once the window passes, without scanning other writers"""
+    writes = ExpiringLRUCache(16)
+    router = ReadRouter(mock_replica_pools, Replication(sticky_window=5.0, recent_writes=writes))
+    with freeze_time('2023-01-01 00:00:00') as frozen:
+        router.record_write('user1')
+        router.record_write('user2')
+        frozen.tick(6)
+        assert router.candidates('user1')
+        assert len(writes) == 1
@@ -4,6 +4,7 @@
     :module_author: Nathan Mendoza (nathancm@uci.edu)
 """
 
+from io import BytesIO
 from unittest.mock import patch
 
 from sliceoflife_webservice import app
@@ -11,6 +12,7 @@ from sliceoflife_webservice.api import BaseSliceOfLifeApiResponse
 from sliceoflife_webservice.api.get import SliceOfLifeApiGetResponse
 from sliceoflife_webservice.api.post import SliceOfLifeApiPostResponse
 from sliceoflife_webservice.api.options import SliceOfLifeApiOptionsResponse
+from sliceoflife_webservice.toolkit import SpaceIndex
 
 import pytest
 from flask import request
@@ -26,6 +28,13 @@ def test_greeting_endpoint(mock_get, test_client):
     assert response.request.method == 'GET'
     assert mock_get.called
 
+@patch.object(SliceOfLifeApiGetResponse, 'get_service_stats')
+def test_service_stats_endpoint(mock_get, test_client):
+    response = test_client.get('/api/v1/stats')
+    assert response.request.path == '/api/v1/stats'
+    assert response.request.method == 'GET'
+    assert mock_get.called
+
 @patch.object(SliceOfLifeApiGetResponse, 'get_latest_posts')
 def test_latest_posts_endpoint(mock_get, test_client):
     response = test_client.get('/api/v1/slices/latest')
@@ -93,3 +102,65 @@ def test_post_creation_endpoint(mock_post, test_client):
     assert response.request.path == '/api/v1/slices/new'
     assert response.request.method == 'POST'
     assert mock_post.called
+
+@patch.object(SliceOfLifeApiPostResponse, 'start_post_upload')
+def test_post_upload_start_endpoint(mock_post, test_client):
+    response = test_client.post('/api/v1/slices/upload')
+    assert response.request.path == '/api/v1/slices/upload'
+    assert response.request.method == 'POST'
+    assert mock_post.called
+
+@patch.object(SliceOfLifeApiPostResponse, 'finish_post_upload')
+def test_post_upload_finish_endpoint(mock_post, test_client):
+    response = test_client.post('/api/v1/slices/upload/finish')
+    assert response.request.path == '/api/v1/slices/upload/finish'
+    assert response.request.method == 'POST'
+    assert mock_post.called
+
+@pytest.fixture
+def local_spaces(tmp_path):
+    spaces = SpaceIndex(SPACES_BACKEND='local', SPACES_ROOT=str(tmp_path),
+                        SPACES_LOCAL_URL='http://localhost', SPACES_LOCAL_KEY='secret')
+    spaces.create_session()
+    spaces.save_file('images/ab/abc.png', BytesIO(b'0123456789'), 'image/png')
+    with patch.object(BaseSliceOfLifeApiResponse, '_space', spaces):
+        yield spaces
+
+def test_stored_file_endpoint(local_spaces, test_client):
+    link = local_spaces.get_share_link('images/ab/abc.png')
+    response = test_client.get(link)
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+    assert response.mimetype == 'image/png'
+
+    partial = test_client.get(link, headers={'Range': 'bytes=2-5'})
+    assert partial.status_code == 206
+    assert partial.data == b'2345'
+
+    cached = test_client.get(link, headers={'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+
+def test_stored_file_endpoint_rejects_bad_links(local_spaces, test_client):
+    assert test_client.get('/api/v1/files/images/ab/abc.png?expires=1&signature=x').status_code == 401
+    link = local_spaces.get_share_link('images/ab/missing.png')
+    assert test_client.get(link).status_code == 404
+
+PNG_IMAGE = b'\x89PNG\r\n\x1a\n uploaded'
+
+def test_stored_file_upload_endpoint(local_spaces, test_client):
+    link = local_spaces.get_upload_link('posts/user1/task1.png', 'image/png')
+    response = test_client.put(link, data=PNG_IMAGE, content_type='image/png')
+    assert response.status_code == 200
+    assert local_spaces.read_file('posts/user1/task1.png') == PNG_IMAGE
+    assert test_client.put(link, data=PNG_IMAGE, content_type='text/html').status_code == 401
+
+@pytest.mark.parametrize('data, status', [
+    (b'#!/bin/sh pretending to be a png', 415),
+    (b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01 a jpeg', 415),
+    (PNG_IMAGE + b'0' * 64, 413)
+])
+def test_stored_file_upload_endpoint_checks_uploads(local_spaces, test_client, data, status):
+    link = local_spaces.get_upload_link('posts/user1/task1.png', 'image/png')
+    with patch.object(BaseSliceOfLifeApiResponse, 'max_upload_bytes', 48):
+        assert test_client.put(link, data=data, content_type='image/png').status_code == status
+    assert not local_spaces.file_exists('posts/user1/task1.png')
@@ -0,0 +1,89 @@
+"""
+    module_name: test_cache
+    module_summary: test the ExpiringLRUCache class from toolkit module
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import pytest
+from freezegun import freeze_time
+
+from sliceoflife_webservice.toolkit import ExpiringLRUCache
+
+@pytest.fixture
+def mock_cache():
+    """Test cache of two entries that expire after a minute"""
+    return ExpiringLRUCache(2, ttl=60)
+
+def test_cached_values_are_returned(mock_cache):
+    """Test a stored value is found again"""
+    mock_cache.put('key', 'value')
+    assert mock_cache.get('key') == 'value'
+    assert mock_cache.get('other') is None
+    assert mock_cache.get('other', 'default') == 'default'
+    assert mock_cache.stats()['hits'] == 1
+    assert mock_cache.stats()['misses'] == 2
+
+def test_least_recently_used_value_is_evicted(mock_cache):
+    """Test the cache stays within its capacity"""
+    mock_cache.put('a', 1)
+    mock_cache.put('b', 2)
+    mock_cache.get('a')
+    mock_cache.put('c', 3)
+    assert len(mock_cache) == 2
+    assert mock_cache.get('b') is None
+    assert mock_cache.get('a') == 1
+    assert mock_cache.get('c') == 3
+
+def test_values_expire(mock_cache):
+    """Test entries are forgotten after their ttl"""
+    with freeze_time('2023-01-01 00:00:00') as frozen:
+        mock_cache.put('default', 1)
+        mock_cache.put('longer', 2, ttl=120)
+        frozen.tick(61)
+        assert mock_cache.get('default') is None
+        assert mock_cache.get('longer') == 2
+        assert len(mock_cache) == 1
+
+def test_values_can_be_invalidated(mock_cache):
+    """Test entries can be forgotten on demand"""
+    mock_cache.put('a', 1)
+    mock_cache.put('b', 2)
+    mock_cache.invalidate('a')
+    assert mock_cache.get('a') is None
+    mock_cache.clear()
+    assert len(mock_cache) == 0
+
+def test_matching_values_can_be_invalidated(mock_cache):
+    """Test a group of entries can be forgotten at once"""
+    mock_cache.put(('latest', 1), 1)
+    mock_cache.put(('slice', 1), 2)
+    mock_cache.invalidate_matching(lambda key: key[0] == 'latest')
+    assert mock_cache.get(('latest', 1)) is None
+    assert mock_cache.get(('slice', 1)) == 2
+
+def test_cache_without_capacity_stores_nothing():
+    """Test a cache can be disabled by giving it no room"""
+    cache = ExpiringLRUCache(0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+
+def test_cache_bounded_by_bytes():
+    """Test entries are evicted to keep the cached bytes within the limit"""
+    cache = ExpiringLRUCache(16, max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'5678')
+    assert cache.get('a') == b'1234'
+    cache.put('c', b'90ab')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.stats()['bytes'] == 8
+    cache.put('a', b'12')
+    assert cache.stats()['bytes'] == 6
+    cache.put('d', b'x' * 11)
+    assert cache.get('d') is None
+    assert cache.stats()['bytes'] == 6
+    assert cache.stats()['oversize'] == 1
+    cache.invalidate('a')
+    assert cache.stats()['bytes'] == 4
+    cache.clear()
+    assert cache.stats()['bytes'] == 0
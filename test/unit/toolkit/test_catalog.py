@@ -0,0 +1,55 @@
+"""
+    module_name: test_catalog
+    module_summary: test the TaskCatalog class from toolkit module
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+from unittest.mock import MagicMock
+
+import pytest
+from freezegun import freeze_time
+
+from sliceoflife_webservice.toolkit import TaskCatalog
+from sliceoflife_webservice.dbtools.schema import Task
+
+@pytest.fixture
+def mock_load():
+    """Test loader for a catalog of three tasks"""
+    return MagicMock(return_value=[
+        Task(1, 'task1', 'task1 description', True),
+        Task(2, 'task2', 'task2 description', True),
+        Task(3, 'task3', 'task3 description', True)
+    ])
+
+def test_catalog_is_loaded_once(mock_load):
+    """Test tasks are shared until they go stale"""
+    with freeze_time('2023-01-01 00:00:00') as frozen:
+        catalog = TaskCatalog(ttl=60)
+        assert [t.task_id for t in catalog.tasks(mock_load)] == [1, 2, 3]
+        catalog.tasks(mock_load)
+        assert mock_load.call_count == 1
+        frozen.tick(61)
+        catalog.tasks(mock_load)
+        assert mock_load.call_count == 2
+        assert catalog.stats() == {'size': 3, 'loads': 2}
+
+def test_catalog_can_be_invalidated(mock_load):
+    """Test an invalidated catalog is loaded again"""
+    catalog = TaskCatalog()
+    catalog.tasks(mock_load)
+    catalog.invalidate()
+    assert catalog.stats()['size'] == 0
+    catalog.tasks(mock_load)
+    assert mock_load.call_count == 2
+
+@pytest.mark.parametrize('completed_ids, completed, available', [
+    ([], [], [1, 2, 3]),
+    ([2, 3], [2, 3], [1]),
+    ([3, 1], [1, 3], [2]),
+    ([1, 2, 3, 4], [1, 2, 3], [])
+])
+def test_catalog_partition(mock_load, completed_ids, completed, available):
+    """Test the catalog is split into completed and available tasks in order"""
+    done, todo = TaskCatalog().partition(mock_load, completed_ids)
+    assert [t.task_id for t in done] == completed
+    assert [t.task_id for t in todo] == available
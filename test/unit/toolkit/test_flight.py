@@ -0,0 +1,61 @@
+"""
+    module_name: test_flight
+    module_summary: test the SingleFlight class from toolkit module
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from sliceoflife_webservice.toolkit import SingleFlight
+
+CALLERS = 8
+
+def wait_for_followers(flights: SingleFlight, followers: int):
+    """Block until the given number of callers are waiting on the running call"""
+    deadline = time.monotonic() + 5
+    while flights.stats()['shared'] < followers and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+def test_concurrent_calls_share_one_result():
+    """Test callers that arrive while a call is running get its result"""
+    flights = SingleFlight()
+    calls = []
+    def call():
+        calls.append(1)
+        wait_for_followers(flights, CALLERS - 1)
+        return ['result']
+    with ThreadPoolExecutor(CALLERS) as pool:
+        results = list(pool.map(lambda _: flights.do('key', call), range(CALLERS)))
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    assert flights.stats() == {'in_flight': 0, 'shared': CALLERS - 1}
+
+def test_concurrent_calls_share_one_error():
+    """Test callers that arrive while a call is running get its exception"""
+    flights = SingleFlight()
+    def call():
+        wait_for_followers(flights, CALLERS - 1)
+        raise KeyError('key')
+    def caller(_):
+        with pytest.raises(KeyError):
+            flights.do('key', call)
+    with ThreadPoolExecutor(CALLERS) as pool:
+        list(pool.map(caller, range(CALLERS)))
+    assert flights.stats()['in_flight'] == 0
+
+def test_finished_calls_are_not_reused():
+    """Test a call made after another finishes runs again"""
+    flights = SingleFlight()
+    results = iter([1, 2])
+    assert flights.do('key', lambda: next(results)) == 1
+    assert flights.do('key', lambda: next(results)) == 2
+
+def test_different_keys_do_not_share():
+    """Test calls with different keys run independently"""
+    flights = SingleFlight()
+    assert flights.do('a', lambda: 'a') == 'a'
+    assert flights.do('b', lambda: 'b') == 'b'
+    assert flights.stats()['shared'] == 0
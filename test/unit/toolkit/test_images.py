@@ -0,0 +1,143 @@
+"""
+    module_name: test_images
+    module_summary: test the image derivative pipeline from toolkit module
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import threading
+from io import BytesIO
+from unittest.mock import MagicMock
+
+import pytest
+from freezegun import freeze_time
+from PIL import Image
+
+from sliceoflife_webservice.toolkit import ImagePipeline, SpaceIndex, derivative_key, \
+                                           closest_width, make_derivatives, can_decode
+from sliceoflife_webservice.exceptions import ServiceNotReachable
+
+def encode_image(width: int, height: int, image_format: str = 'PNG') -> bytes:
+    """Make an image file of the given size"""
+    encoded = BytesIO()
+    Image.new('RGB', (width, height), 'orange').save(encoded, format=image_format)
+    return encoded.getvalue()
+
+@pytest.fixture
+def mock_spaces():
+    """Test space index holding a single 1000x500 image"""
+    spaces = MagicMock(spec=SpaceIndex)
+    spaces.read_file.return_value = encode_image(1000, 500, 'JPEG')
+    spaces.file_exists.return_value = False
+    return spaces
+
+def test_derivative_keys():
+    """Test derivatives are saved next to their original"""
+    assert derivative_key('posts/user/task1.png', 320) == 'posts/user/task1.w320.webp'
+    assert derivative_key('unknown.jpg', 640) == 'unknown.w640.webp'
+
+@pytest.mark.parametrize('size_hint, width', [(1, 320), (320, 320), (321, 640), (5000, 1280)])
+def test_closest_width(size_hint, width):
+    """Test the narrowest derivative that is wide enough is chosen"""
+    assert closest_width(size_hint) == width
+
+def test_make_derivatives():
+    """Test derivatives are WebP copies that are never enlarged"""
+    derivatives = make_derivatives(encode_image(1000, 500))
+    sizes = {width: Image.open(BytesIO(encoded)).size for width, encoded in derivatives.items()}
+    assert sizes == {320: (320, 160), 640: (640, 320), 1280: (1000, 500)}
+    assert all(Image.open(BytesIO(encoded)).format == 'WEBP' for encoded in derivatives.values())
+
+def test_pipeline_saves_derivatives(mock_spaces):
+    """Test submitted images have their derivatives saved and served"""
+    pipeline = ImagePipeline(mock_spaces)
+    pipeline.submit('posts/user/task1.jpg').result()
+    saved = [c.args[0] for c in mock_spaces.save_file.call_args_list]
+    assert saved == ['posts/user/task1.w320.webp',
+                     'posts/user/task1.w640.webp',
+                     'posts/user/task1.w1280.webp']
+    assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.w320.webp'
+    assert not mock_spaces.file_exists.called
+
+def test_pipeline_survives_bad_images(mock_spaces):
+    """Test a file that cannot be read as an image is skipped, and not tried again soon"""
+    mock_spaces.read_file.return_value = b'not an image'
+    pipeline = ImagePipeline(mock_spaces)
+    with freeze_time('2023-01-01 00:00:00') as frozen:
+        pipeline.submit('posts/user/task1.jpg').result()
+        assert not mock_spaces.save_file.called
+        frozen.tick(ImagePipeline.PENDING_RECHECK + 1)
+        assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.jpg'
+        pipeline._executor.shutdown()
+    assert mock_spaces.read_file.call_count == 1
+    assert not mock_spaces.file_exists.called
+
+def test_pipeline_retries_images_it_could_not_read(mock_spaces):
+    """Test an image that could not be downloaded is looked at again when next asked for"""
+    mock_spaces.read_file.side_effect = ServiceNotReachable()
+    pipeline = ImagePipeline(mock_spaces)
+    pipeline.submit('posts/user/task1.jpg').result()
+    assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.jpg'
+    pipeline._executor.shutdown()
+    assert mock_spaces.read_file.call_count == 2
+
+@pytest.mark.parametrize('submitted', [True, False])
+def test_undecodable_types_are_never_downloaded(mock_spaces, submitted):
+    """Test images Pillow has no plugin for are served as they are, without asking storage"""
+    pipeline = ImagePipeline(mock_spaces)
+    if submitted:
+        pipeline.submit('images/ab/abc.heic').result()
+    assert pipeline.variant_for('images/ab/abc.heic', 300) == 'images/ab/abc.heic'
+    pipeline._executor.shutdown()
+    assert pipeline.variant_for('images/ab/abc.heic', 300) == 'images/ab/abc.heic'
+    assert not mock_spaces.read_file.called
+    assert not mock_spaces.file_exists.called
+
+@pytest.mark.parametrize('image, decodable', [
+    ('images/ab/abc.jpg', True),
+    ('images/ab/abc.PNG', True),
+    ('images/ab/abc.webp', True),
+    ('images/ab/abc.heic', False),
+    ('images/ab/abc', False)
+])
+def test_can_decode(image, decodable):
+    """Test images are only decoded if a Pillow plugin is installed for their type"""
+    assert can_decode(image) is decodable
+
+def test_variant_falls_back_to_original(mock_spaces):
+    """Test the original is served, without asking storage, until derivatives are ready"""
+    looked = threading.Event()
+    mock_spaces.file_exists.side_effect = lambda variant: looked.wait(5) and False
+    pipeline = ImagePipeline(mock_spaces)
+    assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.jpg'
+    assert pipeline.variant_for('posts/user/task1.jpg', 640) == 'posts/user/task1.jpg'
+    looked.set()
+    pipeline._executor.shutdown()
+    assert mock_spaces.file_exists.call_count == 1
+
+def test_old_images_get_derivatives_in_the_background(mock_spaces):
+    """Test an image saved before derivatives were made gets them once it is asked for"""
+    pipeline = ImagePipeline(mock_spaces)
+    assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.jpg'
+    pipeline._executor.shutdown()
+    assert mock_spaces.save_file.call_count == 3
+    assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.w320.webp'
+
+def test_variant_made_by_another_worker(mock_spaces):
+    """Test derivatives made elsewhere are found in storage"""
+    mock_spaces.file_exists.return_value = True
+    pipeline = ImagePipeline(mock_spaces)
+    assert pipeline.variant_for('posts/user/task1.jpg', 600) == 'posts/user/task1.jpg'
+    pipeline._executor.shutdown()
+    assert pipeline.variant_for('posts/user/task1.jpg', 600) == 'posts/user/task1.w640.webp'
+    assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.w320.webp'
+    assert mock_spaces.file_exists.call_count == 3
+    assert not mock_spaces.save_file.called
+
+def test_variant_when_storage_fails(mock_spaces):
+    """Test an image whose derivatives cannot be looked for is served as is, and looked at again later"""
+    mock_spaces.file_exists.side_effect = ServiceNotReachable()
+    pipeline = ImagePipeline(mock_spaces)
+    assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.jpg'
+    pipeline._executor.shutdown()
+    assert pipeline.variant_for('posts/user/task1.jpg', 300) == 'posts/user/task1.jpg'
+    assert mock_spaces.file_exists.call_count == 1
@@ -0,0 +1,80 @@
+"""
+    module_name: test_media
+    module_summary: test the image recognition functions from toolkit module
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+from io import BytesIO
+
+import pytest
+
+from sliceoflife_webservice.toolkit import sniff_image_type, sniff_upload_type, sniff_stream_type, \
+                                          guess_image_type, ImageUploadFile
+from sliceoflife_webservice.exceptions import UnsupportedMediaError
+
+@pytest.mark.parametrize('header, content_type', [
+    (b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n\x00\x00\x00\r', 'image/png'),
+    (b'GIF89a\x01\x00\x01\x00\x00\x00', 'image/gif'),
+    (b'RIFF\x24\x00\x00\x00WEBP', 'image/webp'),
+    (b'\x00\x00\x00\x18ftypheic', 'image/heic'),
+    (b'%PDF-1.7\n%\xe2\xe3\xcf\xd3', None),
+    (b'', None)
+])
+def test_sniff_image_type(header, content_type):
+    """Test images are recognized by their signatures"""
+    assert sniff_image_type(header) == content_type
+
+def test_sniff_upload_type_rewinds():
+    """Test the uploaded file can still be read in full after it is checked"""
+    upload = BytesIO(b'\x89PNG\r\n\x1a\n rest of the image')
+    assert sniff_upload_type(upload) == 'image/png'
+    assert upload.read() == b'\x89PNG\r\n\x1a\n rest of the image'
+
+def test_sniff_upload_type_on_jpeg_file():
+    """Test a real image file is recognized"""
+    with open('test/files/postimage.jpeg', 'rb') as upload:
+        assert sniff_upload_type(upload) == 'image/jpeg'
+
+@pytest.mark.parametrize('filename, content_type', [
+    ('slice.jpg', 'image/jpeg'),
+    ('slice.JPEG', 'image/jpeg'),
+    ('slice.heic', 'image/heic'),
+    ('slice.webp', 'image/webp'),
+    ('slice.exe', None),
+    ('slice', None)
+])
+def test_guess_image_type(filename, content_type):
+    """Test images are recognized by their file names"""
+    assert guess_image_type(filename) == content_type
+
+def test_image_upload_file_keeps_images():
+    """Test an image written in small pieces can be read back in full"""
+    upload = ImageUploadFile()
+    for piece in (b'\x89PNG', b'\r\n\x1a\n', b' rest of the image'):
+        upload.write(piece)
+    upload.seek(0)
+    assert upload.read() == b'\x89PNG\r\n\x1a\n rest of the image'
+
+def test_image_upload_file_refuses_other_files():
+    """Test a file is refused once its first bytes show it is not an image"""
+    upload = ImageUploadFile()
+    upload.write(b'#!/bin')
+    with pytest.raises(UnsupportedMediaError):
+        upload.write(b'/sh pretending to be a png')
+
+@pytest.mark.parametrize('size', [-1, 1, 5, 64])
+def test_sniff_stream_type_gives_back_the_whole_stream(size):
+    """Test a stream that cannot be rewound is read in full after it is checked"""
+    content_type, stream = sniff_stream_type(BytesIO(b'\x89PNG\r\n\x1a\n rest of the image'))
+    assert content_type == 'image/png'
+    data = b''
+    for chunk in iter(lambda: stream.read(size), b''):
+        data += chunk
+    assert data == b'\x89PNG\r\n\x1a\n rest of the image'
+
+def test_sniff_stream_type_on_short_streams():
+    """Test a stream too short to be an image is not one"""
+    content_type, stream = sniff_stream_type(BytesIO(b'\x89PNG'))
+    assert content_type is None
+    assert stream.read() == b'\x89PNG'
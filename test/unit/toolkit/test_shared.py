@@ -0,0 +1,195 @@
+"""
+    module_name: test_shared
+    module_summary: test the SharedCache class from toolkit module
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+import multiprocessing
+import os
+import stat
+from unittest.mock import patch
+
+import pytest
+from freezegun import freeze_time
+
+from sliceoflife_webservice.toolkit import SharedCache, ExpiringLRUCache, region_cache
+from sliceoflife_webservice.dbtools.schema import Task
+
+@pytest.fixture
+def cache_path(tmp_path):
+    """Test file to keep shared caches in"""
+    return str(tmp_path / 'test.cache')
+
+@pytest.fixture
+def mock_cache(cache_path):
+    """Test shared cache of four entries that expire after a minute"""
+    cache = SharedCache(cache_path, 4, ttl=60, slot_size=256)
+    yield cache
+    cache.close()
+
+def fill_from_another_process(path: str):
+    """Store an entry the way another worker would"""
+    cache = SharedCache(path, 4, ttl=60, slot_size=256)
+    cache.put(('task', 1), Task(1, 'task1', 'task1 description', True))
+    cache.close()
+
+def test_cached_values_are_returned(mock_cache):
+    """Test a stored value is found again"""
+    mock_cache.put('key', 'value')
+    mock_cache.put(('key', 2), {'a': [1, 2]})
+    assert mock_cache.get('key') == 'value'
+    assert mock_cache.get(('key', 2)) == {'a': [1, 2]}
+    assert mock_cache.get('other') is None
+    assert mock_cache.get('other', 'default') == 'default'
+    assert mock_cache.stats()['hits'] == 2
+    assert mock_cache.stats()['misses'] == 2
+    assert len(mock_cache) == 2
+
+def test_values_are_shared_between_processes(mock_cache, cache_path):
+    """Test an entry stored by one process is seen by another"""
+    worker = multiprocessing.get_context('fork').Process(
+        target=fill_from_another_process, args=(cache_path,)
+    )
+    worker.start()
+    worker.join(10)
+    assert worker.exitcode == 0
+    assert mock_cache.get(('task', 1)) == Task(1, 'task1', 'task1 description', True)
+
+def put_from_a_forked_worker(cache: SharedCache):
+    """Store an entry through a cache inherited from the parent process"""
+    cache.put('key', 'child')
+
+def test_caches_made_before_a_fork_still_lock_out_other_workers(mock_cache):
+    """Test a forked worker waits for the lock its parent holds on an inherited cache"""
+    mock_cache.put('key', 'parent')
+    worker = multiprocessing.get_context('fork').Process(
+        target=put_from_a_forked_worker, args=(mock_cache,)
+    )
+    with mock_cache._locked():
+        worker.start()
+        worker.join(0.5)
+        assert worker.is_alive()
+        assert mock_cache.get('key') == 'parent'
+    worker.join(10)
+    assert worker.exitcode == 0
+    assert mock_cache.get('key') == 'child'
+
+def test_cache_file_is_private(cache_path):
+    """Test only the owner may read the pickles in a new cache file"""
+    cache = SharedCache(cache_path, 4)
+    assert stat.S_IMODE(os.stat(cache_path).st_mode) == 0o600
+    cache.close()
+
+def test_cache_file_of_another_user_is_refused(monkeypatch, tmp_path, cache_path):
+    """Test a cache file somebody else made is not unpickled"""
+    SharedCache(cache_path, 4).close()
+    with patch('os.getuid', return_value=os.getuid() + 1):
+        with pytest.raises(PermissionError):
+            SharedCache(cache_path, 4)
+        monkeypatch.setenv('SHAREDCACHEDIR', str(tmp_path))
+        (tmp_path / 'sliceoflife-test-4x512.cache').touch()
+        assert isinstance(region_cache('test', 4), ExpiringLRUCache)
+
+def test_values_are_replaced(mock_cache):
+    """Test storing a key again replaces its value"""
+    mock_cache.put('key', 'old')
+    mock_cache.put('key', 'new')
+    assert mock_cache.get('key') == 'new'
+    assert len(mock_cache) == 1
+
+def test_values_expire(mock_cache):
+    """Test entries are not returned once their ttl has passed"""
+    with freeze_time('2023-01-01 00:00:00') as frozen:
+        mock_cache.put('a', 1)
+        mock_cache.put('b', 2, ttl=120)
+        frozen.tick(61)
+        assert mock_cache.get('a') is None
+        assert mock_cache.get('b') == 2
+
+def test_recently_read_values_survive_eviction(mock_cache):
+    """Test a full cache evicts an entry that has not been read"""
+    for key in 'abcd':
+        mock_cache.put(key, key)
+    assert mock_cache.get('a') == 'a'
+    mock_cache.put('e', 'e')
+    assert len(mock_cache) == 4
+    assert mock_cache.get('a') == 'a'
+    assert mock_cache.get('e') == 'e'
+
+def test_values_too_large_are_not_cached(mock_cache):
+    """Test values that do not fit a slot are skipped, and drop what they replace"""
+    mock_cache.put('key', 'small')
+    mock_cache.put('key', 'x' * 1024)
+    assert mock_cache.get('key') is None
+    assert mock_cache.stats()['oversize'] == 1
+
+def test_values_can_be_invalidated(mock_cache):
+    """Test entries can be forgotten on demand"""
+    mock_cache.put(('latest', 1), 1)
+    mock_cache.put(('slice', 1), 2)
+    mock_cache.put(('slice', 2), 3)
+    mock_cache.invalidate(('slice', 2))
+    assert mock_cache.get(('slice', 2)) is None
+    mock_cache.invalidate_matching(lambda key: key[0] == 'latest')
+    assert mock_cache.get(('latest', 1)) is None
+    assert mock_cache.get(('slice', 1)) == 2
+    mock_cache.clear()
+    assert len(mock_cache) == 0
+    mock_cache.put(('slice', 1), 4)
+    assert mock_cache.get(('slice', 1)) == 4
+
+def test_torn_reads_are_misses(mock_cache):
+    """Test a slot being written by another process is not read"""
+    mock_cache.put('key', 'value')
+    slot = next(s for s in range(4) if mock_cache._header(s)[1])
+    offset = mock_cache._offset(slot)
+    sequence = mock_cache._SEQUENCE.unpack_from(mock_cache._map, offset)[0]
+    mock_cache._SEQUENCE.pack_into(mock_cache._map, offset, sequence + 1)
+    assert mock_cache.get('key') is None
+    mock_cache._SEQUENCE.pack_into(mock_cache._map, offset, sequence + 2)
+    assert mock_cache.get('key') == 'value'
+
+def test_differently_laid_out_file_is_refused(mock_cache, cache_path):
+    """Test a cache file made for other settings is neither misread nor resized"""
+    mock_cache.put('key', 'value')
+    with pytest.raises(OSError):
+        SharedCache(cache_path, 8, slot_size=256)
+    assert os.path.getsize(cache_path) == 8 + 4 * 256
+    assert mock_cache.get('key') == 'value'
+
+def test_slots_must_fit_an_entry(cache_path):
+    """Test slots smaller than their header are refused"""
+    with pytest.raises(ValueError):
+        SharedCache(cache_path, 4, slot_size=8)
+
+def test_region_cache_is_local_by_default(monkeypatch):
+    """Test caches are kept in each process unless a shared directory is given"""
+    monkeypatch.delenv('SHAREDCACHEDIR', raising=False)
+    assert isinstance(region_cache('test', 4), ExpiringLRUCache)
+
+def test_region_cache_can_be_shared(monkeypatch, tmp_path):
+    """Test caches are kept in the shared directory when it is given"""
+    monkeypatch.setenv('SHAREDCACHEDIR', str(tmp_path))
+    cache = region_cache('test', 4, ttl=60)
+    assert isinstance(cache, SharedCache)
+    assert (tmp_path / 'sliceoflife-test-4x512.cache').exists()
+    cache.close()
+    # workers started with other settings keep to their own file
+    other = region_cache('test', 8, ttl=60)
+    assert isinstance(other, SharedCache)
+    assert (tmp_path / 'sliceoflife-test-8x512.cache').exists()
+    other.close()
+    assert isinstance(region_cache('test', 0), ExpiringLRUCache)
+
+def test_region_cache_shares_slots_within_its_byte_limit(monkeypatch, tmp_path):
+    """Test a shared cache of bytes gets only as many slots as its byte limit allows"""
+    monkeypatch.setenv('SHAREDCACHEDIR', str(tmp_path))
+    cache = region_cache('test', 16, slot_size=1024, max_bytes=4096)
+    assert cache.stats()['capacity'] == 4
+    assert (tmp_path / 'sliceoflife-test-4x1024.cache').exists()
+    cache.close()
+
+def test_region_cache_falls_back_to_local(monkeypatch, tmp_path):
+    """Test a shared directory that cannot be used leaves the cache local"""
+    monkeypatch.setenv('SHAREDCACHEDIR', str(tmp_path / 'missing'))
+    assert isinstance(region_cache('test', 4), ExpiringLRUCache)
@@ -4,9 +4,12 @@
     module_author: Nathan Mendoza (nathancm@uci.edu)
 """
 
+from io import BytesIO
 from unittest.mock import patch
 
 import pytest
+from freezegun import freeze_time
+from botocore.exceptions import ClientError
 
 from sliceoflife_webservice.toolkit import SpaceIndex
 from sliceoflife_webservice.exceptions import ServiceNotReachable
@@ -56,6 +59,167 @@ def test_can_save_file_with_active_session(mock_space_config):
     """Test file saving available with active session"""
     msi = SpaceIndex(**mock_space_config)
     msi.create_session()
-    with patch.object(msi._session, 'put_object') as mock_store:
-        msi.save_file("postimage_copy.jpeg", open("test/files/postimage.jpeg", 'rb'))
+    with patch.object(msi._session, 'upload_fileobj') as mock_store:
+        msi.save_file("postimage_copy.jpeg", open("test/files/postimage.jpeg", 'rb'), 'image/jpeg')
         assert mock_store.called
+        assert mock_store.call_args.kwargs['ExtraArgs']['ContentType'] == 'image/jpeg'
+        assert mock_store.call_args.kwargs['Config'].multipart_chunksize == SpaceIndex.SPACES_PART_SIZE
+
+def test_share_links_are_reused_while_valid(mock_space_config):
+    """Test a share link is reused until it is close to expiring"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with freeze_time('2023-01-01 00:00:00') as frozen:
+        with patch.object(msi._session, 'generate_presigned_url',
+                          side_effect=lambda **kwargs: f"link{mock_presign.call_count}") as mock_presign:
+            first = msi.get_share_link('postauthor/taskimage.png')
+            assert msi.get_share_link('postauthor/taskimage.png') == first
+            assert mock_presign.call_count == 1
+            frozen.tick(SpaceIndex.SPACES_SHARE_TIME - SpaceIndex.SPACES_SHARE_MARGIN + 1)
+            assert msi.get_share_link('postauthor/taskimage.png') != first
+            assert mock_presign.call_count == 2
+    assert msi.share_link_stats()['hits'] == 1
+
+def test_share_links_are_shared_between_workers(mock_space_config, monkeypatch, tmp_path):
+    """Test a share link made by one worker is reused by the others"""
+    monkeypatch.setenv('SHAREDCACHEDIR', str(tmp_path))
+    workers = [SpaceIndex(**mock_space_config) for _ in range(2)]
+    for msi in workers:
+        msi.create_session()
+    with patch.object(workers[0]._session, 'generate_presigned_url', return_value='link'):
+        assert workers[0].get_share_link('postauthor/taskimage.png') == 'link'
+    with patch.object(workers[1]._session, 'generate_presigned_url') as mock_presign:
+        assert workers[1].get_share_link('postauthor/taskimage.png') == 'link'
+        assert not mock_presign.called
+
+def test_share_links_with_longer_share_time(mock_space_config):
+    """Test share links can be made to last longer"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with patch.object(msi._session, 'generate_presigned_url', return_value='link') as mock_presign:
+        msi.get_share_link('avatar.png', share_time=SpaceIndex.SPACES_AVATAR_SHARE_TIME)
+        msi.get_share_link('avatar.png')
+    assert [c.kwargs['ExpiresIn'] for c in mock_presign.call_args_list] == [
+        SpaceIndex.SPACES_AVATAR_SHARE_TIME, SpaceIndex.SPACES_SHARE_TIME
+    ]
+
+def test_can_get_upload_link_with_active_session(mock_space_config):
+    """Test upload link obtainable with active session"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with patch.object(msi._session, 'generate_presigned_url', return_value='link') as mock_presign:
+        assert msi.get_upload_link('posts/user/task1.png', 'image/png') == 'link'
+    assert mock_presign.call_args.kwargs['ClientMethod'] == 'put_object'
+    assert mock_presign.call_args.kwargs['Params']['ContentType'] == 'image/png'
+
+def test_cannot_check_files_if_no_active_session(mock_space_config):
+    """Test checking for files prohibited without active session"""
+    msi = SpaceIndex(**mock_space_config)
+    with pytest.raises(ServiceNotReachable):
+        msi.file_exists('posts/user/task1.png')
+    with pytest.raises(ServiceNotReachable):
+        msi.get_upload_link('posts/user/task1.png', 'image/png')
+
+@pytest.mark.parametrize('code, exists', [(None, True), ('404', False), ('NoSuchKey', False)])
+def test_file_exists(mock_space_config, code, exists):
+    """Test checking for files that have or have not been saved"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with patch.object(msi._session, 'head_object') as mock_head:
+        if code:
+            mock_head.side_effect = ClientError({'Error': {'Code': code}}, 'HeadObject')
+        assert msi.file_exists('posts/user/task1.png') is exists
+
+def test_file_exists_when_storage_fails(mock_space_config):
+    """Test an unexpected storage error is reported as unreachable"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with patch.object(msi._session, 'head_object') as mock_head:
+        mock_head.side_effect = ClientError({'Error': {'Code': '403'}}, 'HeadObject')
+        with pytest.raises(ServiceNotReachable):
+            msi.file_exists('posts/user/task1.png')
+
+@pytest.mark.parametrize('code, size', [(None, 2048), ('404', None)])
+def test_file_size(mock_space_config, code, size):
+    """Test measuring files that have or have not been saved"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with patch.object(msi._session, 'head_object', return_value={'ContentLength': 2048}) as mock_head:
+        if code:
+            mock_head.side_effect = ClientError({'Error': {'Code': code}}, 'HeadObject')
+        assert msi.file_size('posts/user/task1.png') == size
+
+def test_read_file_start_asks_for_a_range(mock_space_config):
+    """Test only the start of a saved file is downloaded"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with patch.object(msi._session, 'get_object') as mock_get:
+        mock_get.return_value = {'Body': BytesIO(b'file')}
+        assert msi.read_file_start('posts/user/task1.png', 4) == b'file'
+        assert mock_get.call_args.kwargs['Range'] == 'bytes=0-3'
+
+def test_can_read_file_with_active_session(mock_space_config):
+    """Test saved files can be read back with active session"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with patch.object(msi._session, 'get_object') as mock_get:
+        mock_get.return_value = {'Body': BytesIO(b'file contents')}
+        assert msi.read_file('posts/user/task1.png') == b'file contents'
+    with pytest.raises(ServiceNotReachable):
+        SpaceIndex(**mock_space_config).read_file('posts/user/task1.png')
+
+def test_content_key_names_files_by_contents(mock_space_config):
+    """Test identical files get the same name and different files do not"""
+    msi = SpaceIndex(**mock_space_config)
+    upload = BytesIO(b'image bytes')
+    key = msi.content_key(upload, 'image/png')
+    assert key == msi.content_key(BytesIO(b'image bytes'), 'image/png')
+    assert key != msi.content_key(BytesIO(b'other bytes'), 'image/png')
+    assert key.startswith('images/') and key.endswith('.png')
+    assert upload.read() == b'image bytes'
+
+def test_stored_content_key_matches_content_key(mock_space_config):
+    """Test a saved file is named the same as it would have been before it was saved"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    stored = BytesIO(b'image bytes')
+    with patch.object(msi._session, 'get_object', return_value={'Body': stored}) as mock_get:
+        key = msi.stored_content_key('uploads/user1/token.png', 'image/png')
+        assert mock_get.call_args.kwargs['Key'] == 'uploads/user1/token.png'
+    assert key == msi.content_key(BytesIO(b'image bytes'), 'image/png')
+    assert stored.closed
+
+@pytest.mark.parametrize('exists', [True, False])
+def test_save_content_skips_known_files(mock_space_config, exists):
+    """Test files are only uploaded if their contents are new"""
+    msi = SpaceIndex(**mock_space_config)
+    msi.create_session()
+    with patch.object(msi, 'file_exists', return_value=exists):
+        with patch.object(msi, 'save_file') as mock_save:
+            assert msi.save_content('images/ab/abc.png', BytesIO(b'image bytes'), 'image/png') is not exists
+            assert mock_save.called is not exists
+
+def test_copy_file_stays_in_the_store(mock_space_config):
+    """Test files are copied by the object store, without downloading them"""
+    msi = SpaceIndex(**mock_space_config)
+    with pytest.raises(ServiceNotReachable):
+        msi.copy_file('uploads/user1/abc.png', 'images/ab/abc.png')
+    msi.create_session()
+    with patch.object(msi._session, 'copy_object') as mock_copy:
+        msi.copy_file('uploads/user1/abc.png', 'images/ab/abc.png')
+        mock_copy.assert_called_once_with(
+            Bucket=SpaceIndex.SPACES_BUCKET,
+            Key='images/ab/abc.png',
+            CopySource={'Bucket': SpaceIndex.SPACES_BUCKET, 'Key': 'uploads/user1/abc.png'},
+            ACL='private'
+        )
+
+def test_can_delete_file_with_active_session(mock_space_config):
+    """Test files can be deleted with active session"""
+    msi = SpaceIndex(**mock_space_config)
+    with pytest.raises(ServiceNotReachable):
+        msi.delete_file('images/ab/abc.png')
+    msi.create_session()
+    with patch.object(msi._session, 'delete_object') as mock_delete:
+        msi.delete_file('images/ab/abc.png')
+        mock_delete.assert_called_once_with(Bucket=SpaceIndex.SPACES_BUCKET, Key='images/ab/abc.png')
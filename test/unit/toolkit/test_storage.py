@@ -0,0 +1,120 @@
+"""
+    module_name: test_storage
+    module_summary: test the storage backends from toolkit module
+    module_author: Nathan Mendoza (nathancm@uci.edu)
+"""
+
+from io import BytesIO
+from unittest.mock import patch
+from urllib.parse import urlsplit, parse_qsl
+
+import pytest
+from freezegun import freeze_time
+
+from sliceoflife_webservice.toolkit import SpaceIndex, StorageBackend, LocalStorage
+from sliceoflife_webservice.exceptions import AuthorizationError, ContentNotFoundError, \
+                                              ConfigurationError
+
+@pytest.fixture
+def mock_local_storage(tmp_path):
+    """Test storage kept in a temporary directory"""
+    return LocalStorage(str(tmp_path), 'http://127.0.0.1:8000', 'secret')
+
+def link_args(link: str) -> dict:
+    """The query arguments of a link"""
+    return dict(parse_qsl(urlsplit(link).query))
+
+def test_local_storage_round_trip(mock_local_storage, tmp_path):
+    """Test files can be saved, read, found and deleted"""
+    mock_local_storage.save('images/ab/abc.png', BytesIO(b'image bytes'), 'image/png')
+    assert (tmp_path / 'images' / 'ab' / 'abc.png').read_bytes() == b'image bytes'
+    assert mock_local_storage.read('images/ab/abc.png') == b'image bytes'
+    assert mock_local_storage.exists('images/ab/abc.png')
+    assert mock_local_storage.size('images/ab/abc.png') == len(b'image bytes')
+    assert mock_local_storage.read_start('images/ab/abc.png', 5) == b'image'
+    with mock_local_storage.open('images/ab/abc.png') as stored:
+        assert stored.read() == b'image bytes'
+    mock_local_storage.copy('images/ab/abc.png', 'images/cd/cde.png')
+    assert mock_local_storage.read('images/cd/cde.png') == b'image bytes'
+    mock_local_storage.delete('images/ab/abc.png')
+    assert not mock_local_storage.exists('images/ab/abc.png')
+    assert mock_local_storage.size('images/ab/abc.png') is None
+
+def test_local_storage_save_is_atomic(mock_local_storage, tmp_path):
+    """Test a failed save leaves the previous file and no partial file behind"""
+    mock_local_storage.save('a.png', BytesIO(b'old'), 'image/png')
+    with patch('shutil.copyfileobj', side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            mock_local_storage.save('a.png', BytesIO(b'new'), 'image/png')
+    assert mock_local_storage.read('a.png') == b'old'
+    assert [p.name for p in tmp_path.iterdir()] == ['a.png']
+
+@pytest.mark.parametrize('key', ['../outside.png', 'images/../../outside.png', '/etc/passwd'])
+def test_local_storage_stays_in_its_directory(mock_local_storage, key):
+    """Test names cannot point outside of the storage directory"""
+    with pytest.raises(ContentNotFoundError):
+        mock_local_storage.path_for(key)
+
+def test_local_storage_signed_links(mock_local_storage):
+    """Test links are only valid for what they were signed for, until they expire"""
+    with freeze_time('2023-01-01 00:00:00') as frozen:
+        link = mock_local_storage.share_link('images/ab/abc.png', 300)
+        assert link.startswith('http://127.0.0.1:8000/api/v1/files/images/ab/abc.png?')
+        args = link_args(link)
+        mock_local_storage.verify('GET', 'images/ab/abc.png', args)
+        with pytest.raises(AuthorizationError):
+            mock_local_storage.verify('GET', 'images/ab/other.png', args)
+        with pytest.raises(AuthorizationError):
+            mock_local_storage.verify('PUT', 'images/ab/abc.png', args)
+        with pytest.raises(AuthorizationError):
+            mock_local_storage.verify('GET', 'images/ab/abc.png', {**args, 'expires': '9999999999'})
+        frozen.tick(301)
+        with pytest.raises(AuthorizationError):
+            mock_local_storage.verify('GET', 'images/ab/abc.png', args)
+
+def test_local_storage_upload_links(mock_local_storage):
+    """Test upload links are bound to their content type"""
+    args = link_args(mock_local_storage.upload_link('a.png', 'image/png', 300))
+    mock_local_storage.verify('PUT', 'a.png', args, 'image/png')
+    with pytest.raises(AuthorizationError):
+        mock_local_storage.verify('PUT', 'a.png', args, 'text/html')
+
+def test_space_index_with_local_backend(tmp_path):
+    """Test a space index can keep files locally"""
+    msi = SpaceIndex(SPACES_BACKEND='local', SPACES_ROOT=str(tmp_path),
+                     SPACES_LOCAL_URL='http://127.0.0.1:8000', SPACES_LOCAL_KEY='secret')
+    msi.create_session()
+    assert isinstance(msi.local_storage(), LocalStorage)
+    msi.save_file('a.png', BytesIO(b'image bytes'), 'image/png')
+    assert msi.file_exists('a.png')
+    assert msi.get_share_link('a.png').startswith('http://127.0.0.1:8000/api/v1/files/a.png')
+
+def test_space_index_with_object_store_has_no_local_storage():
+    """Test files kept in an object store are not served by the API"""
+    msi = SpaceIndex(SPACES_ENDPOINT='http://127.0.0.1:3200')
+    msi.create_session()
+    with pytest.raises(ContentNotFoundError):
+        msi.local_storage()
+
+@pytest.mark.parametrize('config', [
+    {'SPACES_LOCAL_KEY': 'secret'},
+    {'SPACES_LOCAL_URL': 'http://127.0.0.1:8000'},
+    {'SPACES_ENDPOINT': 'http://127.0.0.1:3200', 'SPACES_SECRET': 'secret'}
+])
+def test_space_index_with_local_backend_needs_its_settings(tmp_path, monkeypatch, config):
+    """Test local storage without a URL or signing key is refused up front"""
+    monkeypatch.delenv('BASE_URL', raising=False)
+    monkeypatch.delenv('SPACES_LOCAL_URL', raising=False)
+    monkeypatch.delenv('SPACES_LOCAL_KEY', raising=False)
+    msi = SpaceIndex(SPACES_BACKEND='local', SPACES_ROOT=str(tmp_path), **config)
+    with pytest.raises(ConfigurationError):
+        msi.create_session()
+    assert not msi.has_active_session()
+
+def test_storage_backends_must_implement_the_interface():
+    """Test a backend missing part of the interface cannot be made"""
+    class PartialStorage(StorageBackend): # pylint: disable=abstract-method
+        def share_link(self, key: str, share_time: int) -> str:
+            return key
+    with pytest.raises(TypeError):
+        PartialStorage()